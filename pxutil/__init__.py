@@ -22,14 +22,40 @@ from .pxutil import (
     register_signal_ctrl_c,
     post,
     request,
+    apost,
+    arequest,
+    request_many,
+    ResponseStream,
+    deadline,
+    remaining_time,
+    DeadlineExceeded,
+    SessionPool,
+    get_session_pool,
+    RetryPolicy,
+    CircuitBreaker,
+    ResponseCache,
+    RequestMetrics,
+    request_metrics,
     set_work_path,
     prepend_sys_path,
     import_any,
     ChatAPI,
+    ChatCache,
+    ChatSessionLog,
+    ChatRateLimiter,
+    chat_rate_limiter,
+    ChatUsage,
     list_module_contents,
     setup_logger,
     read_dotenv,
     is_text_file,
     token_counter,
+    token_counter_approx,
+    token_counter_many,
+    token_counter_file,
+    token_counter_files,
+    TokenCountCache,
+    json_loads,
+    json_dumps,
 )
 from .pxutil_cy import run_loop, fib
@@ -12,11 +12,13 @@ import sys
 import textwrap
 from time import sleep
 import argparse
+import json
+import shlex
 import shutil
 
 # add pxutil/pxutil.py functions and classes to pxutil/__init__.py so that
 # it can be imported as `from pxutil import <func>` both outside and inside pxutil package
-from pxutil import bashx, register_signal_ctrl_c, ChatAPI
+from pxutil import bashx, register_signal_ctrl_c, ChatAPI, ChatSessionLog
 import pxutil as px
 
 # defaults
@@ -74,18 +76,197 @@ def chat_main():
         action="store_true",
         help="Quick mode to get answer, e.g., add 'Short answer pls' to chat.",
     )
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="print the answer when it is complete instead of streaming it as it is generated.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print a stats footer after each answer: tokens, wall time, time to first token and tokens/sec.",
+    )
+    parser.add_argument(
+        "-s",
+        "--session",
+        help="name of a persistent chat session to save and resume, e.g. ops, saved in ~/.pxutil/chat_sessions.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        metavar="FILE",
+        help="non-interactive batch mode, ask each prompt of FILE ('-' for stdin) independently, without chat history. "
+        'A line is a prompt, or a JSON record {"id": ..., "prompt": ...}, id defaults to a hash of the prompt.',
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="batch mode: number of concurrent API calls, default: 8.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="batch mode: JSONL output file, default to stdout. "
+        "An existing output is resumed, i.e. prompts answered already are skipped, error records are removed "
+        "and asked again, and new results are appended.",
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="batch mode: write results as they complete instead of in input order.",
+    )
     args = parser.parse_args()
 
+    if args.batch:
+        chat = ChatAPI(model=args.model.strip(), remember_chat_history=False)
+        return chat_batch(chat, args)
+
     register_signal_ctrl_c()
-    chat = ChatAPI(model=args.model.strip())
+    history_log = None
+    if args.session:
+        try:
+            history_log = ChatSessionLog(args.session)
+        except (ValueError, OSError) as e:
+            sys.exit(f"Failed to open chat session {args.session}: {e}")
+    chat = ChatAPI(model=args.model.strip(), history_log=history_log)
+    if history_log is not None and len(history_log):
+        print(f"Resumed session {args.session}: {len(history_log) // 2} chats, last {len(chat.chat_history) // 2} in context.")
     while True:
         question = input("> ")
         if question in ("q", "quit"):
             break
         if args.quick:
             question += "\nShort answer pls."
-        answer = chat.chat(question)
-        print(answer)
+        if args.no_stream:
+            answer = chat.chat(question)
+            print(answer)
+        else:
+            deltas = chat.chat_stream(question)
+            if isinstance(deltas, Exception):
+                print(deltas)
+            else:
+                try:
+                    for delta in deltas:
+                        print(delta, end="", flush=True)
+                except Exception as e:
+                    print(f"\nChat stream failed with error: {e}", end="")
+                print()
+        if args.stats:
+            print(chat.usage.footer())
+
+
+def _batch_prompt_id(prompt, seen):
+    """return default id of a batch prompt: a hash of it, with -2, -3... suffixes of repeats counted in seen"""
+    import hashlib
+
+    digest = hashlib.sha256(str(prompt).encode("utf-8", errors="surrogatepass")).hexdigest()[:16]
+    seen[digest] = seen.get(digest, 0) + 1
+    return digest if seen[digest] == 1 else f"{digest}-{seen[digest]}"
+
+
+def _read_batch_prompts(file):
+    """yield (id, prompt) of batch input lines, id defaults to a hash of the prompt
+
+    Unlike line numbers, hash ids stay the same when lines are added or removed, so an output is resumed
+    after the input is edited.
+    """
+    seen = {}
+    for line in file:
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        if line.lstrip().startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict) and "prompt" in record:
+                if "id" in record:
+                    yield record["id"], record["prompt"]
+                else:
+                    yield _batch_prompt_id(record["prompt"], seen), record["prompt"]
+                continue
+        yield _batch_prompt_id(line, seen), line
+
+
+def _resume_batch_output(output):
+    """return ids answered in an existing output, and remove its error records and torn last line
+
+    Prompts of error records are asked again and get new records, and the last line is torn if a run is
+    interrupted. The output is rewritten to a temporary file and renamed, not to lose it if interrupted too.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "rb") as f:
+        data = f.read()
+    kept = []
+    for line in data[: data.rfind(b"\n") + 1].splitlines(keepends=True):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            kept.append(line)
+            continue
+        if not isinstance(record, dict):
+            kept.append(line)
+        elif "answer" in record:
+            done.add(json.dumps(record.get("id")))
+            kept.append(line)
+        elif "error" not in record:
+            kept.append(line)
+    kept = b"".join(kept)
+    if kept != data:
+        with open(output + ".tmp", "wb") as f:
+            f.write(kept)
+        os.replace(output + ".tmp", output)
+    return done
+
+
+def chat_batch(chat, args):
+    """px.chat --batch: ask prompts of a file or stdin with concurrent workers and write results in JSONL
+
+    output record: {"id": "3f79bb7b435b0532", "prompt": "...", "answer": "..."}, or "error" instead of "answer"
+    """
+    done = _resume_batch_output(args.output) if args.output else set()
+    input_file = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8")
+    output_file = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    pending = {}  # position in questions => (id, prompt) until answered
+    asked = skipped = 0
+
+    def questions():
+        nonlocal asked, skipped
+        for prompt_id, prompt in _read_batch_prompts(input_file):
+            if json.dumps(prompt_id) in done:
+                skipped += 1
+                continue
+            pending[asked] = (prompt_id, prompt)
+            asked += 1
+            yield prompt + "\nShort answer pls." if args.quick else prompt
+
+    answered = errors = 0
+    try:
+        for index, answer in chat.imap(questions(), max_workers=args.jobs, ordered=not args.unordered):
+            prompt_id, prompt = pending.pop(index)
+            record = {"id": prompt_id, "prompt": prompt}
+            if isinstance(answer, Exception):
+                record["error"] = str(answer)
+                errors += 1
+            else:
+                record["answer"] = answer
+                answered += 1
+            output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output_file.flush()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    print(f"{answered} answers, {errors} errors, {skipped} skipped as answered already.", file=sys.stderr)
+    if args.stats:
+        print(chat.usage.to_json(), file=sys.stderr)
+    return 1 if errors else 0
 
 
 def runc_main():
@@ -137,6 +318,62 @@ def ls_mod_main():
     px.list_module_contents(args.module)
 
 
+def list_text_files(root=".", spec_file=None):
+    """return text files under root, relative to root, respecting .gitignore and an optional spec file
+
+    spec_file: file in the same format as .gitignore but specify files to include, e.g., .includefiles
+    """
+    import pathspec
+
+    ## get files excluding the ones specified in .gitignore
+    ## use 'git ls-files' for best match and recursive .gitignore support
+    ls_files = None
+    is_repo_root = os.path.isdir(os.path.join(root, ".git"))
+    if shutil.which("git"):
+        # also works in a sub folder of a repo
+        r = px.bash(f"git -C {shlex.quote(root)} ls-files -z")
+        if r.returncode == 0:
+            ls_files = [f for f in r.stdout.split("\0") if f]
+        elif is_repo_root:
+            sys.exit(
+                f"Error: git ls-files failed with return code: {r.returncode}, stderr: {r.stderr}"
+            )
+    elif is_repo_root:
+        sys.exit("Oops... git command not found. Please install git first.")
+    if ls_files is None:
+        # get all files if not a repo
+        ls_files = []
+        for dirpath, dirs, files in os.walk(root):
+            # For each file, construct relative path to be same output format as git ls-files
+            for file in files:
+                ls_files.append(os.path.relpath(os.path.join(dirpath, file), root))
+
+    ## get files included in spec file, e.g., .includefiles
+    if spec_file:
+        if not os.path.isfile(spec_file):
+            sys.exit(f"Error: spec file {spec_file} does not exit.")
+        with open(spec_file, "r") as f:
+            spec_text = f.read()
+        spec = pathspec.GitIgnoreSpec.from_lines(spec_text.splitlines())
+        include_files = set(spec.match_tree(root))
+        ## get intersection of git_ls_files and include_files
+        ls_files = [f for f in ls_files if f in include_files]
+
+    # exclude binary files, and files deleted but not committed yet
+    return [f for f in ls_files if px.is_text_file(os.path.join(root, f)) and os.path.isfile(os.path.join(root, f))]
+
+
+def _token_count_cache(enabled=True):
+    """return the TokenCountCache of CLI scripts, or None if disabled or it can't be opened"""
+    if not enabled:
+        return None
+    try:
+        return px.TokenCountCache()
+    except Exception as e:
+        print(f"Token count cache is disabled, failed to open it with error: {e}", file=sys.stderr)
+        return None
+
+
 def onefile_main():
     """px.onefile cli
 
@@ -155,8 +392,6 @@ def onefile_main():
     content
     ```
     """
-    import pathspec
-
     ## Parse command line arguments.
     parser = argparse.ArgumentParser(
         description="Combine files in a repo into one for LLM prompt, and respect .gitignore and an optional spec file in the same format to specify files to include. Run it in your repo root folder. Inspired by files-to-prompt."
@@ -177,6 +412,12 @@ def onefile_main():
         default="a.md",
         help="output file, default: a.md",
     )
+    parser.add_argument(
+        "-t",
+        "--tokens",
+        action="store_true",
+        help="count tokens of the files, cached by content in ~/.cache/pxutil/token_counts.sqlite3",
+    )
     args = parser.parse_args()
 
     ## Usage
@@ -187,6 +428,9 @@ def onefile_main():
     # With spec to include only certain files
     px.onefile -s .includefiles
 
+    # Print the token total of the files too
+    px.onefile -t
+
     spec example: only *.py except tests/*.py
     ---
     *.py
@@ -204,45 +448,7 @@ def onefile_main():
         print(usages)
         sys.exit()
 
-    ## get files excluding the ones specified in .gitignore
-    ## use 'git ls-files' for best match and recursive .gitignore support
-    ls_files = []
-    if os.path.isdir(".git"):
-        if not shutil.which("git"):
-            sys.exit("Oops... git command not found. Please install git first.")
-        r = px.bash("git ls-files")
-        if r.returncode != 0:
-            sys.exit(
-                f"Error: git ls-files failed with return code: {r.returncode}, stderr: {r.stderr}"
-            )
-        ls_files = r.stdout.splitlines()
-    else:
-        # get all files if not a repo
-        for root, dirs, files in os.walk("."):
-            # For each file, construct relative path to be same output format as git ls-files
-            for file in files:
-                ls_files.append(os.path.relpath(os.path.join(root, file), "."))
-
-    ## get files included in spec file, e.g., .includefiles
-    include_files = None
-    spec_file = args.spec
-    if spec_file:
-        if not os.path.isfile(spec_file):
-            sys.exit(f"Error: spec file {spec_file} does not exit.")
-        with open(spec_file, "r") as f:
-            spec_text = f.read()
-        spec = pathspec.GitIgnoreSpec.from_lines(spec_text.splitlines())
-        matches = spec.match_tree(".")
-        include_files = list(matches)
-
-    ## get intersection of git_ls_files and include_files
-    if include_files:
-        files = set(ls_files) & set(include_files)
-    else:
-        files = ls_files
-
-    # exclude binary files
-    files = [f for f in files if px.is_text_file(f)]
+    files = list_text_files(".", args.spec)
 
     output = px.normal_path(args.output)
     if not os.path.isdir(os.path.dirname(output)):
@@ -281,33 +487,196 @@ def onefile_main():
             )
             # fmt: on
             out_f.write(to_output)
-    print(f"one file is generated at {args.output}")
+    # token footprint of the files, counted once per content by the token count cache
+    message = f"one file is generated at {args.output}"
+    if args.tokens:
+        counts = px.token_counter_files(files, cache=_token_count_cache())
+        tokens = sum(c for c in counts if not isinstance(c, Exception))
+        if len(counts) > 0 and tokens > 0:
+            message += f", {tokens} tokens of {len(files)} files"
+    print(message)
+
+
+def _expand_token_paths(paths, spec_file=None):
+    """return files of paths: files as they are, text files of directories and globs respecting .gitignore and spec"""
+    import glob
+
+    files = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                print(f"{path} matches no files.", file=sys.stderr)
+            files.extend(_expand_token_paths(matches, spec_file))
+        elif os.path.isdir(path):
+            files.extend(os.path.normpath(os.path.join(path, f)) for f in list_text_files(path, spec_file))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            sys.exit(f"{path} does not exist!")
+    # a file may be given twice, e.g. by a directory and a glob
+    return list(dict.fromkeys(files))
+
+
+def token_report(files, counts, sort="tokens"):
+    """return report dict of files with token counts, and token totals of each directory and all files
+
+    counts: token count or Exception per file, e.g. of token_counter_files()
+    """
+    rows = []
+    errors = []
+    directories = {}
+    for path, tokens in zip(files, counts):
+        if isinstance(tokens, Exception):
+            errors.append({"path": path, "error": str(tokens)})
+            continue
+        size = os.path.getsize(path)
+        rows.append({"path": path, "tokens": tokens, "bytes": size})
+        # add to all ancestor directories
+        directory = os.path.dirname(os.path.normpath(path))
+        while directory not in ("", os.sep):
+            total = directories.setdefault(directory, {"path": directory, "tokens": 0, "bytes": 0, "files": 0})
+            total["tokens"] += tokens
+            total["bytes"] += size
+            total["files"] += 1
+            directory = os.path.dirname(directory)
+    dirs = list(directories.values())
+    if sort == "path":
+        rows.sort(key=lambda r: r["path"])
+        dirs.sort(key=lambda r: r["path"])
+    else:
+        rows.sort(key=lambda r: (-r["tokens"], r["path"]))
+        dirs.sort(key=lambda r: (-r["tokens"], r["path"]))
+    total = {
+        "tokens": sum(r["tokens"] for r in rows),
+        "bytes": sum(r["bytes"] for r in rows),
+        "files": len(rows),
+    }
+    return {"files": rows, "directories": dirs, "total": total, "errors": errors}
+
+
+def _print_token_report(report):
+    print(f"{'tokens':>12} {'bytes':>12}  file")
+    for row in report["files"]:
+        print(f"{row['tokens']:>12} {row['bytes']:>12}  {row['path']}")
+    if report["directories"]:
+        print(f"\n{'tokens':>12} {'bytes':>12}  directory (files)")
+        for row in report["directories"]:
+            print(f"{row['tokens']:>12} {row['bytes']:>12}  {row['path']}/ ({row['files']})")
+    total = report["total"]
+    print(f"\n{total['tokens']:>12} {total['bytes']:>12}  total ({total['files']} files)")
+    for error in report["errors"]:
+        print(f"{error['path']}: {error['error']}", file=sys.stderr)
 
 
 def token_counter_main():
     """px.token.counter cli
 
-    count LLM tokens of a given file
+    count LLM tokens of a given file, streamed in chunks with bounded memory,
+    or a report of files in directories and globs, counted on a process pool
     """
-    import pathspec
-
     ## Parse command line arguments.
-    parser = argparse.ArgumentParser(description="count LLM tokens of a given file.")
+    parser = argparse.ArgumentParser(
+        description="count LLM tokens of a given file, or report tokens per file and directory of "
+        "directories and globs, respecting .gitignore like px.onefile."
+    )
     parser.add_argument(
-        "file",
-        help="file to count",
+        "paths",
+        nargs="+",
+        metavar="path",
+        help="file, directory or glob (quoted, ** for recursive) to count, '-' for stdin",
+    )
+    parser.add_argument(
+        "-s",
+        "--spec",
+        help="spec file in the same format as .gitignore but specify files to include in directories, e.g., .includefiles",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="worker processes to count files, default: number of CPUs",
+    )
+    parser.add_argument(
+        "--sort",
+        choices=("tokens", "path"),
+        default="tokens",
+        help="sort report by tokens (default, most first) or path",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print report in json",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="count all files again instead of reusing counts of unchanged content in ~/.cache/pxutil/token_counts.sqlite3",
+    )
+    parser.add_argument(
+        "-e",
+        "--encoding",
+        help=f"tiktoken encoding, default: {px.pxutil.TOKEN_ENCODING}",
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        help="count by the encoding of the model instead, e.g. gpt-4o",
+    )
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="don't show progress, which is shown on stderr if it is a terminal",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="estimate tokens by character classes without tiktoken, relative error mean 5%%, p95 13%% on docs and code",
     )
 
     args = parser.parse_args()
-    if not os.path.isfile(args.file):
-        sys.exit(f"{args.file} does not exist!")
+    if args.paths == ["-"]:
+        file, total_bytes = sys.stdin.buffer, None
+    elif len(args.paths) == 1 and os.path.isfile(args.paths[0]) and not args.json:
+        file, total_bytes = args.paths[0], os.path.getsize(args.paths[0])
+    else:
+        files = _expand_token_paths(args.paths, args.spec)
+        cache = _token_count_cache(not args.no_cache and not args.fast)
+        counts = px.token_counter_files(
+            files, args.encoding, args.model, max_workers=args.jobs, cache=cache, approx=args.fast
+        )
+        report = token_report(files, counts, args.sort)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            _print_token_report(report)
+        return 1 if report["errors"] else 0
+
+    progress = None
+    if not args.no_progress and sys.stderr.isatty():
+
+        def progress(bytes_read, tokens):
+            read = f"{bytes_read / 1e6:.1f} MB"
+            if total_bytes:
+                read += f" / {total_bytes / 1e6:.1f} MB ({100 * bytes_read / total_bytes:.0f}%)"
+            print(f"\r{read}, {tokens} tokens", end="", file=sys.stderr, flush=True)
 
     try:
-        with open(args.file, "r") as f:
-            content = f.read()
-        print(px.token_counter(content))
+        cache = _token_count_cache(not args.no_cache and not args.fast and file is not sys.stdin.buffer)
+        if cache is not None:
+            tokens = cache.count_file(file, args.encoding, args.model, progress=progress)
+            if isinstance(tokens, Exception):
+                raise tokens
+        else:
+            tokens = px.token_counter_file(
+                file, encoding=args.encoding, model=args.model, progress=progress, approx=args.fast
+            )
     except Exception as e:
-        print(f"Failed to count token with error: {e}")
+        sys.exit(f"Failed to count token with error: {e}")
+    finally:
+        if progress is not None:
+            print(file=sys.stderr)
+    print(tokens)
 
 
 if __name__ == "__main__":
@@ -3,12 +3,21 @@
 Some handy utilities from Peter Jiping Xie
 """
 
-import copy
 import sys
 import re
 import os
+import io
 import json
 import logging
+import random
+import socket
+import threading
+import time
+import weakref
+import contextvars
+import functools
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
 from logging.handlers import RotatingFileHandler
 from os import path
 import os.path as osp
@@ -16,7 +25,19 @@ from contextlib import contextmanager
 import pdb
 
 import requests
-
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# optional fast json codecs, fall back to stdlib json. See json_loads() and json_dumps().
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 ### Settings ###
 ## log level is not used.
 # log_level_str = os.getenv(
@@ -28,6 +49,18 @@ import requests
 
 LOG_MODULE_NAME_LEN = 8
 
+# max bytes of request / response body to pretty log, the rest is truncated.
+LOG_BODY_MAX_BYTES = 10240
+
+# max number of concurrent arequest() calls per event loop if no semaphore is provided.
+ASYNC_REQUEST_LIMIT = 64
+# threads running arequest() calls of all event loops, i.e. the cap of concurrent calls whatever the semaphores.
+# Read when the first arequest() is called.
+ASYNC_MAX_THREADS = 256
+
+# default (connect, read) timeout in seconds of request() if the caller sets none, not to hang forever.
+REQUEST_TIMEOUT = (10.0, 120.0)
+
 # root_path is parent folder of this file
 root_path = path.dirname(path.abspath(__file__))
 
@@ -142,33 +175,114 @@ def setup_logger(
     return logger
 
 
+# name of the json codec used by json_loads() and json_dumps(): orjson, ujson or json (stdlib).
+JSON_CODEC = "orjson" if orjson else "ujson" if ujson else "json"
+
+
+def json_loads(data):
+    """decode json with the fastest available codec: orjson, ujson or stdlib json
+
+    data: str, bytes, bytearray or memoryview
+    return: decoded object, raise ValueError (json.JSONDecodeError with orjson and stdlib) if it is not valid json
+            or TypeError if data type is not supported.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False, as_bytes=False):
+    """encode obj to compact json with the fastest available codec: orjson, ujson or stdlib json
+
+    indent:     pretty format with indentation, 2 spaces with orjson, otherwise 4.
+    as_bytes:   return utf-8 bytes, e.g., for request body, to save the encoding step.
+    return: json str, or bytes if as_bytes is True.
+
+    Note: It falls back to stdlib json for objects orjson does not support, e.g., non-str dict keys.
+    """
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+            return encoded if as_bytes else encoded.decode("utf-8")
+        except TypeError:
+            pass
+    if ujson is not None and orjson is None:
+        encoded = ujson.dumps(
+            obj, indent=4 if indent else 0, ensure_ascii=False, escape_forward_slashes=False
+        )
+    elif indent:
+        encoded = json.dumps(obj, indent=4, ensure_ascii=False)
+    else:
+        encoded = json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+    return encoded.encode("utf-8") if as_bytes else encoded
+
+
+def _looks_like_json(data: bytes):
+    """cheap check if bytes body is json by its first non-space byte, without parsing it"""
+    head = data[:64].lstrip()
+    return head[:1] in (b"{", b"[")
+
+
 def pretty_json(json_str):
     """return pretty formatted json string if possible, otherwise return the original
 
     json_str: The input could be anything, e.g., bytes, and it just returns the original if it is not a valid json string.
     """
-    import json
-
     try:
-        json_dict = json.loads(json_str)
-        return json.dumps(json_dict, indent=4)
+        json_dict = json_loads(json_str)
+        return json_dumps(json_dict, indent=True)
     # ValueError includes: UnicodeDecodeError (e.g. json_str is image binary), json.decoder.JSONDecodeError etc.
     # TypeError includes: dict, int etc.
     except (ValueError, TypeError):
         return json_str
 
 
-def pretty_print_request_json(request, logger):
+class _LazyStr:
+    """Log message argument that is only built when the log record is formatted by a handler"""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+
+def _truncate_body(body, max_body):
+    """return (body, truncated_note), body is sliced to max_body if it is str or bytes"""
+    if isinstance(body, (str, bytes)) and len(body) > max_body:
+        return body[:max_body], f"\n... <{len(body) - max_body} more truncated>"
+    return body, ""
+
+
+def pretty_print_request_json(request, logger, max_body=None):
     """pretty print request in json format if possible, otherwise print in text or bytes
     Note it may differ from the actual request as it is pretty formatted.
 
+    It does nothing unless logger is enabled for DEBUG, and the message is only built when it is emitted.
+
     Params
     ------
     request:    requests' request object
     logger:     logging instance
+    max_body:   max bytes of body to print, default to LOG_BODY_MAX_BYTES
     """
-    # pretty json if possible
-    req_body = pretty_json(request.body)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", _LazyStr(_format_request, request, max_body))
+
+
+def _format_request(request, max_body=None):
+    max_body = LOG_BODY_MAX_BYTES if max_body is None else max_body
+    req_body, truncated = _truncate_body(request.body, max_body)
+    # pretty json if possible, truncated json is printed as it is
+    if not truncated:
+        req_body = pretty_json(req_body)
 
     # decode bytes to string if possible
     # otherwise, replace form raw data (e.g. image) with string '<binary raw data>', then decode to string
@@ -177,51 +291,554 @@ def pretty_print_request_json(request, logger):
             req_body = req_body.decode("utf-8")
         except UnicodeDecodeError:
             # replace form raw data with string '<binary raw data>'
-            if "multipart/form-data" in request.headers.get("Content-Type"):
+            if "multipart/form-data" in request.headers.get("Content-Type", ""):
                 req_body = re.sub(
                     b"(\r\n\r\n)(.*?)(\r\n--)",
                     rb"\1<binary raw data>\3",
                     req_body,
                     flags=re.DOTALL,
                 )
-                req_body = req_body.decode("utf-8")
+                # truncated body may end in the middle of raw data
+                req_body = req_body.decode("utf-8", errors="replace")
             # else unchanged as bytes
             # print(req_body)
 
-    logger.debug(
-        "{}\n{}\n\n{}\n\n{}\n".format(
-            "-----------Request----------->",
-            request.method + " " + request.url,
-            "\n".join(f"{k}: {v}" for k, v in request.headers.items()),
-            req_body,
-        )
+    return "{}\n{}\n\n{}\n\n{}{}\n".format(
+        "-----------Request----------->",
+        request.method + " " + request.url,
+        "\n".join(f"{k}: {v}" for k, v in request.headers.items()),
+        req_body,
+        truncated,
     )
 
 
-def pretty_print_response_json(response, logger):
+def pretty_print_response_json(response, logger, stream=False, max_body=None):
     """pretty print response in json format
     If failing to parse body in json format, print in text.
 
+    It does nothing unless logger is enabled for DEBUG, and the message is only built when it is emitted.
+
     Params
     ------
     response:   requests' response object
     logger:     logging instance
+    stream:     True if the response body is streamed, then the body is not read or printed.
+    max_body:   max bytes of body to print, default to LOG_BODY_MAX_BYTES
     """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", _LazyStr(_format_response, response, stream, max_body))
+
+
+def _format_response(response, stream=False, max_body=None):
+    max_body = LOG_BODY_MAX_BYTES if max_body is None else max_body
+    truncated = ""
+    if stream:
+        resp_body = "<streamed body>"
+    elif len(response.content) > max_body:
+        resp_body, truncated = _truncate_body(response.content, max_body)
+        resp_body = resp_body.decode(response.encoding or "utf-8", errors="replace")
+    else:
+        try:
+            resp_data = json_loads(response.content)
+            resp_body = json_dumps(resp_data, indent=True)
+        # if decoding fails, ValueError is raised, take text format
+        except (ValueError, TypeError):
+            resp_body = response.text
+
+    return "{}\n{}\n\n{}\n\n{}{}\n".format(
+        "<-----------Response-----------",
+        "Status code:" + str(response.status_code),
+        "\n".join(f"{k}: {v}" for k, v in response.headers.items()),
+        resp_body,
+        truncated,
+    )
+
+
+class _Histogram:
+    """Histogram of values (e.g. seconds) with fixed log-scale buckets, to observe and estimate quantiles cheaply"""
+
+    # upper bounds of buckets, the last one is +inf
+    BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float("inf"),
+    )  # fmt: skip
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        from bisect import bisect_left
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """return estimated q quantile (0 to 1), interpolated in its bucket, or None if empty"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                high = min(self.buckets[i], self.max)
+                low = max(low, self.min)
+                return low + (high - low) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class RequestMetrics:
+    """In-process latency metrics of request() per host and method
+
+    Phases in seconds:
+    connect:    TCP connect and TLS handshake of new connections, 0 if a keep-alive connection is reused.
+                Only measured with pooled sessions, i.e., session is None or a SessionPool.
+    ttfb:       time to first byte, from sending the request to receiving response headers, including connect.
+    download:   reading the response body.
+    decode:     decoding the body to dict or text.
+    total:      whole request() call including retries.
+
+    Disabled by default, the overhead is one attribute check per call when disabled.
+
+    Usage:
+    px.request_metrics.enable()
+    px.request("GET", url)
+    print(px.request_metrics.snapshot())
+    print(px.request_metrics.to_prometheus())
+    """
+
+    PHASES = ("connect", "ttfb", "download", "decode", "total")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # (host, method) => {"status": {code: n}, "bytes": n, phase: _Histogram}
+        self._series = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def record(self, url, method, status, nbytes, timings):
+        """record one request() call
+
+        status:     response code or 'error'
+        timings:    dict of phase => seconds, missing phases are not recorded
+        """
+        key = (SessionPool.host_key(url), method.upper())
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"status": {}, "bytes": 0}
+                for phase in self.PHASES:
+                    series[phase] = _Histogram()
+            series["status"][str(status)] = series["status"].get(str(status), 0) + 1
+            series["bytes"] += nbytes
+            for phase, seconds in timings.items():
+                series[phase].observe(seconds)
+
+    def snapshot(self):
+        """return dict of "host method" => {"status": {code: n}, "bytes": n, phase: {count, sum, min, max, mean, p50, p95, p99}}"""
+        with self._lock:
+            return {
+                f"{host} {method}": {
+                    "status": dict(series["status"]),
+                    "bytes": series["bytes"],
+                    **{phase: series[phase].to_dict() for phase in self.PHASES},
+                }
+                for (host, method), series in self._series.items()
+            }
+
+    def to_json(self, indent=True):
+        return json_dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self, prefix="pxutil_request"):
+        """return metrics in Prometheus text exposition format"""
+        with self._lock:
+            series_items = [
+                (f'host="{host}",method="{method}"', series)
+                for (host, method), series in self._series.items()
+            ]
+            lines = [f"# TYPE {prefix}_total counter"]
+            for labels, series in series_items:
+                for status, count in series["status"].items():
+                    lines.append(f'{prefix}_total{{{labels},status="{status}"}} {count}')
+            lines.append(f"# TYPE {prefix}_response_bytes_total counter")
+            for labels, series in series_items:
+                lines.append(f"{prefix}_response_bytes_total{{{labels}}} {series['bytes']}")
+            lines.append(f"# TYPE {prefix}_duration_seconds histogram")
+            for labels, series in series_items:
+                for phase in self.PHASES:
+                    hist = series[phase]
+                    phase_labels = f'{labels},phase="{phase}"'
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(
+                            f'{prefix}_duration_seconds_bucket{{{phase_labels},le="{le}"}} {cumulative}'
+                        )
+                    lines.append(f"{prefix}_duration_seconds_sum{{{phase_labels}}} {hist.sum}")
+                    lines.append(f"{prefix}_duration_seconds_count{{{phase_labels}}} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+# default metrics recorded by request() when enabled
+request_metrics = RequestMetrics()
+
+# seconds spent to connect new connections in the current thread, read and reset by request()
+_connect_timer = threading.local()
+
+
+def _timed_connect(connect):
+    start = time.perf_counter()
     try:
-        resp_data = response.json()
-        resp_body = json.dumps(resp_data, indent=4)
-    # if .json() fails, ValueError is raised, take text format
-    except ValueError:
-        resp_body = response.text
-
-    logger.debug(
-        "{}\n{}\n\n{}\n\n{}\n".format(
-            "<-----------Response-----------",
-            "Status code:" + str(response.status_code),
-            "\n".join(f"{k}: {v}" for k, v in response.headers.items()),
-            resp_body,
+        connect()
+    finally:
+        _connect_timer.seconds = getattr(_connect_timer, "seconds", 0.0) + (
+            time.perf_counter() - start
         )
-    )
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        _timed_connect(super().connect)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _timed_connect(super().connect)
+
+
+class _BoundedWaitMixin:
+    """wait for a free connection of a blocking pool no longer than the connect timeout, instead of forever
+
+    requests passes no pool_timeout, and the connect timeout is capped by deadline() in request().
+    """
+
+    def urlopen(self, method, url, *args, **kwargs):
+        if self.block and kwargs.get("pool_timeout") is None:
+            wait = getattr(kwargs.get("timeout"), "connect_timeout", None)
+            if isinstance(wait, (int, float)):
+                kwargs["pool_timeout"] = wait
+        return super().urlopen(method, url, *args, **kwargs)
+
+
+class _CallConnections:
+    """connections in use by a call, to abort the call from another thread, e.g. a hedged call which lost
+
+    Sockets are shut down rather than closed, which wakes up a thread blocked reading the response.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        self.aborted = False
+
+    @staticmethod
+    def _shutdown(conn):
+        sock = getattr(conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def add(self, conn):
+        with self._lock:
+            if self.aborted:
+                self._shutdown(conn)
+            self._connections.add(conn)
+
+    def discard(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+
+    def abort(self):
+        """shut down connections in use and those taken later by the call"""
+        with self._lock:
+            self.aborted = True
+            for conn in self._connections:
+                self._shutdown(conn)
+
+
+# _CallConnections of the call in the current context, None if not tracked
+_call_connections = contextvars.ContextVar("pxutil_call_connections", default=None)
+
+
+class _TrackedConnMixin:
+    """add connections taken from the pool to _call_connections of the context while they are in use"""
+
+    def _get_conn(self, timeout=None):
+        connections = _call_connections.get()
+        if connections is not None and connections.aborted:
+            # don't send retries of an aborted call
+            raise ConnectionAbortedError("The call is aborted.")
+        conn = super()._get_conn(timeout)
+        if connections is not None:
+            connections.add(conn)
+            # a streamed response may release it in another context
+            conn._pxutil_call_connections = connections
+        return conn
+
+    def _put_conn(self, conn):
+        connections = getattr(conn, "_pxutil_call_connections", None)
+        if connections is not None:
+            connections.discard(conn)
+            conn._pxutil_call_connections = None
+        super()._put_conn(conn)
+
+
+class _TimedHTTPConnectionPool(_TrackedConnMixin, _BoundedWaitMixin, HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(_TrackedConnMixin, _BoundedWaitMixin, HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter measuring connect time (incl. TLS handshake) of new connections for RequestMetrics"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class _RejectAllCookies(DefaultCookiePolicy):
+    """Cookie policy to keep pooled sessions stateless like a fresh requests.Session() per call.
+
+    Cookies still work within a single call, e.g. set by a redirect, as requests uses a per-request jar then.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class SessionPool:
+    """Thread-safe pool of keep-alive requests.Session, one per host (scheme://host:port).
+
+    It saves the TCP and TLS handshakes of creating a new requests.Session() on every call.
+    Pooled sessions don't keep cookies between calls. Pass your own requests.Session() to request() for that.
+
+    Params
+    ------
+    max_per_host:   max number of connections per host kept alive for reuse.
+    idle_timeout:   seconds, close the session of a host which has not been used for this long.
+    block:          False (default) to open extra connections that are not kept when all max_per_host connections
+                    are busy, so concurrency is not capped. True to wait for a free connection instead, up to the
+                    connect timeout of the call (capped by deadline()), to cap connections to a host.
+
+    Usage:
+    pool = SessionPool(max_per_host=20)
+    with pool.session("https://httpbin.org/get") as s:
+        s.get("https://httpbin.org/get")
+    px.request("GET", "https://httpbin.org/get", session=pool)
+    pool.close()
+    """
+
+    def __init__(self, max_per_host=10, idle_timeout=60.0, block=False):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self._lock = threading.Lock()
+        # host key => [session, in use count, last used time]
+        self._entries = {}
+
+    @staticmethod
+    def host_key(url):
+        """return pool key of url, e.g., https://httpbin.org:443/get => https://httpbin.org:443"""
+        parts = urlsplit(url)
+        return f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+
+    def _new_session(self):
+        session = requests.Session()
+        # pool_connections is the number of hosts cached per adapter, a few for redirects to other hosts.
+        adapter = _TimedHTTPAdapter(
+            pool_connections=4, pool_maxsize=self.max_per_host, pool_block=self.block
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.cookies.set_policy(_RejectAllCookies())
+        return session
+
+    def acquire(self, url):
+        """return the pooled session of the url host, call release(url) when done."""
+        with self._lock:
+            evicted = self._pop_idle()
+            entry = self._entries.get(self.host_key(url))
+            if entry is None:
+                entry = [self._new_session(), 0, 0.0]
+                self._entries[self.host_key(url)] = entry
+            entry[1] += 1
+            entry[2] = time.monotonic()
+        for session in evicted:
+            session.close()
+        return entry[0]
+
+    def release(self, url):
+        """mark the session of url host acquired by acquire(url) as not in use."""
+        with self._lock:
+            entry = self._entries.get(self.host_key(url))
+            if entry is not None:
+                entry[1] = max(entry[1] - 1, 0)
+                entry[2] = time.monotonic()
+
+    @contextmanager
+    def session(self, url):
+        """With statement to use the pooled session of the url host
+
+        Yield: requests.Session
+        """
+        session = self.acquire(url)
+        try:
+            yield session
+        finally:
+            self.release(url)
+
+    def _pop_idle(self):
+        """remove idle entries from the pool and return their sessions. Call with self._lock held."""
+        now = time.monotonic()
+        idle_keys = [
+            key
+            for key, (_, in_use, last_used) in self._entries.items()
+            if in_use == 0 and now - last_used >= self.idle_timeout
+        ]
+        return [self._entries.pop(key)[0] for key in idle_keys]
+
+    def evict_idle(self):
+        """close sessions of hosts idle for longer than idle_timeout"""
+        with self._lock:
+            evicted = self._pop_idle()
+        for session in evicted:
+            session.close()
+        return len(evicted)
+
+    def stats(self):
+        """return dict of host key => {"in_use": n, "idle_seconds": s}"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                key: {"in_use": in_use, "idle_seconds": round(now - last_used, 3)}
+                for key, (_, in_use, last_used) in self._entries.items()
+            }
+
+    def close(self):
+        """close all sessions in the pool"""
+        with self._lock:
+            sessions = [entry[0] for entry in self._entries.values()]
+            self._entries.clear()
+        for session in sessions:
+            session.close()
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """return the default SessionPool used by request(), post() and ChatAPI when no session is provided."""
+    global _session_pool
+    if _session_pool is None:
+        with _session_pool_lock:
+            if _session_pool is None:
+                _session_pool = SessionPool()
+    return _session_pool
+
+
+class DeadlineExceeded(TimeoutError):
+    """deadline of a deadline() context is exceeded, returned (not raised) by request() and ChatAPI calls"""
+
+
+# absolute time.monotonic() deadline of the current context, None if no deadline
+_deadline = contextvars.ContextVar("pxutil_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """Context of a time budget, which pxutil blocking calls respect: request(), post(), ChatAPI calls, bash() and bashx()
+
+    Each call gets the remaining budget as its timeout, and returns DeadlineExceeded (a TimeoutError) in its
+    usual return style when the budget is used up, e.g. request() returns it, bash() returns returncode 124.
+    A nested deadline can only shorten the outer one. The deadline is a contextvar, so it follows asyncio tasks
+    and is passed to the thread pools of request_many(), arequest() and ChatAPI.chat_many().
+
+    Usage:
+    with px.deadline(5.0):
+        resp = px.request("GET", url)              # timeout is at most 5s
+        answer = px.ChatAPI().chat("hi")           # gets what is left of the 5s
+    """
+    new_deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        new_deadline = min(new_deadline, outer)
+    token = _deadline.set(new_deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """return seconds left of the current deadline() context (0 if exceeded), or None if no deadline"""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return max(current - time.monotonic(), 0.0)
+
+
+def _cap_timeout(timeout, remaining):
+    """return timeout (seconds or (connect, read) tuple or None) capped by remaining seconds of the deadline"""
+    if remaining is None:
+        return timeout
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def _is_unsent_error(ex):
+    """return True if ex of requests is a connection error before the request is sent, e.g. connection refused"""
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(ex.args[0], "reason", None) if ex.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _with_context(func):
+    """return func bound to a copy of the current context, to run it in another thread with the same deadline"""
+    return functools.partial(contextvars.copy_context().run, func)
 
 
 def post(
@@ -266,6 +883,12 @@ def request(
     content_type=None,
     session=None,
     logger=None,
+    stream=False,
+    stream_as="chunks",
+    chunk_size=65536,
+    retry=None,
+    circuit_breaker=None,
+    cache=None,
     **kwargs,
 ):
     """
@@ -279,78 +902,268 @@ def request(
     ---------
     method:         Same as requests.request
     url:            Same as requests.request
-    data:           Same as requests.request
+    data:           Same as requests.request. bytes and memoryview bodies are sent as they are.
     headers:        Same as requests.request
     files:          Same as requests.request
     auth:           Same as requests.request
     verify:         Same as requests.request. False - Disable SSL certificate verification, set to False to test dev server with self-signed certificate.
-    amend_headers:  boolean, Append common headers, e.g. set Content-Type to "application/json" if body is json
+    amend_headers:  boolean, Append common headers, e.g. set Content-Type to "application/json" if body is json.
+                    str body is parsed to check, bytes body is checked by its first character only.
     content_type:   str, set header Content-Type if provided
     session:        requests.Session() instance, send requests in the provided session if set, and will maintain session cookies.
-    logger:         logging instance, e.g., logging.getLogger(), to pretty log API request and response in INFO level (please set proper level in the logger).
+                    Or a SessionPool instance. Default to None, use the default pool get_session_pool() to reuse connections.
+    logger:         logging instance, e.g., logging.getLogger(), to pretty log API request and response in DEBUG level (please set proper level in the logger).
+                    Bodies are truncated to LOG_BODY_MAX_BYTES. Nothing is formatted unless DEBUG is enabled.
                     Default to None, no logging.
+    stream:         boolean, return an iterator of the response body instead of loading it into memory, see stream_as.
+                    The response body is not logged in stream mode.
+    stream_as:      str, what the stream iterator yields:
+                    'chunks' - bytes chunks (default), 'lines' - decoded text lines, 'ndjson' - parsed json object per line.
+    chunk_size:     int, bytes to read from the socket at a time in stream mode.
+    retry:          RetryPolicy instance or int as RetryPolicy(total=retry), to retry connection errors, 429 and 5xx
+                    with exponential backoff and jitter. Default to None, no retry.
+                    Note body of file or generator data can't be sent again.
+    circuit_breaker: CircuitBreaker instance to fail fast while the host is down, usually shared by many calls.
+                    Default to None, no circuit breaker.
+    cache:          ResponseCache instance to cache GET and HEAD responses, see ResponseCache.
+                    Fresh cached responses are returned without a request, stale ones are revalidated.
+                    Default to None, no cache. Not used in stream mode.
     kwargs:         Other arguments requests.request takes.
+                    json=obj is encoded by json_dumps() (orjson or ujson if installed) with Content-Type "application/json".
+                    timeout defaults to REQUEST_TIMEOUT, and is capped by the remaining time of a deadline() context.
+                    Within a deadline() the whole body must arrive in time too, not only each read.
 
     Return: response decoded as dict if possible,
             or decoded text if not json,
             or original bytes if decoding fails (not likely),
             or '' if response has no body,
-            or Exception if any error or response code >=400.
+            or ResponseStream iterator of the body as per stream_as if stream is True, close it if not consumed,
+            or Exception if any error or response code >=400,
+            or DeadlineExceeded if the deadline() context is exceeded.
+
+    Stream usage:
+    events = request("GET", url, stream=True, stream_as="ndjson")
+    if not isinstance(events, Exception):
+        for event in events:
+            print(event)
     """
     # append common headers
-    # deep copy headers to avoid using the same headers object (default {}) in different requests
-    headers_new = copy.deepcopy(headers)
+    # copy headers to avoid using the same headers object (default {}) in different requests
+    headers_new = dict(headers or {})
+    # encode json body with the fast codec instead of requests' stdlib json
+    json_body = kwargs.pop("json", None)
+    if json_body is not None and data is None:
+        data = json_dumps(json_body, as_bytes=True)
+        headers_new.setdefault("Content-Type", "application/json")
+    # requests sends bytes but not memoryview
+    if isinstance(data, memoryview):
+        data = data.tobytes()
     # set content type to json if not set
     if content_type is not None:
         headers_new["Content-Type"] = content_type
     # check if body is json, then set content type to json
     elif amend_headers is True:
-        if data:
+        if isinstance(data, (bytes, bytearray)):
+            if _looks_like_json(data):
+                headers_new["Content-Type"] = "application/json"
+        elif data:
             try:
-                json.loads(data)
-            except (json.JSONDecodeError, TypeError):
+                json_loads(data)
+            except (ValueError, TypeError):
                 pass
             else:
                 headers_new["Content-Type"] = "application/json"
 
     # send request
     try:
-        if session:
+        assert stream_as in _STREAM_AS, f"stream_as must be one of {_STREAM_AS}"
+        if session is not None and not isinstance(session, SessionPool):
             assert isinstance(
                 session, requests.Session
-            ), "Provided session is not requests.Session() instance"
-        else:
-            # create a new session
-            session = requests.Session()
-        resp = session.request(
-            method,
-            url,
-            data=data,
-            headers=headers_new,
-            files=files,
-            auth=auth,
-            verify=verify,
-            **kwargs,
-        )
+            ), "Provided session is not requests.Session() or SessionPool instance"
     except Exception as ex:
         return Exception("request() failed with exception: %s" % str(ex))
+    if isinstance(retry, int):
+        retry = RetryPolicy(total=retry)
+    metrics = request_metrics if request_metrics.enabled else None
+    if metrics is not None:
+        start_time = time.perf_counter()
+
+    # serve fresh response from cache, or revalidate the stale one
+    cache_key = cache_entry = None
+    if cache is not None and not stream and method.upper() in ("GET", "HEAD"):
+        cache_key = cache.key(method, url, kwargs.get("params"), headers_new, auth)
+        cache_entry = cache.get(cache_key)
+        if cache_entry is not None:
+            if cache.is_fresh(cache_entry):
+                if logger:
+                    logger.debug("Cache hit of %s %s", method, url)
+                return _decode_content(cache_entry["content"], cache_entry["encoding"])
+            headers_new.update(cache.validators(cache_entry))
+
+    timeout = kwargs.pop("timeout", REQUEST_TIMEOUT)
+    attempt = 0
+    while True:
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            return DeadlineExceeded(f"request() deadline exceeded before {method} {url}.")
+        if circuit_breaker is not None and not circuit_breaker.allow(url):
+            return Exception(
+                f"request() failed fast as circuit breaker is open for {SessionPool.host_key(url)}."
+            )
+        pool = None
+        try:
+            if session is None or isinstance(session, SessionPool):
+                # reuse keep-alive connections of the host from the pool
+                session_pool = session if session is not None else get_session_pool()
+                req_session = session_pool.acquire(url)
+                pool = session_pool
+            else:
+                req_session = session
+            if metrics is not None:
+                # stream to measure time to first byte and download separately
+                _connect_timer.seconds = 0.0
+                send_time = time.perf_counter()
+            resp = req_session.request(
+                method,
+                url,
+                data=data,
+                headers=headers_new,
+                files=files,
+                auth=auth,
+                verify=verify,
+                # a deadline checks the time between chunks of the body, see _read_content()
+                stream=stream or metrics is not None or remaining is not None,
+                timeout=_cap_timeout(timeout, remaining),
+                **kwargs,
+            )
+            if metrics is not None:
+                headers_time = time.perf_counter()
+            if not stream:
+                if remaining is not None:
+                    _read_content(resp, _deadline.get(), f"{method} {url}")
+                else:
+                    resp.content
+            if metrics is not None:
+                timings = {
+                    "connect": _connect_timer.seconds,
+                    "ttfb": headers_time - send_time,
+                    "download": time.perf_counter() - headers_time,
+                }
+        except Exception as ex:
+            if pool is not None:
+                pool.release(url)
+            is_connection_error = isinstance(
+                ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+            )
+            if circuit_breaker is not None and (
+                is_connection_error or circuit_breaker.state(url) == CircuitBreaker.HALF_OPEN
+            ):
+                # any error of the trial request counts, or the circuit would stay half open
+                circuit_breaker.record_failure(url)
+            if (
+                retry is not None
+                and is_connection_error
+                and retry.is_retry(method, attempt, sent=not _is_unsent_error(ex))
+            ):
+                delay = retry.backoff(attempt)
+                if _within_deadline(delay):
+                    _sleep_before_retry(delay, attempt, url, ex, logger)
+                    attempt += 1
+                    continue
+            if metrics is not None:
+                metrics.record(
+                    url, method, "error", 0, {"total": time.perf_counter() - start_time}
+                )
+            if isinstance(ex, DeadlineExceeded):
+                return ex
+            if remaining is not None and isinstance(ex, requests.exceptions.Timeout) and not remaining_time():
+                return DeadlineExceeded(f"request() deadline exceeded in {method} {url}: {ex}")
+            return Exception("request() failed with exception: %s" % str(ex))
+
+        if circuit_breaker is not None:
+            if resp.status_code >= 500:
+                circuit_breaker.record_failure(url)
+            else:
+                circuit_breaker.record_success(url)
+        if retry is not None and retry.is_retry(method, attempt, resp.status_code):
+            delay = retry.backoff(attempt, resp.headers.get("Retry-After"))
+            # no retry if the deadline is before it, return the error response
+            if _within_deadline(delay):
+                resp.close()
+                if pool is not None:
+                    pool.release(url)
+                _sleep_before_retry(
+                    delay, attempt, url, f"response code {resp.status_code}", logger
+                )
+                attempt += 1
+                continue
+        break
 
-    if logger:
+    if logger and logger.isEnabledFor(logging.DEBUG):
         # pretty request and response into API log file
         pretty_print_request_json(resp.request, logger)
-        pretty_print_response_json(resp, logger)
+        pretty_print_response_json(resp, logger, stream=stream)
+
+    if cache_key is not None and cache_entry is not None and resp.status_code == 304:
+        cache_entry = cache.refresh(cache_key, cache_entry, resp)
+        resp.close()
+        if pool is not None:
+            pool.release(url)
+        if metrics is not None:
+            timings["total"] = time.perf_counter() - start_time
+            metrics.record(url, method, 304, 0, timings)
+        return _decode_content(cache_entry["content"], cache_entry["encoding"])
 
     if resp.status_code >= 400:
         error = f"API call to {url} failed with response code {resp.status_code}."
         if resp.text and len(resp.text) > 0:
             error = error + f"body:\n{pretty_json(resp.text)}"
+        resp.close()
+        if pool is not None:
+            pool.release(url)
+        if metrics is not None:
+            timings["total"] = time.perf_counter() - start_time
+            metrics.record(url, method, resp.status_code, len(resp.content), timings)
         return Exception(error)
 
+    if stream:
+        if metrics is not None:
+            # body is not read yet in stream mode
+            del timings["download"]
+            timings["total"] = time.perf_counter() - start_time
+            metrics.record(url, method, resp.status_code, 0, timings)
+        # the iterator holds the pooled session until the body is consumed or the iterator is closed
+        on_close = (lambda: pool.release(url)) if pool is not None else None
+        return ResponseStream(resp, stream_as, chunk_size, on_close)
+
+    if pool is not None:
+        pool.release(url)
+
+    if metrics is not None:
+        decode_time = time.perf_counter()
+    result = _decode_response(resp)
+    if metrics is not None:
+        end_time = time.perf_counter()
+        timings["decode"] = end_time - decode_time
+        timings["total"] = end_time - start_time
+        metrics.record(url, method, resp.status_code, len(resp.content), timings)
+    if cache_key is not None and resp.status_code == 200:
+        # save the text encoding detected for non-json body
+        encoding = resp.encoding
+        if encoding is None and isinstance(result, str) and result:
+            encoding = resp.apparent_encoding
+        cache.store(cache_key, resp, encoding)
+    return result
+
+
+def _decode_response(resp):
+    """return response body decoded as described in request()"""
     if resp.content:
         # return json if possible
         try:
-            return resp.json()
-        except requests.exceptions.JSONDecodeError:
+            return json_loads(resp.content)
+        except ValueError:
             try:
                 # It returns string 'A\x11\x12B' for b'\x41\x11\x12\x42' - ascii binary data with unprintable characters (\x11\x12)
                 #   NB: print('A\x11\x12B') prints 'AB' in terminal as \x11\x12 are unprintable characters, but will write A^Q^RB to file.
@@ -363,7 +1176,869 @@ def request(
         return ""
 
 
-def bash(cmd: str, encoding=None):
+def _read_content(resp, deadline_at, what="request"):
+    """read the body of a stream=True response as resp.content, raise DeadlineExceeded if it is not read by deadline_at
+
+    The read timeout only caps each socket read, so a body trickling in would run past the deadline
+    if it were not checked between chunks.
+    """
+    read1 = getattr(resp.raw, "read1", None)
+    if read1 is not None:
+        # urllib3 2: return the bytes available instead of blocking until a whole chunk arrives
+        chunks = iter(lambda: read1(1 << 16, decode_content=True), b"")
+    else:
+        chunks = resp.iter_content(chunk_size=1024)
+    content = []
+    for chunk in chunks:
+        content.append(chunk)
+        if time.monotonic() >= deadline_at:
+            resp.close()
+            raise DeadlineExceeded(f"request() deadline exceeded reading the body of {what}.")
+    resp._content = b"".join(content)
+    resp._content_consumed = True
+
+
+def _within_deadline(delay):
+    """return True if there is time left for a retry after delay seconds"""
+    remaining = remaining_time()
+    return remaining is None or delay < remaining
+
+
+def _sleep_before_retry(delay, attempt, url, reason, logger=None):
+    if logger:
+        logger.debug(
+            "Retry #%d of %s in %.2f seconds after %s", attempt + 1, url, delay, reason
+        )
+    time.sleep(delay)
+
+
+class RetryPolicy:
+    """Retry policy of request() for connection errors and response codes like 429 and 5xx
+
+    Params
+    ------
+    total:              max number of retries, i.e., up to total + 1 attempts.
+    backoff_factor:     seconds, delay of retry n (from 0) is backoff_factor * 2**n, capped by backoff_max.
+    backoff_max:        seconds, max delay between retries, also cap of Retry-After.
+    jitter:             randomize delay in [0, delay] (full jitter) to avoid synchronized retries of many callers.
+    status_forcelist:   response codes to retry.
+    methods:            methods to retry, default to IDEMPOTENT_METHODS, None for all methods. Other methods like
+                        POST and PATCH are retried only on connection errors before the request is sent,
+                        e.g., connection refused, as a retry after that may apply it twice.
+    retry_connection_errors: retry connection errors and timeouts.
+    respect_retry_after: use delay of Retry-After response header if present.
+
+    Usage:
+    px.request("GET", url, retry=RetryPolicy(total=5, backoff_factor=1))
+    """
+
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+    def __init__(
+        self,
+        total=3,
+        backoff_factor=0.5,
+        backoff_max=30.0,
+        jitter=True,
+        status_forcelist=(429, 500, 502, 503, 504),
+        methods=IDEMPOTENT_METHODS,
+        retry_connection_errors=True,
+        respect_retry_after=True,
+    ):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.status_forcelist = status_forcelist
+        self.methods = methods
+        self.retry_connection_errors = retry_connection_errors
+        self.respect_retry_after = respect_retry_after
+
+    def is_retry(self, method, attempt, status_code=None, sent=True):
+        """return True to retry after attempt n (from 0), of connection error if status_code is None.
+
+        sent: False if the connection error is before the request is sent, safe to retry with any method.
+        """
+        if attempt >= self.total:
+            return False
+        if self.methods is not None and method.upper() not in self.methods and (sent or status_code is not None):
+            return False
+        if status_code is None:
+            return self.retry_connection_errors
+        return status_code in self.status_forcelist
+
+    def backoff(self, attempt, retry_after=None):
+        """return seconds to wait before retry after attempt n (from 0)
+
+        retry_after: value of Retry-After response header, in seconds or HTTP date.
+        """
+        if self.respect_retry_after and retry_after:
+            seconds = self.parse_retry_after(retry_after)
+            if seconds is not None:
+                return min(seconds, self.backoff_max)
+        delay = min(self.backoff_factor * 2**attempt, self.backoff_max)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        """return seconds of Retry-After header value, e.g., '120' or 'Wed, 21 Oct 2015 07:28:00 GMT', or None if invalid."""
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker for request() to fail fast while a host is down
+
+    States per host (scheme://host:port):
+    closed:     normal, requests are sent.
+    open:       after failure_threshold consecutive failures (connection errors or 5xx),
+                requests fail fast without being sent for reset_timeout seconds.
+    half_open:  after reset_timeout, one trial request is sent. Success closes the circuit, failure (any exception)
+                opens it again. If the trial is never recorded, another one is sent after reset_timeout.
+
+    Params
+    ------
+    failure_threshold:  number of consecutive failures to open the circuit.
+    reset_timeout:      seconds to wait in open state before a trial request.
+
+    Usage:
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    px.request("GET", url, circuit_breaker=breaker)
+    print(breaker.state(url), breaker.stats())
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        # host key => [state, consecutive failures, opened time, total failures, total fast fails]
+        self._hosts = {}
+
+    def _entry(self, url):
+        key = SessionPool.host_key(url)
+        entry = self._hosts.get(key)
+        if entry is None:
+            entry = self._hosts[key] = [self.CLOSED, 0, 0.0, 0, 0]
+        return entry
+
+    def allow(self, url):
+        """return True if a request to url may be sent"""
+        with self._lock:
+            entry = self._entry(url)
+            if entry[0] == self.CLOSED:
+                return True
+            if (
+                entry[0] in (self.OPEN, self.HALF_OPEN)
+                and time.monotonic() - entry[2] >= self.reset_timeout
+            ):
+                # let one trial request through, another one if the last trial is lost without a result
+                entry[0] = self.HALF_OPEN
+                entry[2] = time.monotonic()
+                return True
+            entry[4] += 1
+            return False
+
+    def record_success(self, url):
+        with self._lock:
+            entry = self._entry(url)
+            entry[0] = self.CLOSED
+            entry[1] = 0
+
+    def record_failure(self, url):
+        with self._lock:
+            entry = self._entry(url)
+            entry[1] += 1
+            entry[3] += 1
+            if entry[0] == self.HALF_OPEN or entry[1] >= self.failure_threshold:
+                entry[0] = self.OPEN
+                entry[2] = time.monotonic()
+
+    def state(self, url):
+        """return state of url host: closed, open or half_open"""
+        with self._lock:
+            entry = self._hosts.get(SessionPool.host_key(url))
+            return entry[0] if entry else self.CLOSED
+
+    def stats(self):
+        """return dict of host key => {"state", "consecutive_failures", "failures", "fast_fails"}"""
+        with self._lock:
+            return {
+                key: {
+                    "state": state,
+                    "consecutive_failures": failures,
+                    "failures": total_failures,
+                    "fast_fails": fast_fails,
+                }
+                for key, (state, failures, _, total_failures, fast_fails) in self._hosts.items()
+            }
+
+    def reset(self, url=None):
+        """close the circuit of url host, or of all hosts if url is None"""
+        with self._lock:
+            if url is None:
+                self._hosts.clear()
+            else:
+                self._hosts.pop(SessionPool.host_key(url), None)
+
+
+class _LRUCache:
+    """Thread-safe in-memory LRU cache of max_entries"""
+
+    def __init__(self, max_entries=256):
+        from collections import OrderedDict
+
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _DiskStore:
+    """On-disk bytes store, one file per key named by sha256 of the key, capped to max_bytes
+
+    Writes are atomic (temp file + rename). When the store exceeds max_bytes, the least recently used files
+    (by mtime, touched on read) are removed until it is under 90% of max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=100 * 1024 * 1024):
+        self.cache_dir = normal_path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # total bytes of files, scanned on first write
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        import hashlib
+
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return osp.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, key):
+        """return bytes of key or None"""
+        file = self._path(key)
+        try:
+            with open(file, "rb") as f:
+                value = f.read()
+            os.utime(file)
+            return value
+        except OSError:
+            return None
+
+    def set(self, key, value: bytes):
+        file = self._path(key)
+        os.makedirs(osp.dirname(file), exist_ok=True)
+        tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            old_size = osp.getsize(file)
+        except OSError:
+            old_size = 0
+        with open(tmp_file, "wb") as f:
+            f.write(value)
+        os.replace(tmp_file, file)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(value) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _files(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if not file.endswith(".tmp"):
+                    yield osp.join(root, file)
+
+    def _scan_size(self):
+        size = 0
+        for file in self._files():
+            try:
+                size += osp.getsize(file)
+            except OSError:
+                pass
+        return size
+
+    def _evict(self):
+        """remove least recently used files until under 90% of max_bytes. Call with self._lock held."""
+        stats = []
+        for file in self._files():
+            try:
+                st = os.stat(file)
+            except OSError:
+                continue
+            stats.append((st.st_mtime, st.st_size, file))
+        stats.sort()
+        size = sum(st[1] for st in stats)
+        for _, file_size, file in stats:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(file)
+                size -= file_size
+            except OSError:
+                pass
+        self._size = size
+
+    def clear(self):
+        import shutil
+
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._size = 0
+
+
+def _parse_cache_control(value):
+    """return dict of Cache-Control directives, e.g., 'max-age=60, no-cache' => {'max-age': '60', 'no-cache': ''}"""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('" ')
+    return directives
+
+
+class ResponseCache:
+    """HTTP response cache of request() for GET and HEAD with an in-memory LRU tier and an optional on-disk tier
+
+    It respects Cache-Control (no-store, no-cache, max-age), Expires and Age response headers,
+    and revalidates stale responses with If-None-Match (ETag) / If-Modified-Since (Last-Modified).
+    A 304 response is served from the cached body. Only 200 responses are cached.
+
+    Params
+    ------
+    max_entries:    max number of responses in memory.
+    cache_dir:      directory of the on-disk tier, shared by processes. Default to None, memory only.
+    max_disk_bytes: max bytes of the on-disk tier.
+    default_max_age: seconds to consider a response fresh if it has no max-age or Expires header,
+                    default to 0, i.e., revalidate every time.
+
+    Usage:
+    cache = ResponseCache(cache_dir="~/.cache/pxutil/http")
+    px.request("GET", url, cache=cache)
+    print(cache.stats())
+    """
+
+    def __init__(
+        self,
+        max_entries=256,
+        cache_dir=None,
+        max_disk_bytes=100 * 1024 * 1024,
+        default_max_age=0,
+    ):
+        self.default_max_age = default_max_age
+        self._memory = _LRUCache(max_entries)
+        self._disk = _DiskStore(cache_dir, max_disk_bytes) if cache_dir else None
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0}
+
+    @staticmethod
+    def key(method, url, params=None, headers=None, auth=None):
+        """return cache key of a request, which varies on url with params, headers and auth"""
+        if params:
+            prepared = requests.PreparedRequest()
+            prepared.prepare_url(url, params)
+            url = prepared.url
+        key = f"{method.upper()} {url}"
+        if headers:
+            key += "\n" + "\n".join(f"{k.lower()}: {v}" for k, v in sorted(headers.items()))
+        if auth is not None:
+            key += f"\nauth: {auth!r}"
+        return key
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        """return cached entry dict of key or None"""
+        entry = self._memory.get(key)
+        if entry is None and self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                meta, _, content = value.partition(b"\n")
+                try:
+                    entry = json_loads(meta)
+                except ValueError:
+                    entry = None
+                else:
+                    entry["content"] = content
+                    self._memory.set(key, entry)
+        self._count("misses" if entry is None else "hits")
+        return entry
+
+    @staticmethod
+    def is_fresh(entry):
+        return time.time() < entry["expires_at"]
+
+    @staticmethod
+    def validators(entry):
+        """return headers to revalidate the entry, i.e., If-None-Match and If-Modified-Since"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _expires_at(self, headers, now):
+        """return expiry time of a response by its headers, or None if it must not be stored"""
+        from email.utils import parsedate_to_datetime
+
+        cache_control = _parse_cache_control(headers.get("Cache-Control"))
+        if "no-store" in cache_control:
+            return None
+        if "no-cache" in cache_control:
+            return now
+        age = 0.0
+        try:
+            age = float(headers.get("Age", 0))
+        except ValueError:
+            pass
+        if cache_control.get("max-age", "").isdigit():
+            return now + int(cache_control["max-age"]) - age
+        if headers.get("Expires"):
+            try:
+                expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+                date = parsedate_to_datetime(headers["Date"]).timestamp() if headers.get("Date") else now
+                return now + expires - date - age
+            except (TypeError, ValueError):
+                # invalid Expires means already expired
+                return now
+        return now + self.default_max_age
+
+    def store(self, key, resp, encoding=None):
+        """store a 200 response if it is cacheable
+
+        encoding: text encoding of the body, default to resp.encoding
+        """
+        now = time.time()
+        expires_at = self._expires_at(resp.headers, now)
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if expires_at is None or (expires_at <= now and not etag and not last_modified):
+            # no-store, or stale right away without validators
+            return
+        entry = {
+            "url": resp.url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "encoding": encoding or resp.encoding,
+            "expires_at": expires_at,
+            "content": resp.content,
+        }
+        self._set(key, entry)
+        self._count("stored")
+
+    def refresh(self, key, entry, resp):
+        """refresh entry with a 304 Not Modified response and return it"""
+        now = time.time()
+        expires_at = self._expires_at(resp.headers, now)
+        if expires_at is None:
+            self.delete(key)
+            return entry
+        entry = dict(entry, expires_at=expires_at)
+        entry["etag"] = resp.headers.get("ETag") or entry.get("etag")
+        entry["last_modified"] = resp.headers.get("Last-Modified") or entry.get("last_modified")
+        self._set(key, entry)
+        self._count("revalidated")
+        return entry
+
+    def _set(self, key, entry):
+        self._memory.set(key, entry)
+        if self._disk is not None:
+            meta = {k: v for k, v in entry.items() if k != "content"}
+            self._disk.set(key, json_dumps(meta, as_bytes=True) + b"\n" + entry["content"])
+
+    def delete(self, key):
+        self._memory.pop(key)
+        if self._disk is not None:
+            self._disk.delete(key)
+
+    def clear(self):
+        self._memory.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self):
+        """return dict of hits, misses, revalidated (304) and stored counts and entries in memory"""
+        with self._stats_lock:
+            return dict(self._stats, memory_entries=len(self._memory))
+
+
+def _decode_content(content, encoding=None):
+    """decode cached response body like request(): json if possible, otherwise text, or '' if empty"""
+    if not content:
+        return ""
+    try:
+        return json_loads(content)
+    except ValueError:
+        return str(content, encoding or "utf-8", errors="replace")
+
+
+_STREAM_AS = ("chunks", "lines", "ndjson")
+
+
+def _iter_stream(resp, stream_as, chunk_size):
+    """yield response body by chunks, lines or ndjson objects with flat memory usage, see request(stream=True)."""
+    if stream_as == "chunks":
+        yield from resp.iter_content(chunk_size=chunk_size)
+        return
+
+    # split lines on bytes to handle \r\n across chunks and decode each line.
+    # server-sent events are always utf-8, and text without charset is more likely utf-8 than ISO-8859-1,
+    # which requests assumes for text/* without charset. json.loads() detects the encoding of ndjson itself.
+    content_type = resp.headers.get("Content-Type", "").lower()
+    if "charset" in content_type and "text/event-stream" not in content_type:
+        encoding = resp.encoding or "utf-8"
+    else:
+        encoding = "utf-8"
+    buffer = b""
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if stream_as == "lines":
+                yield line.decode(encoding, errors="replace")
+            elif line.strip():
+                yield json.loads(line)
+    if buffer:
+        if stream_as == "lines":
+            yield buffer.rstrip(b"\r").decode(encoding, errors="replace")
+        elif buffer.strip():
+            yield json.loads(buffer)
+
+
+def _close_response(resp, on_close):
+    resp.close()
+    if on_close is not None:
+        on_close()
+
+
+class ResponseStream:
+    """Iterator of a streamed response body returned by request(stream=True), see _iter_stream()
+
+    The response is closed and on_close, e.g. to release the pooled session, is called once when the body
+    is consumed, an error is raised, close() is called, the with statement exits, or the iterator is
+    garbage collected, so an iterator never started or dropped half way doesn't hold the connection.
+    Past the deadline() of the request, the next item raises DeadlineExceeded.
+
+    Usage:
+    with request("GET", url, stream=True, stream_as="lines") as lines:
+        for line in lines:
+            ...
+    """
+
+    def __init__(self, resp, stream_as="chunks", chunk_size=1024, on_close=None):
+        self._iterator = _iter_stream(resp, stream_as, chunk_size)
+        # deadline() context of the request, checked between items as the read timeout caps each read only
+        self._deadline = _deadline.get()
+        # the finalizer doesn't refer to self, so it runs when self is garbage collected
+        self._finalizer = weakref.finalize(self, _close_response, resp, on_close)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                raise DeadlineExceeded("deadline exceeded reading the response stream.")
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """close the response and release its connection, the rest of the body is not read"""
+        self._finalizer()
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_async_executor = None
+_async_executor_lock = threading.Lock()
+# event loop => default semaphore of arequest()
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_async_executor():
+    """return the shared thread pool running request() calls for arequest()"""
+    global _async_executor
+    if _async_executor is None:
+        with _async_executor_lock:
+            if _async_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                _async_executor = ThreadPoolExecutor(
+                    max_workers=ASYNC_MAX_THREADS, thread_name_prefix="pxutil-async"
+                )
+    return _async_executor
+
+
+async def apost(url, *, semaphore=None, **kwargs):
+    """shorthand for await arequest('POST', ...)"""
+    return await arequest("POST", url, semaphore=semaphore, **kwargs)
+
+
+async def arequest(method: str, url: str, *, semaphore=None, **kwargs):
+    """asyncio version of request() with bounded concurrency
+
+    It runs request() in a shared thread pool, so it reuses the same pooled keep-alive sessions (one client)
+    and keeps the same contract as request(), including logger pretty logging.
+
+    Arguments
+    ---------
+    method, url:    Same as request()
+    semaphore:      asyncio.Semaphore to limit concurrent calls, e.g., shared by a group of calls.
+                    Default to None, use a default semaphore of the running event loop with ASYNC_REQUEST_LIMIT.
+                    Calls beyond ASYNC_MAX_THREADS in total wait for a thread of the shared pool, whatever the
+                    semaphore, so raise it before the first call for a higher concurrency.
+    kwargs:         Other arguments request() takes, e.g., data, headers, session, logger, timeout.
+
+    Return: same as request(), i.e., decoded dict, text or '' on success, or Exception if any error.
+
+    Usage:
+    async def main():
+        sem = asyncio.Semaphore(100)
+        return await asyncio.gather(*(px.arequest("GET", url, semaphore=sem) for url in urls))
+    results = asyncio.run(main())
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        semaphore = _async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _async_semaphores[loop] = asyncio.Semaphore(ASYNC_REQUEST_LIMIT)
+    async with semaphore:
+        # run in the task's context, e.g. with its deadline()
+        return await loop.run_in_executor(
+            _get_async_executor(), _with_context(functools.partial(request, method, url, **kwargs))
+        )
+
+
+def _imap_threads(func, items, max_workers=8, ordered=True):
+    """run func(item) for items on a thread pool and yield (index, result)
+
+    items:      iterable, consumed lazily with at most max_workers * 2 calls pending.
+    ordered:    yield in input order if True, otherwise as completed.
+    Calls run in a copy of the caller's context, e.g. with its deadline().
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    max_pending = max_workers * 2
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pxutil")
+    try:
+        if ordered:
+            pending = deque()
+            for index, item in enumerate(items):
+                pending.append((index, executor.submit(_with_context(func), item)))
+                if len(pending) >= max_pending:
+                    index, future = pending.popleft()
+                    yield index, future.result()
+            while pending:
+                index, future = pending.popleft()
+                yield index, future.result()
+        else:
+            pending = {}  # future => index
+            for index, item in enumerate(items):
+                pending[executor.submit(_with_context(func), item)] = index
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+    finally:
+        # don't run queued calls if the caller stops early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def request_many(
+    specs,
+    *,
+    max_workers=16,
+    max_per_host=4,
+    ordered=True,
+    timeout=None,
+    session=None,
+    logger=None,
+):
+    """run many request() calls on a thread pool with a per-host concurrency limit
+
+    Arguments
+    ---------
+    specs:          list of request specs, each one of:
+                    - url string for GET
+                    - (method, url) tuple
+                    - dict of request() arguments, e.g., {"method": "POST", "url": url, "data": "{}", "timeout": 5}
+    max_workers:    max number of concurrent calls in total
+    max_per_host:   max number of concurrent calls to the same host (scheme://host:port)
+    ordered:        True to return a list of results in input order,
+                    False to return a generator of (index, result) as they complete.
+    timeout:        default timeout in seconds of each request if not set in its spec
+    session:        requests.Session or SessionPool shared by all requests.
+                    Default to None, use a new SessionPool of max_per_host connections per host for this batch.
+    logger:         default logger of each request if not set in its spec, same as request().
+
+    Return: list of request() results, i.e., decoded dict, text, '' or Exception per spec,
+            or generator of (index, result) if ordered is False.
+
+    Usage:
+    results = px.request_many(["https://httpbin.org/get", ("POST", "https://httpbin.org/post")], timeout=10)
+    for i, result in px.request_many(specs, ordered=False):
+        print(i, result)
+    """
+    own_pool = session is None
+    if own_pool:
+        session = SessionPool(max_per_host=max_per_host)
+    host_semaphores = {}
+    host_semaphores_lock = threading.Lock()
+
+    def run_one(spec):
+        try:
+            if isinstance(spec, str):
+                method, url, kwargs = "GET", spec, {}
+            elif isinstance(spec, dict):
+                kwargs = dict(spec)
+                method = kwargs.pop("method", "GET")
+                url = kwargs.pop("url")
+            else:
+                method, url = spec
+                kwargs = {}
+            kwargs.setdefault("session", session)
+            kwargs.setdefault("logger", logger)
+            if timeout is not None:
+                kwargs.setdefault("timeout", timeout)
+            key = SessionPool.host_key(url)
+            with host_semaphores_lock:
+                semaphore = host_semaphores.get(key)
+                if semaphore is None:
+                    semaphore = host_semaphores[key] = threading.Semaphore(max_per_host)
+        except Exception as ex:
+            return Exception(f"request_many() got invalid request spec {spec!r}: {ex}")
+        with semaphore:
+            return request(method, url, **kwargs)
+
+    def run_all():
+        try:
+            yield from _imap_threads(run_one, specs, max_workers, ordered)
+        finally:
+            if own_pool:
+                session.close()
+
+    if ordered:
+        return [result for _, result in run_all()]
+    return run_all()
+
+
+def _run_shell(cmd, timeout=None, **kwargs):
+    """subprocess.run(cmd, shell=True) with timeout capped by deadline() context
+
+    On timeout, the whole process group of the shell is killed, as killing the shell only leaves its children
+    running and holding the output pipes, and it returns CompletedProcess with returncode 124 like timeout(1).
+    The own process group is not in the foreground of the terminal, so Ctrl+C (KeyboardInterrupt) is forwarded
+    to it as SIGINT, and the group is killed if the shell has not exited in 0.25 seconds, like subprocess.run().
+    """
+    from subprocess import run, Popen, CompletedProcess, TimeoutExpired
+    import signal
+
+    timeout = _cap_timeout(timeout, remaining_time())
+    if timeout is None:
+        return run(cmd, shell=True, **kwargs)
+
+    def signal_group(sig):
+        try:
+            os.killpg(process.pid, sig)
+        except (AttributeError, ProcessLookupError):
+            # no process groups on Windows
+            process.kill()
+
+    # own process group to kill it with its children
+    with Popen(cmd, shell=True, start_new_session=True, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except KeyboardInterrupt:
+            signal_group(signal.SIGINT)
+            try:
+                process.wait(timeout=0.25)
+            except TimeoutExpired:
+                signal_group(signal.SIGKILL)
+            raise
+        except TimeoutExpired:
+            signal_group(signal.SIGKILL)
+            stdout, stderr = process.communicate()
+            message = f"Command timed out after {timeout:.1f} seconds: {cmd}"
+            if isinstance(stderr, str):
+                stderr += message + "\n"
+            elif stderr is None:
+                print(message, file=sys.stderr)
+            return CompletedProcess(cmd, 124, stdout, stderr)
+        return CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def bash(cmd: str, encoding=None, timeout=None):
     """
     subprocess.run with intuitive options to execute system commands just like shell bash command.
 
@@ -371,7 +2046,10 @@ def bash(cmd: str, encoding=None):
 
     cmd: command in a string, e.g. 'ls -l'
     encoding: encoding to decode output, e.g. 'utf-8'. Auto detected if None.
+    timeout: seconds, kill the command and its children if it runs longer. Default to None, no timeout,
+        but capped by the remaining time of a deadline() context.
     return: CompletedProcess object in text (decode as locale encoding), with attributes stdout, stderr and returncode.
+        returncode is 124 if it times out, like timeout(1) command.
 
     Usage example:
     ret = bash('ls')
@@ -384,7 +2062,7 @@ def bash(cmd: str, encoding=None):
     import locale
 
     if sys.version_info >= (3, 7):
-        return run(cmd, shell=True, capture_output=True, text=True, encoding=encoding)
+        return _run_shell(cmd, timeout, stdout=PIPE, stderr=PIPE, text=True, encoding=encoding)
 
     elif sys.version_info >= (3, 5):
         if encoding is None:
@@ -399,7 +2077,7 @@ def bash(cmd: str, encoding=None):
         raise Exception("Require python 3.5 or above.")
 
 
-def bashx(cmd, x=True, e=False):
+def bashx(cmd, x=True, e=False, timeout=None):
     """
     run system cmd like bash -x
 
@@ -411,10 +2089,12 @@ def bashx(cmd, x=True, e=False):
     cmd: string - command to run
     x:  When True, print the command with prefix + like shell 'bash -x' before running it
     e:  When True, exit the python program when returncode is not 0, like shell 'bash -e'.
+    timeout: seconds, kill the command and its children if it runs longer. Default to None, no timeout,
+        but capped by the remaining time of a deadline() context.
 
     return
     ------
-    CompletedProcess object with only returncode.
+    CompletedProcess object with only returncode, 124 if it times out.
 
     Shell environment variables
     ---------------------------
@@ -428,7 +2108,6 @@ def bashx(cmd, x=True, e=False):
 
     Warning of using shell=True: https://docs.python.org/3/library/subprocess.html#security-considerations
     """
-    from subprocess import run  # CompletedProcess
     import sys
     import os
 
@@ -455,7 +2134,7 @@ def bashx(cmd, x=True, e=False):
         if x:
             print("+ %s" % cmd)
 
-        ret = run(cmd, shell=True)
+        ret = _run_shell(cmd, timeout)
 
         if e and ret.returncode != 0:
             print(
@@ -708,6 +2387,582 @@ def import_any(path: str):
         return module
 
 
+class ChatSessionLog:
+    """Persistent chat history of a named session, in an append-only JSONL log with an offset index,
+    so a chat can be resumed after restart, e.g. px.chat --session ops
+
+    Files
+    -----
+    <session_dir>/<name>.jsonl: one message per line, e.g. {"ts": 1700000000.0, "role": "user", "content": "hi"}
+    <session_dir>/<name>.idx:   byte offset of each line in the log, 8-byte unsigned ints,
+                                so resume reads the last n messages only instead of parsing the whole log.
+
+    Writes are crash safe: a turn (question and answer) is appended in one write (fsync'ed if fsync),
+    then its offsets are appended to the index. On open, a torn last line of the log is cut off
+    and the index is rebuilt from the log where it lags behind or is ahead.
+
+    Params
+    ------
+    name:           session name, letters, digits, '_', '-' and '.' only.
+    session_dir:    directory of session files. Default to None, ~/.pxutil/chat_sessions.
+    fsync:          fsync the log after each append, so an answer shown is not lost on power loss.
+
+    Usage:
+    chat = ChatAPI(history_log=ChatSessionLog("ops"))  # resumes the last max_chat_history chats of session ops
+    """
+
+    def __init__(self, name, session_dir=None, fsync=True):
+        if not re.fullmatch(r"[\w.-]+", name) or name.startswith("."):
+            raise ValueError(f"invalid session name: {name!r}")
+        self.name = name
+        self.session_dir = osp.expanduser(session_dir or osp.join("~", ".pxutil", "chat_sessions"))
+        self.path = osp.join(self.session_dir, name + ".jsonl")
+        self.index_path = osp.join(self.session_dir, name + ".idx")
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._count = self._recover()
+
+    def _recover(self):
+        """repair log and index after a crash, return number of messages"""
+        from array import array
+
+        with open(self.path, "ab+") as log:
+            log_size = log.seek(0, os.SEEK_END)
+            log.seek(max(log_size - 1, 0))
+            if log_size and log.read(1) != b"\n":
+                # cut off a torn last line after its last newline, i.e. the log must end with a newline
+                end = log_size
+                while end > 0:
+                    size = min(end, 65536)
+                    log.seek(end - size)
+                    cut = log.read(size).rfind(b"\n")
+                    if cut >= 0:
+                        end = end - size + cut + 1
+                        break
+                    end -= size
+                log_size = end
+                log.truncate(log_size)
+
+            offsets = array("Q")
+            if osp.exists(self.index_path):
+                with open(self.index_path, "rb") as f:
+                    data = f.read()
+                # drop a torn last entry and entries beyond the log
+                offsets.frombytes(data[: len(data) - len(data) % offsets.itemsize])
+                while offsets and offsets[-1] >= log_size:
+                    offsets.pop()
+            # index lines appended to the log after the last indexed line
+            start = offsets[-1] if offsets else 0
+            log.seek(start)
+            position = start
+            for i, line in enumerate(log):
+                if i > 0 or not offsets:
+                    offsets.append(position)
+                position += len(line)
+        with open(self.index_path, "wb") as f:
+            offsets.tofile(f)
+        return len(offsets)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, messages):
+        """append messages, e.g. a question and its answer, to the log in one write"""
+        from array import array
+
+        now = time.time()
+        lines = [json_dumps({"ts": now, **message}, as_bytes=True) + b"\n" for message in messages]
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                offset = os.lseek(fd, 0, os.SEEK_END)
+                os.write(fd, b"".join(lines))
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            offsets = array("Q")
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            with open(self.index_path, "ab") as f:
+                offsets.tofile(f)
+            self._count += len(lines)
+
+    def tail(self, n):
+        """return the last n messages, without ts, read from the offset index"""
+        from array import array
+
+        if n <= 0:
+            return []
+        with self._lock:
+            count = self._count
+            if not count:
+                return []
+            first = max(count - n, 0)
+            offsets = array("Q")
+            with open(self.index_path, "rb") as f:
+                f.seek(first * offsets.itemsize)
+                offsets.frombytes(f.read(offsets.itemsize))
+            with open(self.path, "rb") as log:
+                log.seek(offsets[0])
+                data = log.read()
+        messages = []
+        for line in data.splitlines()[: count - first]:
+            record = json_loads(line)
+            record.pop("ts", None)
+            messages.append(record)
+        return messages
+
+    def __iter__(self):
+        """iterate all messages with ts"""
+        with open(self.path, "rb") as log:
+            for line in log:
+                yield json_loads(line)
+
+
+class _RateBucket:
+    """token bucket of a per-minute limit, refilled continuously at limit / 60 per second
+
+    level can go below 0 by reservations, a reservation waits until the level is back to 0.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit  # None if unknown, no limit
+        self.level = float(limit or 0)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.limit:
+            self.level = min(float(self.limit), self.level + (now - self.updated) * self.limit / 60.0)
+        self.updated = now
+
+    def reserve(self, amount):
+        """take amount and return seconds to wait until it is available"""
+        if not self.limit:
+            return 0.0
+        # a single call larger than the bucket waits for a full bucket only
+        self.level -= min(amount, self.limit)
+        return max(-self.level * 60.0 / self.limit, 0.0)
+
+    def refund(self, amount):
+        """give back amount of a reservation"""
+        if self.limit:
+            self.level += min(amount, self.limit)
+
+
+class ChatRateLimiter:
+    """Rate limit aware scheduler of chat API calls, shared by all ChatAPI instances by default
+
+    It budgets both requests/min and tokens/min per (API host, model) with token buckets,
+    so concurrent callers queue before sending instead of failing with 429 Too Many Requests in bursts.
+
+    - Limits are learned from x-ratelimit-limit-* and x-ratelimit-remaining-* response headers of
+      OpenAI and X.AI, or set by rpm and tpm before any response.
+    - Tokens of a call are estimated before sending (by token_counter) and settled with the usage in the response.
+    - 429 responses block new calls to the key until x-ratelimit-reset-* or Retry-After,
+      and ChatAPI retries them after the delay suggested by the server.
+
+    Params
+    ------
+    rpm:    default requests/min limit per key until it is read from response headers, None for unknown.
+    tpm:    default tokens/min limit per key until it is read from response headers, None for unknown.
+
+    Usage:
+    chat = ChatAPI()  # uses the shared chat_rate_limiter
+    chat = ChatAPI(rate_limiter=ChatRateLimiter(rpm=500, tpm=200000))
+    chat_rate_limiter.stats()
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        # key => {"requests": _RateBucket, "tokens": _RateBucket, "blocked_until": monotonic, "waits", "wait_time", "throttled"}
+        self._keys = {}
+
+    @staticmethod
+    def key(url, model):
+        return f"{urlsplit(url).netloc}/{model}"
+
+    def _entry(self, key):
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = {
+                "requests": _RateBucket(self.rpm),
+                "tokens": _RateBucket(self.tpm),
+                "blocked_until": 0.0,
+                "waits": 0,
+                "wait_time": 0.0,
+                "throttled": 0,
+            }
+        return entry
+
+    def tracks_tokens(self, key):
+        """return True if tokens/min of key is limited, i.e. worth estimating tokens of a call"""
+        with self._lock:
+            return bool(self._entry(key)["tokens"].limit)
+
+    def acquire(self, key, tokens=0):
+        """reserve a request and tokens of key, and wait until they are available
+
+        Reservations are taken in arrival order, so waiting callers are served first in first out.
+        return: seconds waited, or None if it would wait beyond the deadline() of the context.
+        """
+        with self._lock:
+            entry = self._entry(key)
+            now = time.monotonic()
+            wait = max(entry["blocked_until"] - now, 0.0)
+            for name, amount in (("requests", 1), ("tokens", tokens)):
+                bucket = entry[name]
+                bucket.refill(now)
+                wait = max(wait, bucket.reserve(amount))
+            remaining = remaining_time()
+            if remaining is not None and wait > remaining:
+                entry["requests"].refund(1)
+                entry["tokens"].refund(tokens)
+                return None
+            if wait > 0:
+                entry["waits"] += 1
+                entry["wait_time"] += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def settle(self, key, reserved, used):
+        """return reserved but unused tokens of a call to the bucket, or take the extra used tokens"""
+        with self._lock:
+            bucket = self._entry(key)["tokens"]
+            if bucket.limit:
+                bucket.level = min(float(bucket.limit), bucket.level + reserved - used)
+
+    def update(self, key, headers, status_code=None):
+        """update limits and levels of key from x-ratelimit-* response headers, and block it on 429"""
+        with self._lock:
+            entry = self._entry(key)
+            now = time.monotonic()
+            for name in ("requests", "tokens"):
+                bucket = entry[name]
+                bucket.refill(now)
+                limit = _to_number(headers.get(f"x-ratelimit-limit-{name}"))
+                if limit:
+                    if bucket.limit is None:
+                        bucket.level = float(limit)
+                    bucket.limit = limit
+                remaining = _to_number(headers.get(f"x-ratelimit-remaining-{name}"))
+                if remaining is not None and bucket.limit:
+                    # local level also counts calls in flight, which the server has not seen yet
+                    bucket.level = min(bucket.level, float(remaining))
+            if status_code == 429:
+                entry["throttled"] += 1
+                delay = self.retry_delay(headers)
+                if delay is not None:
+                    entry["blocked_until"] = max(entry["blocked_until"], now + delay)
+
+    @staticmethod
+    def retry_delay(headers):
+        """return seconds to wait suggested by a 429 response, by Retry-After or x-ratelimit-reset-*, or None"""
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            return RetryPolicy.parse_retry_after(retry_after)
+        resets = [
+            _parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+            for name in ("requests", "tokens")
+        ]
+        resets = [r for r in resets if r is not None]
+        return max(resets) if resets else None
+
+    def response_hook(self, key):
+        """return a requests response hook to update key, e.g. post(..., hooks={"response": hook})"""
+
+        def hook(resp, *args, **kwargs):
+            self.update(key, resp.headers, resp.status_code)
+            if resp.status_code == 429 and not resp.headers.get("Retry-After"):
+                # OpenAI tells the delay by x-ratelimit-reset-* only, expose it to RetryPolicy as Retry-After
+                delay = self.retry_delay(resp.headers)
+                if delay is not None:
+                    resp.headers["Retry-After"] = "%.3f" % delay
+            return resp
+
+        return hook
+
+    def stats(self):
+        """return dict of key => limits, current levels, waits and 429 responses"""
+        with self._lock:
+            now = time.monotonic()
+            stats = {}
+            for key, entry in self._keys.items():
+                stats[key] = {"waits": entry["waits"], "wait_time": entry["wait_time"], "throttled": entry["throttled"]}
+                for name in ("requests", "tokens"):
+                    bucket = entry[name]
+                    bucket.refill(now)
+                    stats[key][f"{name}_limit"] = bucket.limit
+                    stats[key][f"{name}_available"] = bucket.level if bucket.limit else None
+            return stats
+
+    def reset(self):
+        with self._lock:
+            self._keys.clear()
+
+
+def _to_number(value):
+    """return int or float of a header value, or None"""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_duration(value):
+    """return seconds of a duration like '1s', '6m0s', '20ms' or '1h2m3.5s' of x-ratelimit-reset-* headers, or None"""
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return _to_number(value)
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+# shared rate limiter of all ChatAPI instances
+chat_rate_limiter = ChatRateLimiter()
+
+
+class ChatUsage:
+    """Usage and latency accounting of ChatAPI calls: tokens, wall time, time to first token (TTFT) and tokens/sec
+
+    Per call, it records prompt and completion tokens from the API usage block, wall time,
+    TTFT when streaming, and completion tokens/sec (after the first token when streaming).
+    It keeps running totals and per-model histograms.
+
+    Usage:
+    chat = ChatAPI()
+    chat.chat("hi")
+    print(chat.usage.last)      # last call
+    print(chat.usage.summary()) # totals and per-model latency / ttft / tokens_per_second stats
+    """
+
+    # buckets of tokens/sec histogram
+    RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, float("inf"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.errors = 0
+            self.cached = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.wall_time = 0.0
+            self.last = None
+            # model => {"calls", "prompt_tokens", "completion_tokens", "latency", "ttft", "tokens_per_second"}
+            self._models = {}
+
+    def record(
+        self,
+        model,
+        wall_time,
+        prompt_tokens=None,
+        completion_tokens=None,
+        ttft=None,
+        error=False,
+        cached=False,
+    ):
+        """record a call, token counts are None if the API does not report usage"""
+        tokens_per_second = None
+        if completion_tokens and not error and not cached:
+            generation_time = wall_time - (ttft or 0.0)
+            if generation_time > 0:
+                tokens_per_second = completion_tokens / generation_time
+        last = {
+            "model": model,
+            "wall_time": wall_time,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "ttft": ttft,
+            "tokens_per_second": tokens_per_second,
+            "error": error,
+            "cached": cached,
+        }
+        with self._lock:
+            self.last = last
+            if cached:
+                self.cached += 1
+                return
+            self.calls += 1
+            self.errors += bool(error)
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+            self.wall_time += wall_time
+            stats = self._models.get(model)
+            if stats is None:
+                stats = self._models[model] = {
+                    "calls": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "latency": _Histogram(),
+                    "ttft": _Histogram(),
+                    "tokens_per_second": _Histogram(self.RATE_BUCKETS),
+                }
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens or 0
+            stats["completion_tokens"] += completion_tokens or 0
+            if not error:
+                stats["latency"].observe(wall_time)
+                if ttft is not None:
+                    stats["ttft"].observe(ttft)
+                if tokens_per_second is not None:
+                    stats["tokens_per_second"].observe(tokens_per_second)
+
+    def latency_quantile(self, model, q, min_count=1):
+        """return q quantile (0 to 1) of successful call latency of model in seconds, or None if fewer than min_count calls"""
+        with self._lock:
+            stats = self._models.get(model)
+            if stats is None or stats["latency"].count < min_count:
+                return None
+            return stats["latency"].quantile(q)
+
+    def summary(self):
+        """return dict of totals and per-model stats"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "cached": self.cached,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "wall_time": round(self.wall_time, 6),
+                "models": {
+                    model: {
+                        key: value.to_dict() if isinstance(value, _Histogram) else value
+                        for key, value in stats.items()
+                    }
+                    for model, stats in self._models.items()
+                },
+            }
+
+    def to_json(self, indent=True):
+        return json_dumps(self.summary(), indent=indent)
+
+    def footer(self):
+        """return one line stats of the last call, e.g. for px.chat --stats"""
+        last = self.last
+        if last is None:
+            return ""
+        if last["cached"]:
+            return f"[{last['model']}: cached answer]"
+        parts = []
+        if last["prompt_tokens"] is not None:
+            parts.append(f"{last['prompt_tokens']} prompt + {last['completion_tokens']} completion tokens")
+        parts.append(f"{last['wall_time']:.2f}s")
+        if last["ttft"] is not None:
+            parts.append(f"TTFT {last['ttft']:.2f}s")
+        if last["tokens_per_second"] is not None:
+            parts.append(f"{last['tokens_per_second']:.1f} tokens/s")
+        parts.append(f"total {self.prompt_tokens + self.completion_tokens} tokens in {self.calls} calls")
+        return f"[{last['model']}: " + ", ".join(parts) + "]"
+
+
+class ChatCache:
+    """Cache of ChatAPI answers keyed on hash of (model, messages, chat_params), with an in-memory LRU tier
+    and an optional on-disk tier, so reruns over the same inputs don't call the API again.
+
+    messages include the system message, the trimmed chat history sent and the question.
+
+    Params
+    ------
+    max_entries:    max number of answers in memory.
+    cache_dir:      directory of the on-disk tier, e.g. ~/.cache/pxutil/chat. Default to None, memory only.
+    ttl:            seconds an answer is valid. Default to None, never expires.
+    max_disk_bytes: max bytes of the on-disk tier, least recently used answers are removed first.
+
+    Usage:
+    chat = ChatAPI(cache=ChatCache(cache_dir="~/.cache/pxutil/chat", ttl=7 * 24 * 3600))
+    """
+
+    def __init__(
+        self, max_entries=1024, cache_dir=None, ttl=None, max_disk_bytes=100 * 1024 * 1024
+    ):
+        self.ttl = ttl
+        self._memory = _LRUCache(max_entries)
+        self._disk = _DiskStore(cache_dir, max_disk_bytes) if cache_dir else None
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(model, messages, params=None):
+        """return sha256 hex of model, messages and params, stable across json codecs and processes"""
+        import hashlib
+
+        data = json.dumps(
+            {"model": model, "messages": messages, "params": params or {}},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """return cached dict of answer and message, or None if not found or expired"""
+        entry = self._memory.get(key)
+        if entry is None and self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                try:
+                    entry = json_loads(value)
+                except ValueError:
+                    entry = None
+        if entry is not None and self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            self.delete(key)
+            entry = None
+        if entry is not None:
+            self._memory.set(key, entry)
+        with self._stats_lock:
+            self._stats["misses" if entry is None else "hits"] += 1
+        return entry
+
+    def set(self, key, value):
+        """cache value dict of answer and message"""
+        entry = dict(value, created=time.time())
+        self._memory.set(key, entry)
+        if self._disk is not None:
+            self._disk.set(key, json_dumps(entry, as_bytes=True))
+
+    def delete(self, key):
+        self._memory.pop(key)
+        if self._disk is not None:
+            self._disk.delete(key)
+
+    def clear(self):
+        self._memory.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self):
+        """return dict of hits, misses and entries in memory"""
+        with self._stats_lock:
+            return dict(self._stats, memory_entries=len(self._memory))
+
+
+def _endpoint_for_model(model):
+    """return (chat completions url, environment variable of API key) of model by its prefix, or None if not supported"""
+    if model.startswith("gpt-"):
+        return "https://api.openai.com/v1/chat/completions", "OPENAI_API_KEY"
+    if model.startswith("grok-"):
+        return "https://api.x.ai/v1/chat/completions", "XAI_API_KEY"
+    return None
+
+
 class ChatAPI:
     """chat based on chatGPT API
 
@@ -769,46 +3024,100 @@ class ChatAPI:
         system_msg="You are a command line terminal assistant, respond with terminal friendly text.",
         remember_chat_history=True,
         max_chat_history=2,  # each chat has 2 messages, a question and an answer
+        session=None,  # requests.Session or SessionPool for API calls, default to the default session pool
+        chat_params=None,  # extra parameters of chat completions API, e.g. {"temperature": 0}
+        cache=None,  # ChatCache instance to reuse answers of the same model, messages and chat_params
+        max_history_tokens=None,  # trim chat history to this token budget (by token_counter) besides max_chat_history
+        summarize_history=False,  # summarize chats trimmed by max_history_tokens into a system message, an extra API call in chat()
+        rate_limiter=None,  # ChatRateLimiter, default to the shared chat_rate_limiter, False to disable
+        retry=None,  # RetryPolicy of API calls, default to retry 429 Too Many Requests after the delay suggested by the server
+        history_log=None,  # ChatSessionLog to persist chat history and resume its last max_chat_history chats
+        fallback_models=None,  # models (of any provider) to fail over to in order on errors, e.g. ["grok-4-fast-non-reasoning"]
+        hedge_after=None,  # seconds, or "p95"/"p99" of observed latency, to send the question to the next model too
+        timeout=(10.0, 600.0),  # (connect, read) timeout in seconds of API calls, capped by a deadline() context
     ):
         self.model = model
         self.system_msg = system_msg
         self.remember_chat_history = remember_chat_history
         self.chat_history = []  # list of past chat messages
         self.max_chat_history = max_chat_history
-
-        if model.startswith('gpt-'):
-            self.url = 'https://api.openai.com/v1/chat/completions'
-            token_name = 'OPENAI_API_KEY'
-        elif model.startswith('grok-'):
-            self.url = 'https://api.x.ai/v1/chat/completions'
-            token_name = 'XAI_API_KEY' 
-        else:
-            sys.exit(f'model {model} is not supported.')           
-        
-        self.token = os.environ.get(token_name)
-        if self.token is None:
+        self.session = session
+        self.chat_params = chat_params or {}
+        self.cache = cache
+        self.usage = ChatUsage()  # usage and latency accounting of API calls
+        self.rate_limiter = chat_rate_limiter if rate_limiter is None else rate_limiter
+        # connection errors are not retried but failed over to fallback_models if any
+        if retry is None:
+            retry = RetryPolicy(
+                total=5,
+                backoff_factor=1.0,
+                backoff_max=60.0,
+                status_forcelist=(429,),
+                # POST of chat completions, 429 responses are not processed by the API
+                methods=None,
+                retry_connection_errors=False,
+            )
+        self.retry = retry
+        self.fallback_models = list(fallback_models or [])
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.max_history_tokens = max_history_tokens
+        self.summarize_history = summarize_history
+        self.history_summary = ""  # summary of chats trimmed from history if summarize_history
+        # one turn with chat history at a time, e.g. of concurrent achat() calls
+        self._history_lock = threading.RLock()
+        # token counts of chat_history messages, counted once when recorded
+        self._history_tokens = []
+        # index of the first chat_history message within max_history_tokens, and token count from it
+        self._window_start = 0
+        self._window_tokens = 0
+        self.history_log = history_log
+        if history_log is not None and remember_chat_history:
+            messages = history_log.tail(max_chat_history * 2)
+            # start at a question, e.g. if the answer of the first chat is cut off
+            while messages and messages[0].get("role") != "user":
+                messages.pop(0)
+            self.chat_history = messages
+
+        self.url, self.token = self._endpoint(model)
+        # model => (url, API key) of fallback models
+        self.fallback_endpoints = {m: self._endpoint(m) for m in self.fallback_models}
+
+    @staticmethod
+    def _endpoint(model):
+        """return (url, API key) of model, exit if not supported or API key is not set"""
+        endpoint = _endpoint_for_model(model)
+        if endpoint is None:
+            sys.exit(f'model {model} is not supported.')
+        url, token_name = endpoint
+        token = os.environ.get(token_name)
+        if token is None:
             sys.exit(f'Environment variable {token_name} is not set.')
+        return url, token
 
-    def chat(self, question: str):
-        """Ask a question and get an answer
-
-        return: answer str or Exception
-        """
+    def _build_messages(self, question, with_history=True):
+        """return messages of system message, chat history (if with_history) and question"""
         messages = []
         # add system message
         if self.system_msg:
             messages.append({"role": "system", "content": self.system_msg})
+        if with_history and self.history_summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation:\n{self.history_summary}",
+                }
+            )
         # add chat history
-        if self.remember_chat_history and len(self.chat_history) > 0:
+        if with_history and self.remember_chat_history and len(self.chat_history) > 0:
             # take only max_chat_history. NB: each chat has 2 messages.
-            chat_history = self.chat_history[-self.max_chat_history * 2 :]
-            messages.extend(chat_history)
+            start = max(len(self.chat_history) - self.max_chat_history * 2, 0)
+            if self.max_history_tokens is not None:
+                self._sync_history_tokens()
+                start = max(start, self._window_start)
+            messages.extend(self.chat_history[start:])
         # add current question
         messages.append({"role": "user", "content": question})
-        payload = {
-            "model": self.model,  # "gpt-3.5-turbo",
-            "messages": messages,
-        }
         # messages sample:
         #    "messages": [
         #        {"role": "system", "content": "You are a helpful assistant."}, # appreciation may help get a better answer
@@ -816,27 +3125,500 @@ class ChatAPI:
         #        {"role": "assistant", "content": "The Los Angeles Dodgers won the World Series in 2020."},
         #        {"role": "user", "content": "Where was it played?"},
         #    ]
+        return messages
+
+    def _record_history(self, question, message):
+        """record question and answer message in chat history"""
+        with self._history_lock:
+            if self.remember_chat_history:
+                self.chat_history.append({"role": "user", "content": question})
+                self.chat_history.append(message)
+                if self.history_log is not None:
+                    self.history_log.append(self.chat_history[-2:])
+                if self.max_history_tokens is not None:
+                    self._sync_history_tokens()
+
+    @staticmethod
+    def _message_tokens(message):
+        """return token count of a message, plus a few tokens of message overhead"""
+        content = message.get("content") or ""
+        try:
+            return token_counter(content) + 4
+        except Exception:
+            # rough estimate if tokenizer is not available, not to lose the answer
+            return len(content) // 4 + 4
+
+    def _sync_history_tokens(self):
+        """count tokens of new chat_history messages and trim the window to max_history_tokens
+
+        Each message is counted once, and trimming moves the window start forward by whole chats,
+        so it costs O(1) per turn instead of re-counting the whole history.
+        """
+        if len(self._history_tokens) > len(self.chat_history):
+            # chat_history is reset or edited outside, count again
+            self._history_tokens = []
+            self._window_start = self._window_tokens = 0
+        for message in self.chat_history[len(self._history_tokens) :]:
+            tokens = self._message_tokens(message)
+            self._history_tokens.append(tokens)
+            self._window_tokens += tokens
+
+        # max_chat_history first, its older chats are not sent nor summarized, then the budget to the rest
+        count_start = max(len(self.chat_history) - self.max_chat_history * 2, 0)
+        while self._window_start < count_start:
+            self._window_tokens -= self._history_tokens[self._window_start]
+            self._window_start += 1
+        dropped = []
+        while (
+            self._window_tokens > self.max_history_tokens
+            and self._window_start < len(self.chat_history)
+        ):
+            # drop a whole chat, i.e. a question and its answer
+            for _ in range(2):
+                if self._window_start < len(self.chat_history):
+                    dropped.append(self.chat_history[self._window_start])
+                    self._window_tokens -= self._history_tokens[self._window_start]
+                    self._window_start += 1
+        if dropped and self.summarize_history:
+            self._summarize(dropped)
+
+    def _summarize(self, messages):
+        """fold messages trimmed from history into history_summary
+
+        It is a synchronous API call after the answer is received, which adds its latency to chat() of the turn.
+        """
+        conversation = "\n".join(f"{m['role']}: {m.get('content') or ''}" for m in messages)
+        prompt = (
+            "Summarize the conversation below in a few sentences. "
+            "Keep the facts, names and decisions needed to continue it.\n\n"
+        )
+        if self.history_summary:
+            prompt += f"Earlier summary:\n{self.history_summary}\n\n"
+        prompt += f"Conversation:\n{conversation}"
+        result = self._ask([{"role": "user", "content": prompt}])
+        # keep the earlier summary if it fails
+        if not isinstance(result, Exception):
+            self.history_summary = result[0]
+
+    def _payload(self, messages, model=None, **extra):
+        return {
+            "model": model or self.model,  # "gpt-3.5-turbo",
+            "messages": messages,
+            **self.chat_params,
+            **extra,
+        }
+
+    def _candidates(self):
+        """return [(model, url, API key)] of the model and fallback models in order"""
+        return [(self.model, self.url, self.token)] + [
+            (model, *self.fallback_endpoints[model]) for model in self.fallback_models
+        ]
+
+    def _hedge_delay(self):
+        """return seconds to wait for an answer before hedging, or None not to hedge"""
+        if isinstance(self.hedge_after, str):
+            # e.g. "p95", after enough calls observed to estimate it
+            return self.usage.latency_quantile(
+                self.model, float(self.hedge_after.lstrip("p")) / 100, min_count=self.HEDGE_MIN_CALLS
+            )
+        return self.hedge_after
+
+    # calls of the model observed before hedging by its latency quantile
+    HEDGE_MIN_CALLS = 20
+
+    def _post(self, messages, payload, session=None, url=None, token=None, **kwargs):
+        """post payload to the chat API (default to url and token of the model) within the rate limits
+
+        return: (response of post(), rate limiter key, reserved tokens)
+        """
+        url = url or self.url
+        key = reserved = None
+        hooks = None
+        if self.rate_limiter:
+            key = ChatRateLimiter.key(url, payload["model"])
+            if self.rate_limiter.tracks_tokens(key):
+                # prompt tokens plus the completion tokens the API reserves for max tokens
+                reserved = sum(self._message_tokens(m) for m in messages)
+                reserved += self._max_completion_tokens()
+            if self.rate_limiter.acquire(key, reserved or 0) is None:
+                error = DeadlineExceeded(f"Chat API call of {payload['model']} is rate limited beyond the deadline.")
+                return error, key, None
+            hooks = {"response": self.rate_limiter.response_hook(key)}
+        headers = {"Authorization": "Bearer %s" % (token or self.token)}
+        # payload is encoded to compact json (no indent to save possible tokens) by the fast codec
+        resp = post(
+            url,
+            headers=headers,
+            json=payload,
+            session=session or self.session,
+            retry=self.retry,
+            hooks=hooks,
+            timeout=self.timeout,
+            **kwargs,
+        )
+        return resp, key, reserved
+
+    def _settle(self, key, reserved, usage):
+        """settle reserved tokens of a call with usage in the response"""
+        if reserved is not None and usage and usage.get("total_tokens") is not None:
+            self.rate_limiter.settle(key, reserved, usage["total_tokens"])
+
+    def _max_completion_tokens(self):
+        return self.chat_params.get("max_completion_tokens") or self.chat_params.get("max_tokens") or 0
+
+    def _cache_key(self, messages):
+        return ChatCache.key(self.model, messages, self.chat_params) if self.cache else None
+
+    def _ask(self, messages, session=None):
+        """send messages and return (answer, answer message) or Exception
+
+        It fails over to fallback_models in order on errors, and hedges with the next model
+        if hedge_after is set and no answer comes in time.
+        """
+        cache_key = self._cache_key(messages)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.usage.record(self.model, 0.0, cached=True)
+                return cached["answer"], cached["message"]
+
+        candidates = self._candidates()
+        errors = []
+        i = 0
+        while i < len(candidates):
+            hedge_after = self._hedge_delay() if i + 1 < len(candidates) else None
+            if hedge_after is None:
+                result = self._ask_model(candidates[i], messages, session)
+                i += 1
+            else:
+                result = self._ask_hedged(candidates[i], candidates[i + 1], hedge_after, messages, session)
+                i += 2
+            if isinstance(result, DeadlineExceeded):
+                # no time left for other models
+                return result
+            if not isinstance(result, Exception):
+                answer, message, model = result
+                # cache answers of the model only, as the key is of the model
+                if cache_key is not None and model == self.model:
+                    self.cache.set(cache_key, {"answer": answer, "message": message})
+                return answer, message
+            errors.append(result)
+        return errors[0] if len(errors) == 1 else Exception("; ".join(str(e) for e in errors))
+
+    def _ask_hedged(self, primary, secondary, hedge_after, messages, session=None):
+        """ask primary, and also secondary if primary has not answered in hedge_after seconds, the first answer wins
+
+        The call which loses is aborted by shutting down its connection, on sessions of a SessionPool (the
+        default) only, and its result is discarded: it is not recorded in usage, and its token reservation
+        is settled with the usage of the response if any, or released.
+        return: (answer, answer message, model) or Exception
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pxutil-hedge")
+        discarded = {}  # future => (Event set when its result is discarded, its _CallConnections)
+        winner = None
+
+        def ask(candidate, event, connections):
+            _call_connections.set(connections)
+            return self._ask_model(candidate, messages, session, event)
+
+        def submit(candidate):
+            event, connections = threading.Event(), _CallConnections()
+            future = executor.submit(_with_context(ask), candidate, event, connections)
+            discarded[future] = (event, connections)
+            return future
+
+        try:
+            futures = [submit(primary)]
+            done, _ = wait(futures, timeout=hedge_after)
+            if done and not isinstance(futures[0].result(), Exception):
+                winner = futures[0]
+                return winner.result()
+            # primary is slow or failed
+            futures.append(submit(secondary))
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if not isinstance(future.result(), Exception):
+                        winner = future
+                        return winner.result()
+            return Exception("; ".join(str(future.result()) for future in futures))
+        finally:
+            for future, (event, connections) in discarded.items():
+                if future is not winner:
+                    event.set()
+                    connections.abort()
+            executor.shutdown(wait=False)
+
+    def _ask_model(self, candidate, messages, session=None, discarded=None):
+        """send messages to one (model, url, API key), return (answer, answer message, model) or Exception
+
+        discarded: threading.Event set if the result is not wanted any more, e.g. a hedged call which lost.
+        """
+        model, url, token = candidate
+        payload = self._payload(messages, model)
+
+        start_time = time.perf_counter()
+        resp, key, reserved = self._post(messages, payload, session, url, token)
+        wall_time = time.perf_counter() - start_time
+        # failed calls don't hold their token reservation
+        usage = {"total_tokens": 0} if isinstance(resp, Exception) else resp.get("usage") or {}  # type: ignore
+        # settled on every exit, also if the response is unexpected
+        try:
+            if discarded is not None and discarded.is_set():
+                return Exception("Chat API request of %s is discarded." % model)
+            if isinstance(resp, Exception):
+                self.usage.record(model, wall_time, error=True)
+                if isinstance(resp, DeadlineExceeded):
+                    return resp
+                return Exception("Chat API request of %s failed with error: %s." % (model, resp))
+
+            self.usage.record(
+                model,
+                wall_time,
+                usage.get("prompt_tokens"),
+                usage.get("completion_tokens"),
+            )
+            if len(resp["choices"]) >= 1:  # type: ignore
+                for choice in resp["choices"]:  # type: ignore
+                    if choice["index"] == 0 and choice["finish_reason"] in ("stop", None):  # type: ignore
+                        answer = choice["message"]["content"]  # type: ignore
+                        answer = answer.strip("\n").strip()
+                        return answer, choice["message"], model  # type: ignore
+
+            return Exception(
+                "Chat API request of %s failed with no answer choices." % model
+            )  # default if no answer is found in the response
+        finally:
+            self._settle(key, reserved, usage)
+
+    def chat(self, question: str):
+        """Ask a question and get an answer
 
-        headers = {"Authorization": "Bearer %s" % self.token}
-        # no indent for payload to save possible tokens
-        resp = post(self.url, headers=headers, data=json.dumps(payload))
-        if isinstance(resp, Exception):
-            return Exception("Chat API request failed with error: %s." % resp)
+        Concurrent calls of an instance, e.g. by threads or achat(), take turns, as each question is asked
+        with the chat history of the answers before. Use chat_many() for independent questions.
 
-        if len(resp["choices"]) >= 1:  # type: ignore
-            for choice in resp["choices"]:  # type: ignore
-                if choice["index"] == 0 and choice["finish_reason"] in ("stop", None):  # type: ignore
-                    answer = choice["message"]["content"]  # type: ignore
-                    answer = answer.strip("\n").strip()
-                    # record chat history
-                    if self.remember_chat_history:
-                        self.chat_history.append({"role": "user", "content": question})
-                        self.chat_history.append(choice["message"])  # type: ignore
-                    return answer
+        return: answer str or Exception
+        """
+        with self._history_lock:
+            result = self._ask(self._build_messages(question))
+            if isinstance(result, Exception):
+                return result
+            answer, message = result
+            # record chat history
+            self._record_history(question, message)
+        return answer
+
+    def _ask_independent(self, question, session=None):
+        """ask a question without chat history, return answer str or Exception"""
+        try:
+            result = self._ask(self._build_messages(question, with_history=False), session)
+        except Exception as ex:
+            # e.g. unexpected response format
+            return Exception("Chat API request failed with error: %s." % ex)
+        return result if isinstance(result, Exception) else result[0]
+
+    def chat_many(self, questions, max_workers=8, ordered=True):
+        """Ask many independent questions concurrently on a thread pool
+
+        Each question is sent with the shared system_msg and model, without chat history,
+        and chat history is not recorded.
+
+        questions:      iterable of question str
+        max_workers:    max number of concurrent API calls
+        ordered:        True to return a list in input order, False to return a generator of (index, answer) as completed.
+
+        return: list of answer str or Exception per question, or generator of (index, answer) if ordered is False.
+
+        Usage:
+        answers = chat.chat_many(["classify: a", "classify: b"], max_workers=16)
+        """
+        if ordered:
+            return [answer for _, answer in self.imap(questions, max_workers)]
+        return self.imap(questions, max_workers, ordered=False)
+
+    def imap(self, questions, max_workers=8, ordered=True):
+        """generator version of chat_many(), yield (index, answer str or Exception) as answers are ready
+
+        questions are consumed lazily, so it also suits a long stream of questions, e.g. px.chat --batch.
+        ordered:    True to yield in input order, False as completed.
+        """
+        session = self.session
+        own_pool = session is None and max_workers > get_session_pool().max_per_host
+        if own_pool:
+            # enough keep-alive connections for all workers
+            session = SessionPool(max_per_host=max_workers)
+        try:
+            yield from _imap_threads(
+                lambda question: self._ask_independent(question, session),
+                questions,
+                max_workers,
+                ordered,
+            )
+        finally:
+            if own_pool:
+                session.close()
+
+    async def achat(self, question: str, semaphore=None):
+        """asyncio version of chat() with chat history, runs on the shared thread pool of arequest()
+
+        Concurrent calls take turns like chat(), use achat_many() for independent questions concurrently.
+        semaphore: asyncio.Semaphore to limit concurrent calls, default to None, no limit.
+        return: answer str or Exception
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if semaphore is None:
+            return await loop.run_in_executor(_get_async_executor(), _with_context(self.chat), question)
+        async with semaphore:
+            return await loop.run_in_executor(_get_async_executor(), _with_context(self.chat), question)
+
+    async def achat_many(self, questions, limit=8):
+        """asyncio version of chat_many(), ask many independent questions with at most limit concurrent calls
+
+        return: list of answer str or Exception per question in input order.
+
+        Usage:
+        answers = asyncio.run(chat.achat_many(questions, limit=16))
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(limit)
+
+        async def ask(question):
+            async with semaphore:
+                return await loop.run_in_executor(
+                    _get_async_executor(), _with_context(self._ask_independent), question
+                )
+
+        return await asyncio.gather(*(ask(question) for question in questions))
+
+    def chat_stream(self, question: str):
+        """Ask a question and stream the answer as it is generated
+
+        The server-sent events stream of the chat completions API is consumed as it arrives,
+        so the first words can be shown long before the answer is complete.
+
+        return: generator of answer content deltas (str), or Exception if the request fails.
+                The request fails over to fallback_models too, but it is not hedged.
+                Chat history is recorded when the generator is exhausted.
+                Errors in the middle of the stream, e.g. connection lost, are raised by the generator.
+
+        Usage:
+        deltas = chat.chat_stream("who are you?")
+        if not isinstance(deltas, Exception):
+            for delta in deltas:
+                print(delta, end="", flush=True)
+        """
+        with self._history_lock:
+            messages = self._build_messages(question)
+        cache_key = self._cache_key(messages)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self._iter_cached(question, cached)
+
+        errors = []
+        for model, url, token in self._candidates():
+            # ask for the usage block in the last chunk
+            payload = self._payload(messages, model, stream=True, stream_options={"include_usage": True})
+            start_time = time.perf_counter()
+            lines, key, reserved = self._post(messages, payload, None, url, token, stream=True, stream_as="lines")
+            if not isinstance(lines, Exception):
+                if model != self.model:
+                    # cache answers of the model only
+                    cache_key = None
+                # settled by the generator, or when lines is collected if the generator is never started
+                settle = weakref.finalize(lines, self._settle, key, reserved, self._stream_usage(reserved, []))
+                return self._iter_deltas(question, lines, cache_key, start_time, (key, reserved), model, settle)
+            self._settle(key, reserved, {"total_tokens": 0})
+            self.usage.record(model, time.perf_counter() - start_time, error=True)
+            if isinstance(lines, DeadlineExceeded):
+                return lines
+            # fail over to the next model
+            errors.append("Chat API request of %s failed with error: %s." % (model, lines))
+        return Exception("; ".join(errors))
+
+    def _iter_cached(self, question, cached):
+        """yield cached answer as one delta and record chat history"""
+        self.usage.record(self.model, 0.0, cached=True)
+        yield cached["message"]["content"]
+        self._record_history(question, cached["message"])
+
+    def _stream_usage(self, reserved, parts):
+        """return usage estimate of a stream stopped without the usage block: the prompt and the answer so far"""
+        if reserved is None:
+            return None
+        answer_tokens = self._message_tokens({"content": "".join(parts)}) if parts else 0
+        return {"total_tokens": reserved - self._max_completion_tokens() + answer_tokens}
+
+    def _iter_deltas(
+        self, question, lines, cache_key=None, start_time=None, reservation=(None, None), model=None, settle=None
+    ):
+        """yield content deltas of choice 0 from server-sent events lines, and record chat history at the end
+
+        reservation is settled with the usage of the stream, or its estimate if the stream stops early or fails.
+        settle: weakref.finalize which settles it if the generator is never started, detached once started.
+
+        event sample:
+        data: {"id":"chatcmpl-1","object":"chat.completion.chunk","choices":[{"index":0,"delta":{"content":"Hi"},"finish_reason":null}]}
+        data: [DONE]
+        """
+        model = model or self.model
+        parts = []
+        finish_reason = None
+        ttft = None
+        usage = {}
+        if start_time is None:
+            start_time = time.perf_counter()
+        try:
+            for line in lines:
+                if not line.startswith("data:"):
+                    # skip empty lines between events and comments
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json_loads(data)
+                # usage is in the last chunk with empty choices
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    if choice.get("index", 0) != 0:
+                        continue
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        if ttft is None:
+                            ttft = time.perf_counter() - start_time
+                        parts.append(delta)
+                        yield delta
+                    finish_reason = choice.get("finish_reason") or finish_reason
+        except Exception:
+            self.usage.record(model, time.perf_counter() - start_time, ttft=ttft, error=True)
+            raise
+        finally:
+            # release the connection if the caller stops early
+            lines.close()
+            if settle is None or settle.detach() is not None:
+                self._settle(*reservation, usage or self._stream_usage(reservation[1], parts))
+
+        self.usage.record(
+            model,
+            time.perf_counter() - start_time,
+            usage.get("prompt_tokens"),
+            usage.get("completion_tokens"),
+            ttft=ttft,
+        )
 
-        return Exception(
-            "Chat API request failed with no answer choices."
-        )  # default if no answer is found in the response
+        if finish_reason in ("stop", None):
+            message = {"role": "assistant", "content": "".join(parts)}
+            self._record_history(question, message)
+            if cache_key is not None:
+                answer = message["content"].strip("\n").strip()
+                self.cache.set(cache_key, {"answer": answer, "message": message})
 
 
 def list_module_contents(module_name: str):
@@ -933,12 +3715,596 @@ def is_text_file(filepath: str, blocksize=512):
         return False
 
 
-def token_counter(text: str):
-    """retun number of tokens counted by tiktoken"""
-    import tiktoken
+# default tiktoken encoding of token_counter(), of gpt-4o and later OpenAI models
+TOKEN_ENCODING = "o200k_base"
+
+# tiktoken encoders loaded once per encoding name, also cached by (model, encoding) to skip the model lookup
+_token_encoders = {}
+_token_encoders_lock = threading.Lock()
+
+
+def _get_encoder(encoding=None, model=None):
+    """return cached tiktoken encoder of encoding name, or of model name (encoding if not known by tiktoken)"""
+    key = (model, encoding) if model else encoding or TOKEN_ENCODING
+    encoder = _token_encoders.get(key)
+    if encoder is None:
+        name = _encoding_name(encoding, model)
+        with _token_encoders_lock:
+            encoder = _token_encoders.get(name)
+            if encoder is None:
+                import tiktoken
+
+                encoder = _token_encoders[name] = tiktoken.get_encoding(name)
+            _token_encoders[key] = encoder
+    return encoder
+
+
+def _encoding_name(encoding=None, model=None):
+    """return encoding name of encoding or model as _get_encoder() selects it, without loading the encoder"""
+    if model:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_name_for_model(model)
+        except KeyError:
+            pass
+    return encoding or TOKEN_ENCODING
+
+
+# character class features of the approximate token counter, see _approx_features()
+_APPROX_FEATURES = ("words", "letters", "digits", "punctuation", "whitespace", "cjk", "other")
+_APPROX_WORD = re.compile(r"[A-Za-z]+")
+_APPROX_NUMBER = re.compile(r"[0-9]+")
+_APPROX_WHITESPACE = re.compile(r"\s{2,}|\n")
+_APPROX_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+# tokens per feature of the approximate token counter by encoding, fitted with tests/calibrate_token_approx.py
+# to the Python 3.11 stdlib *.py, site-packages *.md and *.rst docs, /usr/share/common-licenses and the CJK
+# samples of the stdlib test/cjkencodings (2613 samples of 2000 characters, 1.17M tokens).
+# "other" also counts cjk characters, so the cjk coefficient is on top of it.
+TOKEN_APPROX_COEFFICIENTS = {
+    "o200k_base": {
+        "words": 0.891, "letters": 0.033, "digits": 0.921, "punctuation": 0.406,
+        "whitespace": 2.067, "cjk": 0.0, "other": 0.792,
+    },
+    "cl100k_base": {
+        "words": 0.919, "letters": 0.028, "digits": 0.927, "punctuation": 0.394,
+        "whitespace": 2.021, "cjk": 0.0, "other": 1.191,
+    },
+}  # fmt: skip
+
+
+def _approx_features(text):
+    """return dict of character class feature counts of text, by C scans of str and re without a Python loop
+
+    words:          runs of ASCII letters, a common word is one token.
+    letters:        ASCII letters, longer words split into more tokens.
+    digits:         numbers are split into groups of up to 3 digits.
+    punctuation:    other ASCII characters but spaces, tabs and newlines.
+    whitespace:     newlines and runs of whitespace like indentation, single spaces are part of words.
+    cjk:            CJK and kana and hangul characters.
+    other:          non-ASCII characters, cjk included.
+    """
+    words = _APPROX_WORD.findall(text)
+    letters = sum(map(len, words))
+    digits = sum(map(len, _APPROX_NUMBER.findall(text)))
+    other = len(text) - len(text.encode("ascii", "ignore"))
+    spaces = text.count(" ") + text.count("\n") + text.count("\t") + text.count("\r")
+    return {
+        "words": len(words),
+        "letters": letters,
+        "digits": digits,
+        "punctuation": len(text) - letters - digits - other - spaces,
+        "whitespace": len(_APPROX_WHITESPACE.findall(text)),
+        "cjk": len(_APPROX_CJK.findall(text)) if other else 0,
+        "other": other,
+    }
+
+
+def _approx_encoding(encoding=None, model=None):
+    """return encoding name of model by its name like _encoding_name(), without importing tiktoken"""
+    if model:
+        if model == "gpt-4" or model.startswith(("gpt-4-", "gpt-3.5", "gpt-35")):
+            return "cl100k_base"
+        if model.startswith(("gpt-", "o1", "o3", "o4", "chatgpt-")):
+            return TOKEN_ENCODING
+    return encoding or TOKEN_ENCODING
+
+
+def token_counter_approx(text, encoding=None, model=None):
+    """return estimated number of tokens of text, by a linear model of character class counts, without tiktoken
+
+    It takes microseconds for a prompt, e.g. to check whether it fits a budget in a hot path.
+    Coefficients are per encoding in TOKEN_APPROX_COEFFICIENTS (o200k_base ones for unknown encodings).
+
+    Error bound: relative error of mean 4.9%, p95 12.8% (o200k_base) and mean 4.8%, p95 13.0% (cl100k_base),
+    measured on samples of 2000 characters of English docs, Python code and licenses, see
+    TOKEN_APPROX_COEFFICIENTS. CJK text was fitted on few samples only and is off 15% on average, while short
+    texts and data like base64 or minified code can be off more, so leave a margin in budget checks. Run
+    tests/calibrate_token_approx.py on a corpus like your texts to measure it and to refit the coefficients.
+    """
+    return int(round(_approx_estimate(text, _approx_encoding(encoding, model))))
+
+
+def _approx_estimate(text, encoding):
+    """return unrounded estimate of token_counter_approx(), which adds up over chunks of a text"""
+    coefficients = TOKEN_APPROX_COEFFICIENTS.get(encoding, TOKEN_APPROX_COEFFICIENTS[TOKEN_ENCODING])
+    features = _approx_features(text)
+    return sum(coefficients[name] * features[name] for name in _APPROX_FEATURES)
+
+
+def token_counter(text: str, encoding=None, model=None, cache=None, approx=False):
+    """retun number of tokens counted by tiktoken
+
+    encoding:   tiktoken encoding name, default to TOKEN_ENCODING (o200k_base).
+    model:      model name to select its encoding instead, e.g. gpt-4o. Unknown models use encoding.
+    cache:      TokenCountCache to reuse the count of the same text, worth it for long texts only.
+    approx:     True to estimate it in microseconds without tiktoken, see token_counter_approx() for its error.
+
+    Special tokens like <|endoftext|> are counted as plain text.
+    """
+    if approx:
+        return token_counter_approx(text, encoding, model)
+    if cache is not None:
+        return cache.count(text, encoding, model)
+    return len(_get_encoder(encoding, model).encode_ordinary(text))
+
+
+# safe boundaries to split a text for token counting, where tiktoken pre-tokenization splits anyway:
+# after a single newline between non-whitespace characters but /, and before a single space between
+# non-whitespace characters. A newline before / is not safe, as ` ?[^\s\p{L}\p{N}]+[\r\n/]*` of o200k_base
+# joins punctuation, the newline and the / after it, e.g. ";\n//". Longer whitespace runs are not safe
+# either, as patterns like \s+(?!\S) split them differently at the end of a text.
+_TOKEN_SAFE_SPLIT = re.compile(r"(?<=\S)\n(?=[^\s/])|(?<=\S)(?= \S)")
+
+
+def _split_token_safe(text):
+    """return (head, tail) of text split at its last safe boundary, or ("", text) if none"""
+    # look for the last boundary near the end first, as text is usually a long chunk
+    start = max(len(text) - 4096, 0)
+    while True:
+        last = None
+        for last in _TOKEN_SAFE_SPLIT.finditer(text, start):
+            pass
+        if last is not None:
+            return text[: last.end()], text[last.end() :]
+        if start == 0:
+            return "", text
+        start = max(start - 65536, 0)
+
+
+def token_counter_file(
+    file, encoding=None, model=None, chunk_size=1 << 20, num_threads=4, progress=None, approx=False
+):
+    """return number of tokens of a file, read in chunks with bounded memory whatever the file size
+
+    Chunks are split at safe boundaries (see _TOKEN_SAFE_SPLIT) where tiktoken pre-tokenization splits
+    the whole text too, so the count matches token_counter() of the whole file. A stretch of 16 * chunk_size
+    bytes without any boundary, e.g. a huge base64 blob, is split anyway, which may change the count slightly.
+    Chunks are counted on num_threads threads.
+
+    file:       file path, or binary file object, e.g. sys.stdin.buffer. Decoded as utf-8, invalid bytes are replaced.
+    chunk_size: bytes to read at a time.
+    progress:   callable(bytes_read, tokens_counted) called after each chunk is counted, e.g. to print progress.
+    approx:     True to estimate it by token_counter_approx() instead.
+
+    Usage:
+    token_counter_file("huge.log")
+    """
+    import codecs
+
+    if approx:
+        measure = functools.partial(_approx_estimate, encoding=_approx_encoding(encoding, model))
+    else:
+        encode = _get_encoder(encoding, model).encode_ordinary
+
+        def measure(text):
+            return len(encode(text))
+
+    max_carry = 16 * chunk_size
+    bytes_read = 0
+
+    def chunks(f):
+        nonlocal bytes_read
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        carry = ""
+        while True:
+            data = f.read(chunk_size)
+            bytes_read += len(data)
+            text = carry + decoder.decode(data, final=not data)
+            if not data:
+                if text:
+                    yield text
+                return
+            head, carry = _split_token_safe(text)
+            if not head and len(carry) > max_carry:
+                # no boundary in a long stretch, bound the memory
+                head, carry = carry, ""
+            if head:
+                yield head
+
+    def count(text):
+        return measure(text), bytes_read
+
+    if isinstance(file, (str, bytes, os.PathLike)):
+        f = open(file, "rb")
+    else:
+        f = file
+    tokens = 0
+    try:
+        for _, (n, read) in _imap_threads(count, chunks(f), max(num_threads, 1)):
+            tokens += n
+            if progress is not None:
+                progress(read, int(round(tokens)))
+    finally:
+        if f is not file:
+            f.close()
+    return int(round(tokens))
+
+
+def _count_file_tokens(path, encoding=None, model=None, approx=False):
+    """return token count of a file or the Exception, in a worker process of token_counter_files()"""
+    try:
+        return token_counter_file(path, encoding, model, num_threads=1, approx=approx)
+    except Exception as e:
+        return e
+
+
+def token_counter_files(paths, encoding=None, model=None, max_workers=None, cache=None, approx=False):
+    """return token counts of files in order, or Exception per file failed to read, counted on a process pool
+
+    Each worker process loads the tiktoken encoder once and counts many files, which saves the interpreter
+    and tiktoken start-up per file of running px.token.counter per file.
+
+    max_workers: worker processes, default to number of CPUs. 1 to count in this process.
+    cache:       TokenCountCache to count only files changed since they were counted last time.
+    approx:      True to estimate them by token_counter_approx() in this process, cache is not used.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if approx:
+        return [_count_file_tokens(path, encoding, model, approx=True) for path in paths]
+    if cache is not None:
+        return cache.count_files(paths, encoding, model, max_workers)
+    paths = list(paths)
+    count = functools.partial(_count_file_tokens, encoding=encoding, model=model)
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(paths) <= 1:
+        return [count(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        # a few tasks per worker to balance big and small files with little overhead
+        chunksize = max(len(paths) // (max_workers * 4), 1)
+        return list(executor.map(count, paths, chunksize=chunksize))
+
+
+def _file_digest(path, keep_bytes=0):
+    """return (sha256 hex of file content, the content if it is up to keep_bytes long, otherwise None)"""
+    import hashlib
+
+    digest = hashlib.sha256()
+    blocks = []
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            size += len(block)
+            if size <= keep_bytes:
+                blocks.append(block)
+            else:
+                blocks = None
+    return digest.hexdigest(), None if blocks is None else b"".join(blocks)
+
+
+class TokenCountCache:
+    """Persistent cache of token counts keyed on (sha256 of content, encoding), in a sqlite database
+
+    Files have a fast path keyed on (path, size, mtime), so unchanged files are neither read nor hashed.
+    Changed files are hashed, and only content never counted before is tokenized, e.g. a file switched
+    back by git checkout is not counted again.
+
+    A file modified within the last 2 seconds is not cached, as a later change in the same mtime tick
+    with the same size would not be noticed (like racily clean files of git). Nor is a file changed
+    while it is counted, as its hash and count may be of different content.
+    The database is capped to max_entries counts and max_entries files, the least recently used
+    are removed first down to 90%. Last used times of hits by get() are written in batches, call close()
+    to write the rest.
+
+    Params
+    ------
+    path:           sqlite database file. Default to None, ~/.cache/pxutil/token_counts.sqlite3.
+    max_entries:    max number of counts, and max number of files of the fast path.
+
+    Usage:
+    cache = TokenCountCache()
+    token_counter_files(files, cache=cache)
+    token_counter(long_text, cache=cache)
+    """
+
+    # seconds since modification before a file gets a fast path entry and its count is saved
+    RACY_SECONDS = 2.0
+    # misses to count on a process pool, fewer are counted in this process
+    POOL_MIN_FILES = 16
+    # files up to this size are kept in memory while hashed, to count a miss without reading it again
+    KEEP_FILE_BYTES = 4 << 20
+    # hits by get() to write their last used times at once
+    TOUCH_BATCH = 256
+
+    def __init__(self, path=None, max_entries=100000):
+        import sqlite3
+
+        self.path = normal_path(path or osp.join("~", ".cache", "pxutil", "token_counts.sqlite3"))
+        self.max_entries = max_entries
+        os.makedirs(osp.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        # WAL lets other processes, e.g. another px.token.counter, read while one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS counts (digest TEXT, encoding TEXT, tokens INTEGER, used REAL,"
+            " PRIMARY KEY (digest, encoding)) WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+            " digest TEXT, used REAL)"
+        )
+        self._stats = {"hits": 0, "file_hits": 0, "misses": 0}
+        # table => rows counted once and added up by inserts, an upper bound as an insert may replace a row
+        self._rows = {}
+        # (digest, encoding) => last used time of hits not written yet
+        self._touched = {}
+
+    @staticmethod
+    def key(text):
+        import hashlib
+
+        return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    def get(self, digest, encoding=TOKEN_ENCODING):
+        """return token count of content digest, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT tokens FROM counts WHERE digest = ? AND encoding = ?", (digest, encoding)
+            ).fetchone()
+            if row is not None:
+                self._touched[(digest, encoding)] = time.time()
+                if len(self._touched) >= self.TOUCH_BATCH:
+                    self._flush_touched()
+        return None if row is None else row[0]
+
+    def set(self, digest, encoding, tokens):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?)", (digest, encoding, tokens, time.time())
+            )
+            self._evict("counts", 1)
+
+    def _flush_touched(self):
+        """write last used times of hits by get() in one transaction, with lock held"""
+        if not self._touched:
+            return
+        rows = [(used, digest, encoding) for (digest, encoding), used in self._touched.items()]
+        self._touched.clear()
+        sql = "UPDATE counts SET used = ? WHERE digest = ? AND encoding = ?"
+        if self._db.in_transaction:
+            self._db.executemany(sql, rows)
+            return
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(sql, rows)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def count(self, text, encoding=None, model=None):
+        """return token count of text, counted once per content and encoding"""
+        name = _encoding_name(encoding, model)
+        digest = self.key(text)
+        tokens = self.get(digest, name)
+        with self._lock:
+            self._stats["misses" if tokens is None else "hits"] += 1
+        if tokens is None:
+            tokens = token_counter(text, encoding, model)
+            self.set(digest, name, tokens)
+        return tokens
+
+    def _evict(self, table, inserted):
+        """remove least recently used rows of table down to 90% of max_entries if it is over, with lock held
+
+        Rows are counted again only when the upper bound of inserts is over max_entries.
+        """
+        rows = self._rows.get(table)
+        if rows is not None:
+            rows += inserted
+        if rows is None or rows > self.max_entries:
+            (rows,) = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        if rows > self.max_entries:
+            if table == "counts":
+                self._flush_touched()
+            key = "digest, encoding" if table == "counts" else "path"
+            self._db.execute(
+                f"DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} ORDER BY used LIMIT ?)",
+                (rows - int(self.max_entries * 0.9),),
+            )
+            rows = int(self.max_entries * 0.9)
+        self._rows[table] = rows
+
+    def count_file(self, path, encoding=None, model=None, progress=None):
+        """return token count of a file, see count_files(). progress is passed to token_counter_file()"""
+        return self.count_files([path], encoding, model, progress=progress)[0]
+
+    def count_files(self, paths, encoding=None, model=None, max_workers=None, progress=None):
+        """return token counts of files in order, or Exception per file, counting changed content only
+
+        1. fast path: files of the same path, size and mtime as last time
+        2. files of content (by sha256) counted before, hashed on threads
+        3. the rest, counted in this process from the content read to hash them if up to KEEP_FILE_BYTES,
+           or by token_counter_files() on a process pool if there are POOL_MIN_FILES or more
+        """
+        paths = list(paths)
+        name = _encoding_name(encoding, model)
+        now = time.time()
+        results = [None] * len(paths)
+        stats = [None] * len(paths)  # (realpath, size, mtime_ns) of files to update the fast path
+        digests = [None] * len(paths)
+        with self._lock:
+            for i, path in enumerate(paths):
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    results[i] = e
+                    continue
+                stats[i] = (osp.realpath(path), st.st_size, st.st_mtime_ns)
+                row = self._db.execute(
+                    "SELECT counts.tokens FROM files JOIN counts ON files.digest = counts.digest"
+                    " WHERE files.path = ? AND files.size = ? AND files.mtime_ns = ? AND counts.encoding = ?",
+                    (*stats[i], name),
+                ).fetchone()
+                if row is not None:
+                    results[i] = row[0]
+                    self._stats["file_hits"] += 1
+        file_hits = [stats[i][0] for i in range(len(paths)) if isinstance(results[i], int)]
+
+        todo = [i for i in range(len(paths)) if results[i] is None]
+        contents = {}  # index => content of a miss read to hash it, while it may be counted here
+        for i, result in _imap_threads(lambda i: _try(_file_digest, paths[i], self.KEEP_FILE_BYTES), todo, 8):
+            index = todo[i]
+            if isinstance(result, Exception):
+                results[index] = result
+                continue
+            digests[index], content = result
+            results[index] = self.get(digests[index], name)
+            if results[index] is None and content is not None and len(contents) < self.POOL_MIN_FILES:
+                contents[index] = content
+        hits = [i for i in todo if isinstance(results[i], int)]
+        misses = [i for i in todo if results[i] is None]
+        if len(misses) < self.POOL_MIN_FILES:
+            # a worker process would take longer to load tiktoken than counting a few files here
+            counts = [
+                _try(
+                    token_counter_file,
+                    io.BytesIO(contents[i]) if i in contents else paths[i],
+                    encoding,
+                    model,
+                    progress=progress if len(misses) == 1 else None,
+                )
+                for i in misses
+            ]
+        else:
+            contents.clear()
+            counts = token_counter_files([paths[i] for i in misses], encoding, model, max_workers)
+        for i, tokens in zip(misses, counts):
+            results[i] = tokens
+        misses = set(misses)
+        # files changed since stat may have been hashed and counted from different content, don't cache them
+        changed = set()
+        for i in todo:
+            try:
+                st = os.stat(paths[i])
+            except OSError:
+                changed.add(i)
+                continue
+            if (st.st_size, st.st_mtime_ns) != stats[i][1:]:
+                changed.add(i)
+
+        with self._lock:
+            self._stats["hits"] += len(hits)
+            self._stats["misses"] += len(misses)
+            self._db.execute("BEGIN")
+            try:
+                self._flush_touched()
+                # keep the fast path entries and counts in use from eviction
+                self._db.executemany("UPDATE files SET used = ? WHERE path = ?", [(now, p) for p in file_hits])
+                self._db.executemany(
+                    "UPDATE counts SET used = ? WHERE encoding = ? AND digest = (SELECT digest FROM files WHERE path = ?)",
+                    [(now, name, p) for p in file_hits],
+                )
+                inserted = {"counts": 0, "files": 0}
+                for i in todo:
+                    if isinstance(results[i], Exception) or i in changed:
+                        continue
+                    racy = now - stats[i][2] / 1e9 < self.RACY_SECONDS
+                    if i in misses and not racy:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?)", (digests[i], name, results[i], now)
+                        )
+                        inserted["counts"] += 1
+                    if not racy:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (*stats[i], digests[i], now)
+                        )
+                        inserted["files"] += 1
+                    else:
+                        self._db.execute("DELETE FROM files WHERE path = ?", (stats[i][0],))
+                self._evict("counts", inserted["counts"])
+                self._evict("files", inserted["files"])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return results
+
+    def stats(self):
+        """return dict of hits (by content), file_hits (fast path), misses, counts and files"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["counts"] = self._db.execute("SELECT COUNT(*) FROM counts").fetchone()[0]
+            stats["files"] = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._db.execute("DELETE FROM counts")
+            self._db.execute("DELETE FROM files")
+            self._rows = {"counts": 0, "files": 0}
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._db.close()
+
+
+def _try(func, *args, **kwargs):
+    """return func(*args, **kwargs) or the Exception it raises"""
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        return e
+
+
+def token_counter_many(texts, encoding=None, model=None, num_threads=8, batch_size=256):
+    """return token counts of many texts in an array('I'), tokenized in batches on num_threads threads
 
-    enc = tiktoken.get_encoding("o200k_base")
-    return len(enc.encode(text))
+    tiktoken releases the GIL while encoding, so threads scale on multi-core machines, and batching
+    saves the per-call overhead of counting short texts, e.g. log records, one by one.
+
+    texts:      iterable of str, consumed lazily, so a generator of a huge input needs little memory.
+    batch_size: texts per task on the thread pool.
+
+    Usage:
+    counts = token_counter_many(records)
+    total = sum(counts)
+    """
+    from array import array
+    from itertools import islice
+
+    encode = _get_encoder(encoding, model).encode_ordinary
+
+    def count(batch):
+        return [len(encode(text)) for text in batch]
+
+    iterator = iter(texts)
+    batches = iter(lambda: list(islice(iterator, batch_size)), [])
+    counts = array("I")
+    if num_threads <= 1:
+        for batch in batches:
+            counts.extend(count(batch))
+    else:
+        for _, batch_counts in _imap_threads(count, batches, num_threads):
+            counts.extend(batch_counts)
+    return counts
 
 
 def main():
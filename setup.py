@@ -34,14 +34,13 @@ setup(
         "pathspec>=0.12.1",
         "tiktoken",
     ],
-    # # optional dependency example:
-    # # pip install pxutil[test] to install optional test dependencies
-    # extras_require={
-    #     "test": [
-    #         "pytest>=6.0.0",
-    #         "pytest-cov>=2.10.0",
-    #     ],
-    # },
+    # optional dependencies
+    # pip install pxutil[fast] to use faster json codec orjson in request(), pretty_json() and ChatAPI
+    extras_require={
+        "fast": [
+            "orjson",
+        ],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
@@ -0,0 +1,133 @@
+"""
+Throughput benchmark of request()/post() against the local httpbin stand-in, no network needed.
+
+Modes
+-----
+new-session:    sequential calls with a new requests.Session() per call, i.e., no connection reuse.
+pooled:         sequential calls with the default session pool.
+session-reuse:  sequential calls with one explicit requests.Session().
+threaded:       concurrent calls on a thread pool sharing the default session pool.
+post:           sequential post() of a json body with the default session pool.
+
+usage:
+python -m tests.bench_request
+python -m tests.bench_request -n 2000 -j 64 --path /bytes/100000 --json
+# fail (exit 1) if pooled mode is slower than 500 requests/sec, e.g. in CI
+python -m tests.bench_request --min-rps pooled=500
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import pxutil as px
+
+from .local_httpbin import LocalHttpbin
+
+
+def percentile(sorted_values, q):
+    """return q (0-100) percentile of sorted values"""
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(q / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(mode, latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def timed(func):
+    """return (result, seconds) of func()"""
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run_sequential(mode, n, call):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n):
+        result, seconds = timed(call)
+        assert not isinstance(result, Exception), result
+        latencies.append(seconds)
+    return summarize(mode, latencies, time.perf_counter() - start)
+
+
+def run_threaded(n, url, workers):
+    latencies = []
+
+    def call(_):
+        result, seconds = timed(lambda: px.request("GET", url))
+        assert not isinstance(result, Exception), result
+        latencies.append(seconds)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(call, range(n)))
+    return summarize("threaded", latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request()/post() against local httpbin stand-in.")
+    parser.add_argument("-n", "--number", type=int, default=500, help="requests per mode (default: 500)")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=32, help="workers of threaded mode, above max_per_host (default: 32)"
+    )
+    parser.add_argument("--path", default="/get", help="GET path to request (default: /get)")
+    parser.add_argument("--json", action="store_true", help="print results in json")
+    parser.add_argument(
+        "--min-rps",
+        action="append",
+        default=[],
+        metavar="MODE=RPS",
+        help="fail if requests/sec of mode is below RPS, can repeat",
+    )
+    args = parser.parse_args()
+
+    with LocalHttpbin() as httpbin:
+        url = httpbin.url + args.path
+        post_url = httpbin.url + "/post"
+        session = requests.Session()
+        # warm up connections
+        px.request("GET", url)
+        px.request("GET", url, session=session)
+
+        results = [
+            run_sequential("new-session", args.number, lambda: px.request("GET", url, session=requests.Session())),
+            run_sequential("pooled", args.number, lambda: px.request("GET", url)),
+            run_sequential("session-reuse", args.number, lambda: px.request("GET", url, session=session)),
+            run_threaded(args.number, url, args.workers),
+            run_sequential("post", args.number, lambda: px.post(post_url, json={"key": "value"})),
+        ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<15}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for r in results:
+            print(f"{r['mode']:<15}{r['requests']:>10}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+    failed = False
+    rps = {r["mode"]: r["rps"] for r in results}
+    for item in args.min_rps:
+        mode, _, min_rps = item.partition("=")
+        if rps.get(mode, 0.0) < float(min_rps):
+            print(f"FAIL: {mode} {rps.get(mode, 0.0):.1f} req/s is below {min_rps} req/s", file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
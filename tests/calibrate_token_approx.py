@@ -0,0 +1,142 @@
+"""
+Calibrate the approximate token counter token_counter_approx() against real tiktoken counts.
+
+Texts of the given files and globs are cut into samples of about --sample-chars characters, at whitespace.
+Each sample is counted by tiktoken and by its character class features, then the tokens per feature are
+fitted by least squares. It prints the relative error of the current and the fitted coefficients, i.e., the
+error bound to document, and the fitted coefficients to paste into TOKEN_APPROX_COEFFICIENTS.
+
+Use a corpus like the texts to count, e.g. English docs and source code, plus other languages if needed.
+
+usage:
+python -m tests.calibrate_token_approx "docs/**/*.md" "src/**/*.py"
+python -m tests.calibrate_token_approx -e cl100k_base --sample-chars 4000 corpus/*.txt --json
+"""
+
+import argparse
+import glob
+import json
+
+from pxutil.pxutil import TOKEN_APPROX_COEFFICIENTS, TOKEN_ENCODING, _APPROX_FEATURES, _approx_features, _get_encoder
+
+FEATURES = list(_APPROX_FEATURES)
+
+
+def read_samples(patterns, sample_chars):
+    """return list of text samples of about sample_chars characters, cut at whitespace"""
+    samples = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            while text:
+                cut = text.find(" ", sample_chars) if len(text) > sample_chars else -1
+                cut = len(text) if cut < 0 else cut
+                if text[:cut].strip():
+                    samples.append(text[:cut])
+                text = text[cut:]
+    return samples
+
+
+def solve(a, b):
+    """return x of a x = b by Gaussian elimination with partial pivoting, 0 for singular columns"""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            continue
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col and m[r][col]:
+                factor = m[r][col] / m[col][col]
+                m[r] = [x - factor * y for x, y in zip(m[r], m[col])]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+def fit(rows, counts):
+    """return non-negative least squares coefficients of rows of features to counts, weighted by 1/count
+
+    The weight fits the relative error rather than the absolute error of long samples.
+    Negative coefficients are dropped to 0 and the rest refitted, which keeps the estimate monotonic.
+    """
+    active = list(range(len(FEATURES)))
+    while True:
+        ata = [[0.0] * len(active) for _ in active]
+        atb = [0.0] * len(active)
+        for row, count in zip(rows, counts):
+            weight = 1.0 / max(count, 1) ** 2
+            x = [row[i] for i in active]
+            for i, xi in enumerate(x):
+                atb[i] += weight * xi * count
+                for j, xj in enumerate(x):
+                    ata[i][j] += weight * xi * xj
+        solution = solve(ata, atb)
+        if all(value >= 0 for value in solution):
+            coefficients = dict.fromkeys(FEATURES, 0.0)
+            coefficients.update({FEATURES[i]: round(value, 3) for i, value in zip(active, solution)})
+            return coefficients
+        active = [i for i, value in zip(active, solution) if value > 0]
+
+
+def errors(rows, counts, coefficients):
+    """return sorted relative errors of estimates of coefficients"""
+    return sorted(
+        abs(sum(coefficients[name] * row[i] for i, name in enumerate(FEATURES)) - count) / max(count, 1)
+        for row, count in zip(rows, counts)
+    )
+
+
+def error_summary(errs):
+    def q(p):
+        return errs[min(int(p * len(errs)), len(errs) - 1)] if errs else 0.0
+
+    return {
+        "mean": sum(errs) / len(errs) if errs else 0.0,
+        "p50": q(0.5),
+        "p95": q(0.95),
+        "max": errs[-1] if errs else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate token_counter_approx() against tiktoken counts.")
+    parser.add_argument("patterns", nargs="+", help="files or globs of the corpus, ** for subdirectories")
+    parser.add_argument("-e", "--encoding", default=TOKEN_ENCODING, help="tiktoken encoding to fit")
+    parser.add_argument("--sample-chars", type=int, default=2000, help="characters per sample (default: 2000)")
+    parser.add_argument("--json", action="store_true", help="print results in json")
+    args = parser.parse_args()
+
+    samples = read_samples(args.patterns, args.sample_chars)
+    if not samples:
+        parser.error("no text samples found")
+    encode = _get_encoder(args.encoding).encode_ordinary
+    counts = [len(encode(text)) for text in samples]
+    features = [_approx_features(text) for text in samples]
+    rows = [[f[name] for name in FEATURES] for f in features]
+
+    current = TOKEN_APPROX_COEFFICIENTS.get(args.encoding, TOKEN_APPROX_COEFFICIENTS[TOKEN_ENCODING])
+    fitted = fit(rows, counts)
+    result = {
+        "encoding": args.encoding,
+        "samples": len(samples),
+        "tokens": sum(counts),
+        "current": {"coefficients": current, "relative_error": error_summary(errors(rows, counts, current))},
+        "fitted": {"coefficients": fitted, "relative_error": error_summary(errors(rows, counts, fitted))},
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{args.encoding}: {result['samples']} samples, {result['tokens']} tokens")
+    print(f"{'coefficients':<14}{'mean':>8}{'p50':>8}{'p95':>8}{'max':>8}")
+    for name in ("current", "fitted"):
+        e = result[name]["relative_error"]
+        print(f"{name:<14}{e['mean']:>8.1%}{e['p50']:>8.1%}{e['p95']:>8.1%}{e['max']:>8.1%}")
+    print(f"\nTOKEN_APPROX_COEFFICIENTS[{args.encoding!r}] = {json.dumps(fitted)}")
+
+
+if __name__ == "__main__":
+    main()
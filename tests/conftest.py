@@ -0,0 +1,44 @@
+import pytest
+
+from .local_httpbin import LocalHttpbin
+
+
+@pytest.fixture(scope="session")
+def httpbin():
+    """local httpbin stand-in server, use httpbin.url as base url"""
+    with LocalHttpbin() as server:
+        yield server
+
+
+@pytest.fixture
+def chat_api(httpbin, monkeypatch):
+    """factory of ChatAPI talking to the local chat completions stand-in"""
+    import pxutil as px
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+
+    def make(**kwargs):
+        chat = px.ChatAPI(model=kwargs.pop("model", "gpt-test"), **kwargs)
+        chat.url = httpbin.url + "/v1/chat/completions"
+        return chat
+
+    return make
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    """small byte-level BPE encoding as the default tiktoken encoding, as o200k_base can't be downloaded offline"""
+    import tiktoken
+    import pxutil as px
+
+    ranks = {bytes([i]): i for i in range(256)}
+    for merge in (b"he", b"ll", b"hell", b"hello", b" w", b"or", b" wor", b"ld", b" world", b"\n\n"):
+        ranks[merge] = len(ranks)
+    encoding = tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+        mergeable_ranks=ranks,
+        special_tokens={},
+    )
+    monkeypatch.setattr(px.pxutil, "_token_encoders", {px.pxutil.TOKEN_ENCODING: encoding})
+    return encoding
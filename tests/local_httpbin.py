@@ -0,0 +1,239 @@
+"""
+Local stand-in of the httpbin.org endpoints used by the tests, to test and benchmark request()/post()
+without network access.
+
+Endpoints
+---------
+GET  /get                           echo args, headers and url in json
+POST /post (and PUT, PATCH, DELETE) echo args, headers, url, data and json in json
+GET  /cookies                       echo cookies in json
+GET  /cookies/set/<name>/<value>    set cookie and redirect to /cookies
+GET  /status/<code>                 respond with the status code and empty body
+GET  /bytes/<n>                     n bytes of binary data
+GET  /delay/<seconds>               /get after a delay
+GET  /stream/<n>                    n ndjson lines of /get
+GET  /cache/<seconds>               /get with Cache-Control max-age and ETag, 304 if If-None-Match matches
+GET  /drip?numbytes=<n>&duration=<s> n bytes of "*" trickled in evenly over duration seconds, like httpbin.org
+POST /v1/chat/completions           OpenAI compatible chat completions (incl. stream), answer 'echo: <question>'
+                                    with x-ratelimit-* headers, ?ratelimited=<n> responds 429 to the first n hits,
+                                    ?delay=<seconds> delays the response
+
+usage:
+# in tests
+with LocalHttpbin() as httpbin:
+    px.request("GET", httpbin.url + "/get")
+
+# standalone
+python -m tests.local_httpbin --port 8080
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class HttpbinHandler(BaseHTTPRequestHandler):
+    # keep-alive connections as httpbin.org
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid 40ms delayed ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+    # counter of requests by path, e.g. to check retries
+    hits = {}
+    hits_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        # silent
+        pass
+
+    def _send(self, status=200, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_json(self, obj, status=200, headers=None):
+        self._send(status, json.dumps(obj, indent=2).encode("utf-8"), headers=headers)
+
+    def _echo(self, body=b""):
+        parts = urlsplit(self.path)
+        echo = {
+            "args": {k: v[0] if len(v) == 1 else v for k, v in parse_qs(parts.query).items()},
+            "headers": dict(self.headers.items()),
+            "origin": self.client_address[0],
+            "url": f"http://{self.headers.get('Host')}{self.path}",
+        }
+        if self.command not in ("GET", "HEAD"):
+            data = body.decode("utf-8", errors="replace")
+            try:
+                parsed = json.loads(data)
+            except ValueError:
+                parsed = None
+            echo.update(data=data, json=parsed)
+        return echo
+
+    def _route(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = urlsplit(self.path).path
+        parts = path.strip("/").split("/")
+        with self.hits_lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+
+        if path == "/get" and self.command in ("GET", "HEAD"):
+            return self._send_json(self._echo())
+        if path in ("/post", "/put", "/patch", "/delete") and self.command == path[1:].upper():
+            return self._send_json(self._echo(body))
+        if path == "/cookies":
+            cookies = {}
+            for item in self.headers.get("Cookie", "").split(";"):
+                name, _, value = item.strip().partition("=")
+                if name:
+                    cookies[name] = value
+            return self._send_json({"cookies": cookies})
+        if parts[:2] == ["cookies", "set"] and len(parts) == 4:
+            headers = {"Set-Cookie": f"{parts[2]}={parts[3]}; Path=/", "Location": "/cookies"}
+            return self._send(302, headers=headers)
+        if parts[0] == "status" and len(parts) == 2:
+            return self._send(int(parts[1]))
+        if parts[0] == "bytes" and len(parts) == 2:
+            n = int(parts[1])
+            return self._send(body=(bytes(range(256)) * (n // 256 + 1))[:n], content_type="application/octet-stream")
+        if parts[0] == "delay" and len(parts) == 2:
+            time.sleep(float(parts[1]))
+            return self._send_json(self._echo())
+        if parts[0] == "stream" and len(parts) == 2:
+            lines = [json.dumps(dict(self._echo(), id=i)) for i in range(int(parts[1]))]
+            return self._send(body="\n".join(lines).encode("utf-8"), content_type="application/x-ndjson")
+        if parts[0] == "cache" and len(parts) == 2:
+            headers = {"Cache-Control": f"max-age={parts[1]}", "ETag": '"pxutil"'}
+            if self.headers.get("If-None-Match") == '"pxutil"':
+                return self._send(304, headers=headers)
+            return self._send_json(self._echo(), headers=headers)
+        if path == "/drip":
+            query = parse_qs(urlsplit(self.path).query)
+            numbytes = int(query.get("numbytes", ["10"])[0])
+            interval = float(query.get("duration", ["2"])[0]) / max(numbytes, 1)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(numbytes))
+            self.end_headers()
+            for _ in range(numbytes):
+                time.sleep(interval)
+                try:
+                    self.wfile.write(b"*")
+                    self.wfile.flush()
+                except OSError:
+                    # client went away
+                    break
+            return
+        if path == "/v1/chat/completions" and self.command == "POST":
+            return self._chat_completions(json.loads(body), parse_qs(urlsplit(self.path).query))
+        return self._send_json({"error": f"{self.command} {path} not found"}, 404)
+
+    def _chat_completions(self, payload, query):
+        """OpenAI compatible chat completions, answer 'echo: <last user message>'"""
+        with self.hits_lock:
+            if self.path != self.path.split("?")[0]:
+                # count by path with query too, e.g. to respond 429 per test
+                self.hits[self.path] = self.hits.get(self.path, 0) + 1
+            count = self.hits[self.path]
+        if count <= int(query.get("ratelimited", ["0"])[0]):
+            # OpenAI tells the delay by x-ratelimit-reset-* without Retry-After
+            headers = {
+                "x-ratelimit-limit-requests": "600",
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "50ms",
+            }
+            return self._send_json({"error": {"message": "Rate limit reached", "type": "requests"}}, 429, headers)
+        if "delay" in query:
+            time.sleep(float(query["delay"][0]))
+        rate_headers = {
+            "x-ratelimit-limit-requests": "10000",
+            "x-ratelimit-remaining-requests": str(max(10000 - count, 0)),
+            "x-ratelimit-reset-requests": "6ms",
+        }
+        question = payload["messages"][-1]["content"]
+        answer = f"echo: {question}"
+        prompt_tokens = sum(len(m["content"].split()) for m in payload["messages"])
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(answer.split()),
+            "total_tokens": prompt_tokens + len(answer.split()),
+        }
+        base = {"id": "chatcmpl-local", "created": int(time.time()), "model": payload["model"]}
+        if not payload.get("stream"):
+            choice = {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+            return self._send_json(
+                dict(base, object="chat.completion", usage=usage, choices=[choice]), headers=rate_headers
+            )
+
+        events = []
+        for i, word in enumerate(answer.split(" ")):
+            delta = {"content": word if i == 0 else " " + word}
+            events.append(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+        events.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            events.append(dict(base, choices=[], usage=usage))
+        for event in events:
+            event["object"] = "chat.completion.chunk"
+        # raw utf-8 like OpenAI, without a charset in Content-Type
+        body = "".join(f"data: {json.dumps(e, ensure_ascii=False)}\n\n" for e in events) + "data: [DONE]\n\n"
+        return self._send(body=body.encode("utf-8"), content_type="text/event-stream", headers=rate_headers)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _route
+
+
+class _HttpbinServer(ThreadingHTTPServer):
+    # accept bursts of concurrent connections, the default listen backlog of 5 drops SYNs to retry in 1s
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class LocalHttpbin:
+    """run the local httpbin server in a background thread
+
+    url: base url, e.g. http://127.0.0.1:54321
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = _HttpbinServer((host, port), HttpbinHandler)
+        self.url = f"http://{host}:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def hits(self, path):
+        """return number of requests to path, e.g. /status/503"""
+        return HttpbinHandler.hits.get(path, 0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local httpbin stand-in server")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="port (default: 8080)")
+    args = parser.parse_args()
+    httpbin = LocalHttpbin(port=args.port)
+    print(f"Serving httpbin stand-in at {httpbin.url}, ctrl+c to exit.")
+    try:
+        httpbin.server.serve_forever()
+    except KeyboardInterrupt:
+        httpbin.server.server_close()
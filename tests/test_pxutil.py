@@ -23,6 +23,7 @@ import pytest
 import os.path as osp
 import json
 import time
+import threading
 
 
 def test_bash():
@@ -282,3 +283,1072 @@ def test_read_dotenv():
 
 def test_token_counter():
     assert px.token_counter("hello world") == 2
+
+
+def test_session_pool():
+    from pxutil import SessionPool
+
+    pool = SessionPool(max_per_host=2, idle_timeout=60)
+    s1 = pool.acquire("https://example.com/a")
+    s2 = pool.acquire("https://EXAMPLE.com/b?x=1")
+    s3 = pool.acquire("http://example.com/a")
+    assert s1 is s2
+    assert s1 is not s3
+    assert pool.stats()["https://example.com"]["in_use"] == 2
+
+    # pooled sessions don't keep cookies between calls
+    assert s1.cookies.get_policy().set_ok(None, None) is False
+
+    for url in ("https://example.com/a", "https://example.com/b", "http://example.com/a"):
+        pool.release(url)
+
+    # idle sessions are evicted, but in use sessions never
+    pool.idle_timeout = 0
+    s4 = pool.acquire("https://other.com")
+    assert pool.evict_idle() == 0
+    assert list(pool.stats()) == ["https://other.com"]
+    assert pool.acquire("https://other.com") is s4
+
+    pool.close()
+    assert pool.stats() == {}
+
+
+def test_session_pool_concurrency(httpbin):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the default pool doesn't cap concurrent calls to a host to max_per_host
+    url = httpbin.url + "/delay/0.3"
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(lambda _: px.request("GET", url), range(20)))
+    assert all(isinstance(r, dict) for r in results)
+    assert time.perf_counter() - start < 0.55
+
+    # a blocking pool waits for a free connection no longer than the connect timeout
+    pool = px.SessionPool(max_per_host=1, block=True)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda _: px.request("GET", url, session=pool, timeout=(0.1, 5)), range(2)))
+    assert sum(isinstance(r, Exception) for r in results) == 1
+    assert time.perf_counter() - start < 0.55
+    pool.close()
+
+
+def test_arequest():
+    import asyncio
+
+    async def main():
+        sem = asyncio.Semaphore(2)
+        # nothing listens on port 1, connection refused is returned as Exception
+        return await asyncio.gather(
+            *(px.arequest("GET", "http://127.0.0.1:1", semaphore=sem) for _ in range(3)),
+            px.apost("http://127.0.0.1:1", data="{}"),
+        )
+
+    results = asyncio.run(main())
+    assert len(results) == 4
+    assert all(isinstance(r, Exception) for r in results)
+
+
+def test_arequest_concurrency(httpbin):
+    import asyncio
+
+    # more concurrent calls than max_per_host of the default pool finish in about one delay
+    async def main():
+        sem = asyncio.Semaphore(40)
+        return await asyncio.gather(*(px.arequest("GET", httpbin.url + "/delay/0.3", semaphore=sem) for _ in range(40)))
+
+    start = time.perf_counter()
+    results = asyncio.run(main())
+    assert all(isinstance(r, dict) for r in results)
+    assert time.perf_counter() - start < 0.6
+
+
+def test_request_many():
+    # nothing listens on port 1, connection refused is returned as Exception per spec
+    specs = [
+        "http://127.0.0.1:1/a",
+        ("POST", "http://127.0.0.1:1/b"),
+        {"method": "GET", "url": "http://127.0.0.1:1/c", "timeout": 1},
+        {"method": "GET"},  # invalid spec without url
+    ]
+    results = px.request_many(specs, max_workers=2, max_per_host=1, timeout=1)
+    assert len(results) == 4
+    assert all(isinstance(r, Exception) for r in results)
+    assert "invalid request spec" in str(results[3])
+
+    results = px.request_many(specs, ordered=False)
+    assert sorted(i for i, _ in results) == [0, 1, 2, 3]
+
+
+def test_iter_stream():
+    from pxutil.pxutil import _iter_stream, ResponseStream
+
+    class FakeResponse:
+        encoding = None
+        headers = {}
+        closed = False
+
+        def iter_content(self, chunk_size):
+            body = b'{"a": 1}\r\n{"b": 2}\n\n{"c": 3}'
+            return (body[i : i + chunk_size] for i in range(0, len(body), chunk_size))
+
+        def close(self):
+            self.closed = True
+
+    resp = FakeResponse()
+    closed = []
+    events = ResponseStream(resp, "ndjson", 3, on_close=lambda: closed.append(1))
+    assert list(events) == [{"a": 1}, {"b": 2}, {"c": 3}]
+    assert resp.closed and closed == [1]
+    events.close()
+    assert closed == [1]
+
+    lines = list(_iter_stream(FakeResponse(), "lines", 4))
+    assert lines == ['{"a": 1}', '{"b": 2}', "", '{"c": 3}']
+    assert b"".join(_iter_stream(FakeResponse(), "chunks", 5)).startswith(b'{"a"')
+
+
+def test_pretty_print_request_json():
+    import logging
+    import requests
+    from pxutil.pxutil import pretty_print_request_json
+
+    class CountingRequest:
+        """prepared request stub counting body reads"""
+
+        method = "POST"
+        url = "http://example.com"
+        headers = {"Content-Type": "application/json"}
+        reads = 0
+
+        @property
+        def body(self):
+            self.reads += 1
+            return '{"a": "' + "x" * 100 + '"}'
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    logger = logging.getLogger("test_pretty_print_request_json")
+    handler = ListHandler()
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    # nothing is formatted above DEBUG level
+    logger.setLevel(logging.INFO)
+    req = CountingRequest()
+    pretty_print_request_json(req, logger)
+    assert req.reads == 0 and handler.messages == []
+
+    # body is truncated to max_body
+    logger.setLevel(logging.DEBUG)
+    pretty_print_request_json(req, logger, max_body=20)
+    assert req.reads == 1
+    assert "more truncated>" in handler.messages[0]
+    assert "x" * 100 not in handler.messages[0]
+
+    # small multipart binary body is decoded with raw data replaced
+    prepared = requests.Request(
+        "POST", "http://example.com", files={"f": ("a.bin", b"\xff\xfe")}
+    ).prepare()
+    pretty_print_request_json(prepared, logger)
+    assert "<binary raw data>" in handler.messages[1]
+    logger.removeHandler(handler)
+
+
+def test_json_codec():
+    from pxutil.pxutil import pretty_json
+
+    for data in ('{"a": [1, "b"]}', b'{"a": [1, "b"]}', memoryview(b'{"a": [1, "b"]}')):
+        assert px.json_loads(data) == {"a": [1, "b"]}
+    with pytest.raises(ValueError):
+        px.json_loads("not json")
+
+    assert json.loads(px.json_dumps({"a": "é/"})) == {"a": "é/"}
+    assert px.json_dumps({"a": 1}, as_bytes=True) == b'{"a":1}'
+    # non-str keys fall back to stdlib json
+    assert json.loads(px.json_dumps({1: 2})) == {"1": 2}
+
+    assert json.loads(pretty_json('{"a":1}')) == {"a": 1}
+    assert "\n" in pretty_json('{"a":1}')
+    assert pretty_json(b"\xff") == b"\xff"
+
+
+def test_retry_policy():
+    from pxutil import RetryPolicy
+
+    retry = RetryPolicy(total=2, backoff_factor=1, backoff_max=3, jitter=False)
+    assert retry.is_retry("GET", 0) and retry.is_retry("PUT", 1, 503)
+    assert not retry.is_retry("GET", 2, 503)
+    assert not retry.is_retry("GET", 0, 404)
+    assert [retry.backoff(n) for n in range(4)] == [1, 2, 3, 3]
+    assert retry.backoff(0, "2") == 2
+    assert retry.backoff(0, "100") == 3
+    assert retry.backoff(0, "Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert retry.backoff(0, "invalid") == 1
+
+    assert not RetryPolicy(methods=("GET",)).is_retry("PUT", 0)
+    # non-idempotent methods are retried only if the request was not sent, unless methods is None
+    assert not retry.is_retry("POST", 0) and not retry.is_retry("PATCH", 0, 503)
+    assert retry.is_retry("POST", 0, sent=False)
+    assert RetryPolicy(methods=None).is_retry("POST", 0, 503)
+    assert 0 <= RetryPolicy(backoff_factor=1).backoff(3) <= 8
+
+
+def test_circuit_breaker():
+    from pxutil import CircuitBreaker
+
+    url = "https://example.com/a"
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    assert breaker.allow(url) and breaker.state(url) == "closed"
+    breaker.record_failure(url)
+    breaker.record_success(url)
+    breaker.record_failure(url)
+    assert breaker.state(url) == "closed"
+    breaker.record_failure(url)
+    assert breaker.state(url) == "open"
+    assert not breaker.allow("https://example.com/b")
+    # other hosts are not impacted
+    assert breaker.allow("https://other.com")
+
+    # one trial request after reset_timeout
+    time.sleep(0.06)
+    assert breaker.allow(url) and breaker.state(url) == "half_open"
+    assert not breaker.allow(url)
+    breaker.record_failure(url)
+    assert breaker.state(url) == "open"
+    time.sleep(0.06)
+    assert breaker.allow(url)
+    breaker.record_success(url)
+    assert breaker.state(url) == "closed"
+    assert breaker.stats()["https://example.com"]["fast_fails"] == 2
+
+    # request() fails fast without sending the request
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    assert isinstance(px.request("GET", "http://127.0.0.1:1", circuit_breaker=breaker), Exception)
+    result = px.request("GET", "http://127.0.0.1:1", circuit_breaker=breaker)
+    assert "circuit breaker is open" in str(result)
+
+    # trial request failed by other errors opens the circuit again, instead of staying half open
+    import requests
+
+    class BrokenSession:
+        def request(self, *args, **kwargs):
+            raise requests.exceptions.ChunkedEncodingError("broken chunk")
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure(url)
+    time.sleep(0.06)
+    assert isinstance(px.request("GET", url, session=BrokenSession(), circuit_breaker=breaker), Exception)
+    assert breaker.state(url) == "open"
+    # a lost trial request without result lets another trial through after reset_timeout
+    time.sleep(0.06)
+    assert breaker.allow(url) and not breaker.allow(url)
+    time.sleep(0.06)
+    assert breaker.allow(url)
+
+
+def test_response_cache():
+    import tempfile
+    import requests
+    from pxutil import ResponseCache
+
+    def make_response(headers, content=b'{"a": 1}', status_code=200):
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp._content = content
+        resp.headers.update(headers)
+        resp.url = "https://example.com/config"
+        return resp
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = ResponseCache(cache_dir=temp_dir)
+        key = cache.key("GET", "https://example.com/config", params={"b": 1})
+        assert key.startswith("GET https://example.com/config?b=1")
+
+        # fresh by max-age
+        cache.store(key, make_response({"Cache-Control": "max-age=60"}))
+        entry = cache.get(key)
+        assert cache.is_fresh(entry) and entry["content"] == b'{"a": 1}'
+
+        # no-store is not stored, stale without validators is not stored either
+        cache.delete(key)
+        cache.store(key, make_response({"Cache-Control": "no-store"}))
+        cache.store(key, make_response({}))
+        assert cache.get(key) is None
+
+        # no-cache with ETag is stored and revalidated
+        cache.store(key, make_response({"Cache-Control": "no-cache", "ETag": '"v1"'}))
+        entry = cache.get(key)
+        assert not cache.is_fresh(entry)
+        assert cache.validators(entry) == {"If-None-Match": '"v1"'}
+        entry = cache.refresh(key, entry, make_response({"Cache-Control": "max-age=60"}, b"", 304))
+        assert cache.is_fresh(entry) and entry["etag"] == '"v1"'
+
+        # on-disk tier is shared by a new cache instance
+        entry = ResponseCache(cache_dir=temp_dir).get(key)
+        assert entry["content"] == b'{"a": 1}' and entry["etag"] == '"v1"'
+        assert cache.stats()["revalidated"] == 1
+
+
+def test_request_metrics():
+    from pxutil import RequestMetrics
+
+    metrics = RequestMetrics()
+    assert not metrics.enabled
+    url = "https://example.com/a"
+    for seconds in (0.01, 0.02, 0.2):
+        timings = {"connect": 0, "ttfb": seconds, "download": 0.001, "decode": 0.001, "total": seconds}
+        metrics.record(url, "get", 200, 100, timings)
+    metrics.record(url, "GET", "error", 0, {"total": 1.0})
+
+    snapshot = metrics.snapshot()["https://example.com GET"]
+    assert snapshot["status"] == {"200": 3, "error": 1}
+    assert snapshot["bytes"] == 300
+    assert snapshot["ttfb"]["count"] == 3 and snapshot["total"]["count"] == 4
+    assert 0.01 <= snapshot["ttfb"]["p50"] <= 0.025
+    assert snapshot["ttfb"]["max"] == 0.2
+    assert json.loads(metrics.to_json())["https://example.com GET"]["bytes"] == 300
+
+    text = metrics.to_prometheus()
+    assert 'pxutil_request_total{host="https://example.com",method="GET",status="200"} 3' in text
+    assert 'phase="ttfb",le="+Inf"} 3' in text
+
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_request_local(httpbin):
+    """test request against local httpbin stand-in, same as manual test_request"""
+    from pxutil import request
+    import requests
+
+    # Test GET request
+    get_url = httpbin.url + "/get"
+    response = request("GET", get_url)
+    assert isinstance(response, dict)
+    assert response["url"] == get_url
+    assert request("GET", get_url, headers=None)["url"] == get_url
+
+    # Test POST request with JSON data and headers
+    post_url = httpbin.url + "/post"
+    json_data = {"key": "value"}
+    headers = {"My-Header": "value"}
+    response = request("POST", post_url, data=json.dumps(json_data), headers=headers)
+    assert response["json"] == json_data
+    assert response["headers"]["My-Header"] == "value"
+    assert response["headers"]["Content-Type"] == "application/json"
+
+    # Test session with cookies
+    session = requests.Session()
+    set_cookie_url = httpbin.url + "/cookies/set/sessioncookie/123456789"
+    response = request("GET", set_cookie_url, session=session, allow_redirects=False)
+    assert isinstance(response, Exception) is False
+    response = request("GET", httpbin.url + "/cookies", session=session)
+    assert response == {"cookies": {"sessioncookie": "123456789"}}
+
+    # pooled sessions don't keep cookies between calls
+    request("GET", set_cookie_url, allow_redirects=False)
+    assert request("GET", httpbin.url + "/cookies") == {"cookies": {}}
+
+    # error response code and binary body
+    assert isinstance(request("GET", httpbin.url + "/status/404"), Exception)
+    assert request("GET", httpbin.url + "/status/204") == ""
+    assert len(request("GET", httpbin.url + "/bytes/1000")) > 0
+
+
+def test_post_local(httpbin):
+    """test post with json= and bytes body"""
+    response = px.post(httpbin.url + "/post", json={"key": "value"})
+    assert response["json"] == {"key": "value"}
+    assert response["headers"]["Content-Type"] == "application/json"
+
+    response = px.post(httpbin.url + "/post", data=b"plain text")
+    assert response["data"] == "plain text"
+    assert "Content-Type" not in response["headers"]
+
+
+def test_request_features_local(httpbin):
+    """test stream, retry, cache and request_many against local httpbin stand-in"""
+    # stream ndjson
+    events = px.request("GET", httpbin.url + "/stream/5", stream=True, stream_as="ndjson")
+    assert [e["id"] for e in events] == [0, 1, 2, 3, 4]
+    assert isinstance(px.request("GET", httpbin.url + "/status/500", stream=True), Exception)
+
+    # stream not consumed releases its pooled session when closed or dropped, even if never started
+    import gc
+
+    pool = px.SessionPool()
+    key = pool.host_key(httpbin.url)
+    with px.request("GET", httpbin.url + "/stream/5", stream=True, session=pool) as lines:
+        assert pool._entries[key][1] == 1
+        next(lines)
+    assert lines.closed and pool._entries[key][1] == 0
+    lines = px.request("GET", httpbin.url + "/stream/5", stream=True, session=pool)
+    assert pool._entries[key][1] == 1
+    del lines
+    gc.collect()
+    assert pool._entries[key][1] == 0
+
+    # retry 503
+    retry = px.RetryPolicy(total=2, backoff_factor=0.01)
+    assert isinstance(px.request("GET", httpbin.url + "/status/503", retry=retry), Exception)
+    assert httpbin.hits("/status/503") == 3
+    assert isinstance(px.request("POST", httpbin.url + "/status/503", retry=retry), Exception)
+    assert httpbin.hits("/status/503") == 4
+
+    # cache with revalidation
+    cache = px.ResponseCache()
+    for _ in range(3):
+        response = px.request("GET", httpbin.url + "/cache/60", cache=cache)
+        assert response["url"].endswith("/cache/60")
+    assert httpbin.hits("/cache/60") == 1
+    for _ in range(2):
+        px.request("GET", httpbin.url + "/cache/0", cache=cache)
+    assert cache.stats()["revalidated"] == 1
+
+    # batch in input order
+    specs = [httpbin.url + "/delay/0.05", ("POST", httpbin.url + "/post"), httpbin.url + "/status/404"]
+    results = px.request_many(specs, max_per_host=2)
+    assert results[0]["url"].endswith("/delay/0.05")
+    assert results[1]["url"].endswith("/post")
+    assert isinstance(results[2], Exception)
+
+
+def test_chat_api(chat_api):
+    chat = chat_api(max_chat_history=1)
+    assert chat.chat("hello") == "echo: hello"
+    assert chat.chat_history[-1] == {"role": "assistant", "content": "echo: hello"}
+
+    # stream deltas, history is recorded at the end
+    deltas = chat.chat_stream("how are you")
+    assert not isinstance(deltas, Exception)
+    assert list(deltas) == ["echo:", " how", " are", " you"]
+    assert chat.chat_history[-1] == {"role": "assistant", "content": "echo: how are you"}
+    assert len(chat.chat_history) == 4
+    # only max_chat_history chats are sent
+    assert len(chat._build_messages("next")) == 4
+    # raw utf-8 of server-sent events without charset
+    assert "".join(chat.chat_stream("你好")) == "echo: 你好"
+
+    chat.url += "/not_found"
+    assert isinstance(chat.chat_stream("hello"), Exception)
+
+
+def test_chat_many(chat_api):
+    import asyncio
+
+    chat = chat_api()
+    questions = [f"q{i}" for i in range(20)]
+    answers = chat.chat_many(questions, max_workers=12)
+    assert answers == [f"echo: q{i}" for i in range(20)]
+    # independent questions don't touch chat history
+    assert chat.chat_history == []
+
+    results = dict(chat.chat_many(questions[:5], ordered=False))
+    assert results[4] == "echo: q4"
+
+    answers = asyncio.run(chat.achat_many(questions, limit=4))
+    assert answers[19] == "echo: q19"
+    assert asyncio.run(chat.achat("hi")) == "echo: hi"
+    assert len(chat.chat_history) == 2
+
+    # concurrent achat() calls take turns, each one is asked with the chats before
+    async def ask_all():
+        return await asyncio.gather(*(chat.achat(f"a{i}") for i in range(4)))
+
+    chat = chat_api(max_chat_history=10)
+    chat.url += "?delay=0.05"
+    start = time.perf_counter()
+    assert sorted(asyncio.run(ask_all())) == [f"echo: a{i}" for i in range(4)]
+    assert time.perf_counter() - start >= 0.2
+    history = [m["content"] for m in chat.chat_history]
+    assert history[1::2] == ["echo: " + question for question in history[::2]]
+
+    chat.url += "/not_found"
+    assert all(isinstance(a, Exception) for a in chat.chat_many(questions[:3]))
+
+
+def test_chat_cache(chat_api, httpbin, tmp_path):
+    from pxutil import ChatCache
+
+    cache = ChatCache(cache_dir=tmp_path)
+    chat = chat_api(cache=cache, remember_chat_history=False, chat_params={"temperature": 0})
+    calls = httpbin.hits("/v1/chat/completions")
+    assert chat.chat("cached question") == "echo: cached question"
+    assert chat.chat("cached question") == "echo: cached question"
+    assert "".join(chat.chat_stream("cached question")) == "echo: cached question"
+    assert httpbin.hits("/v1/chat/completions") == calls + 1
+    assert cache.stats()["hits"] == 2
+
+    # on-disk tier survives a new cache, e.g. a rerun after crash
+    chat = chat_api(cache=ChatCache(cache_dir=tmp_path), remember_chat_history=False, chat_params={"temperature": 0})
+    assert chat.chat_many(["cached question"]) == ["echo: cached question"]
+    assert httpbin.hits("/v1/chat/completions") == calls + 1
+
+    # different parameters or model miss the cache
+    chat.chat_params = {"temperature": 1}
+    chat.chat("cached question")
+    assert httpbin.hits("/v1/chat/completions") == calls + 2
+
+    # expired by ttl
+    key = ChatCache.key("gpt-test", [{"role": "user", "content": "q"}])
+    cache = ChatCache(ttl=0.01)
+    cache.set(key, {"answer": "a", "message": {"role": "assistant", "content": "a"}})
+    assert cache.get(key)["answer"] == "a"
+    time.sleep(0.02)
+    assert cache.get(key) is None
+
+
+def test_chat_history_token_budget(chat_api, monkeypatch):
+    counted = []
+
+    def word_counter(text):
+        counted.append(text)
+        return len(text.split())
+
+    monkeypatch.setattr(px.pxutil, "token_counter", word_counter)
+
+    # each chat is 2 + 4 and 3 + 4 tokens, i.e., 13 tokens
+    chat = chat_api(system_msg="", max_chat_history=100, max_history_tokens=30)
+    for i in range(5):
+        chat.chat(f"q {i}")
+    messages = chat._build_messages("next")
+    # 2 latest chats within 30 tokens + question
+    assert [m["content"] for m in messages] == ["q 3", "echo: q 3", "q 4", "echo: q 4", "next"]
+    # each message is counted once
+    assert len(counted) == 10
+    assert len(chat.chat_history) == 10
+
+    # trimmed chats are summarized into a system message
+    chat = chat_api(system_msg="", max_chat_history=100, max_history_tokens=20, summarize_history=True)
+    chat.chat("my name is px")
+    chat.chat("what is my name")
+    assert chat.history_summary.startswith("echo: Summarize")
+    messages = chat._build_messages("next")
+    assert messages[0]["role"] == "system" and "my name is px" in messages[0]["content"]
+    assert [m["content"] for m in messages[1:]] == ["what is my name", "echo: what is my name", "next"]
+
+    # the budget applies to the chats within max_chat_history, older ones are dropped without a summary call
+    chat = chat_api(system_msg="", max_chat_history=2, max_history_tokens=26, summarize_history=True)
+    for i in range(3):
+        chat.chat(f"q {i}")
+    assert chat.history_summary == "" and chat.usage.summary()["models"]["gpt-test"]["calls"] == 3
+    assert [m["content"] for m in chat._build_messages("next")] == ["q 1", "echo: q 1", "q 2", "echo: q 2", "next"]
+
+
+def test_chat_usage(chat_api):
+    chat = chat_api(system_msg="")
+    chat.chat("one two")
+    last = chat.usage.last
+    assert last["prompt_tokens"] == 2 and last["completion_tokens"] == 3
+    assert last["wall_time"] > 0 and last["ttft"] is None and last["tokens_per_second"] > 0
+
+    "".join(chat.chat_stream("three"))
+    last = chat.usage.last
+    assert last["ttft"] is not None and last["ttft"] <= last["wall_time"]
+    assert last["completion_tokens"] == 2
+
+    summary = chat.usage.summary()
+    assert summary["calls"] == 2 and summary["completion_tokens"] == 5
+    assert summary["models"]["gpt-test"]["latency"]["count"] == 2
+    assert summary["models"]["gpt-test"]["ttft"]["count"] == 1
+    assert json.loads(chat.usage.to_json())["calls"] == 2
+    assert "tokens/s" in chat.usage.footer()
+    assert chat.usage.latency_quantile("gpt-test", 0.95) > 0
+
+    chat.url += "/not_found"
+    chat.chat("fail")
+    assert chat.usage.summary()["errors"] == 1
+
+
+def test_chat_rate_limiter(chat_api):
+    limiter = px.ChatRateLimiter()
+    key = limiter.key("https://api.openai.com/v1/chat/completions", "gpt-test")
+    assert key == "api.openai.com/gpt-test"
+    # unknown limits, no wait
+    assert limiter.acquire(key, 100) == 0
+    assert not limiter.tracks_tokens(key)
+
+    limiter.update(
+        key,
+        {
+            "x-ratelimit-limit-requests": "600",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-limit-tokens": "60000",
+            "x-ratelimit-remaining-tokens": "60000",
+        },
+    )
+    assert limiter.tracks_tokens(key)
+    # 600 rpm refills 10 requests/sec, the first call waits ~0.1s and the second ~0.2s in the queue
+    start = time.perf_counter()
+    limiter.acquire(key, 10)
+    limiter.acquire(key, 10)
+    assert 0.2 <= time.perf_counter() - start < 1
+    limiter.settle(key, 10, 50)
+    stats = limiter.stats()[key]
+    assert stats["waits"] == 2 and stats["requests_limit"] == 600
+    assert stats["tokens_limit"] == 60000 and stats["tokens_available"] <= 60000
+
+    assert px.pxutil._parse_duration("6m0s") == 360
+    assert px.pxutil._parse_duration("1h2m3.5s") == 3723.5
+    assert px.pxutil._parse_duration("20ms") == 0.02
+    assert limiter.retry_delay({"x-ratelimit-reset-requests": "50ms", "x-ratelimit-reset-tokens": "1s"}) == 1
+
+    # 429 is retried after x-ratelimit-reset-* of the response
+    limiter = px.ChatRateLimiter()
+    chat = chat_api(system_msg="", rate_limiter=limiter)
+    chat.url += "?ratelimited=2&id=chat_rate_limiter"
+    start = time.perf_counter()
+    assert chat.chat("hi") == "echo: hi"
+    assert time.perf_counter() - start >= 0.1
+    stats = limiter.stats()["%s/gpt-test" % chat.url.split("/")[2]]
+    assert stats["throttled"] == 2 and stats["requests_limit"] == 10000
+
+
+def test_chat_no_retry(chat_api, byte_encoding):
+    # retry=0 is not replaced by the default retry policy, and the failed call returns its reserved tokens
+    limiter = px.ChatRateLimiter()
+    chat = chat_api(system_msg="", rate_limiter=limiter, retry=0)
+    chat.url += "?ratelimited=1&id=chat_no_retry"
+    key = limiter.key(chat.url, "gpt-test")
+    limiter.update(key, {"x-ratelimit-limit-tokens": "60", "x-ratelimit-remaining-tokens": "60"})
+    assert isinstance(chat.chat("hello world " * 10), Exception)
+    assert limiter.stats()[key]["tokens_available"] == 60
+    assert chat.chat("hello world") == "echo: hello world"
+
+    # a stream stopped early or never started settles its reservation without the max tokens of the answer
+    limiter = px.ChatRateLimiter()
+    chat = chat_api(system_msg="", rate_limiter=limiter, chat_params={"max_tokens": 500})
+    key = limiter.key(chat.url, "gpt-test")
+    limiter.update(key, {"x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "1000"})
+    deltas = chat.chat_stream("hello world")
+    assert next(deltas) == "echo:"
+    deltas.close()
+    assert limiter.stats()[key]["tokens_available"] > 900
+    deltas = chat.chat_stream("hello world")
+    del deltas
+    import gc
+
+    gc.collect()
+    assert limiter.stats()[key]["tokens_available"] > 900
+
+
+def test_chat_session_log(chat_api, tmp_path):
+    log = px.ChatSessionLog("ops", session_dir=str(tmp_path), fsync=False)
+    chat = chat_api(system_msg="", max_chat_history=2, history_log=log)
+    for i in range(3):
+        chat.chat(f"q{i}")
+    assert len(log) == 6
+    assert log.tail(2) == [{"role": "user", "content": "q2"}, {"role": "assistant", "content": "echo: q2"}]
+    assert [m["content"] for m in log][:2] == ["q0", "echo: q0"]
+
+    # resume the last max_chat_history chats
+    chat = chat_api(system_msg="", max_chat_history=2, history_log=px.ChatSessionLog("ops", str(tmp_path)))
+    assert [m["content"] for m in chat.chat_history] == ["q1", "echo: q1", "q2", "echo: q2"]
+
+    # crash: torn last line and index behind the log
+    with open(log.path, "ab") as f:
+        f.write(b'{"ts": 1, "role": "user", "content": "q3"}\n{"ts": 1, "role": "assis')
+    with open(log.index_path, "r+b") as f:
+        f.truncate(8 * 4 + 3)
+    log = px.ChatSessionLog("ops", session_dir=str(tmp_path))
+    assert len(log) == 7
+    assert log.tail(1) == [{"role": "user", "content": "q3"}]
+    log.append([{"role": "assistant", "content": "a3"}])
+    assert log.tail(3)[0]["content"] == "echo: q2" and log.tail(1)[0]["content"] == "a3"
+    assert os.path.getsize(log.index_path) == 8 * 8
+
+    with pytest.raises(ValueError):
+        px.ChatSessionLog("../ops", session_dir=str(tmp_path))
+
+
+def test_chat_batch(chat_api, tmp_path):
+    import argparse
+    from pxutil.cli import chat_batch
+
+    from pxutil.cli import _batch_prompt_id
+
+    # ids default to a hash of the prompt, repeats are numbered
+    seen = {}
+    a, c, c2 = (_batch_prompt_id(prompt, seen) for prompt in ("a", "c", "c"))
+    assert len(a) == 16 and c2 == c + "-2"
+
+    prompts = tmp_path / "prompts.txt"
+    prompts.write_text('a\n\n{"id": "x", "prompt": "b"}\nc\n{"prompt": "c"}\n')
+    output = tmp_path / "out.jsonl"
+    # interrupted run: c answered, a failed, x torn
+    output.write_text(
+        f'{{"id": "{c}", "prompt": "c", "answer": "echo: c"}}\n'
+        f'{{"id": "{a}", "prompt": "a", "error": "failed"}}\n'
+        '{"id": "x", "pro'
+    )
+    args = argparse.Namespace(
+        batch=str(prompts), jobs=4, output=str(output), unordered=False, quick=False, stats=False
+    )
+    assert chat_batch(chat_api(system_msg=""), args) == 0
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    # the error record is replaced by the answer asked again
+    assert records == [
+        {"id": c, "prompt": "c", "answer": "echo: c"},
+        {"id": a, "prompt": "a", "answer": "echo: a"},
+        {"id": "x", "prompt": "b", "answer": "echo: b"},
+        {"id": c2, "prompt": "c", "answer": "echo: c"},
+    ]
+
+
+def test_chat_failover_and_hedging(chat_api, httpbin, byte_encoding):
+    chat_url = httpbin.url + "/v1/chat/completions"
+    chat = chat_api(system_msg="", fallback_models=["gpt-backup"])
+    assert chat.fallback_endpoints["gpt-backup"][0] == "https://api.openai.com/v1/chat/completions"
+    chat.fallback_endpoints["gpt-backup"] = (chat_url, "test-key")
+
+    # connection error of the primary fails over
+    chat.url = "http://127.0.0.1:1/v1/chat/completions"
+    assert chat.chat("hi") == "echo: hi"
+    assert chat.usage.last["model"] == "gpt-backup"
+    assert chat.usage.summary()["models"]["gpt-test"]["calls"] == 1
+    assert "".join(chat.chat_stream("there")) == "echo: there"
+    chat.fallback_models = []
+    assert isinstance(chat.chat("hi"), Exception)
+
+    # slow primary is hedged with the fallback, the first answer wins
+    chat = chat_api(system_msg="", fallback_models=["gpt-backup"], hedge_after=0.1)
+    chat.fallback_endpoints["gpt-backup"] = (chat_url, "test-key")
+    chat.url = chat_url + "?delay=0.5"
+    start = time.perf_counter()
+    assert chat.chat("hi") == "echo: hi"
+    assert time.perf_counter() - start < 0.4
+    assert chat.usage.last["model"] == "gpt-backup"
+    # the slow primary which lost is discarded when it completes
+    time.sleep(0.6)
+    assert chat.usage.last["model"] == "gpt-backup"
+    assert "gpt-test" not in chat.usage.summary()["models"]
+
+    # the loser is aborted and its token reservation is released, before its answer would come
+    limiter = px.ChatRateLimiter()
+    chat = chat_api(system_msg="", fallback_models=["gpt-backup"], hedge_after=0.1, rate_limiter=limiter)
+    chat.fallback_endpoints["gpt-backup"] = (chat_url, "test-key")
+    chat.url = chat_url + "?delay=2"
+    key = limiter.key(chat.url, "gpt-test")
+    limiter.update(key, {"x-ratelimit-limit-tokens": "60", "x-ratelimit-remaining-tokens": "60"})
+    start = time.perf_counter()
+    assert chat.chat("hello world") == "echo: hello world"
+    while limiter.stats()[key]["tokens_available"] < 60 and time.perf_counter() - start < 1:
+        time.sleep(0.01)
+    assert time.perf_counter() - start < 1
+    assert "gpt-test" not in chat.usage.summary()["models"]
+
+    # hedge by observed p95 only after enough calls
+    chat.hedge_after = "p95"
+    assert chat._hedge_delay() is None
+    for _ in range(chat.HEDGE_MIN_CALLS):
+        chat.usage.record("gpt-test", 0.2)
+    assert 0.1 < chat._hedge_delay() <= 0.25
+
+
+def test_deadline(httpbin, chat_api, monkeypatch, tmp_path):
+    assert px.remaining_time() is None
+    with px.deadline(0.3):
+        assert 0.2 < px.remaining_time() <= 0.3
+        with px.deadline(10):
+            # nested deadline can't extend the outer one
+            assert px.remaining_time() <= 0.3
+        start = time.perf_counter()
+        resp = px.request("GET", httpbin.url + "/delay/1")
+        assert isinstance(resp, px.DeadlineExceeded) and isinstance(resp, TimeoutError)
+        assert time.perf_counter() - start < 0.6
+        assert isinstance(px.request("GET", httpbin.url + "/get"), px.DeadlineExceeded)
+
+    # a body trickling in faster than the read timeout is cut at the deadline, streamed or not
+    drip_url = httpbin.url + "/drip?numbytes=20&duration=2"
+    start = time.perf_counter()
+    with px.deadline(0.3):
+        assert isinstance(px.request("GET", drip_url), px.DeadlineExceeded)
+    with px.deadline(0.3):
+        chunks = px.request("GET", drip_url, stream=True, chunk_size=1)
+    with pytest.raises(px.DeadlineExceeded):
+        list(chunks)
+    assert time.perf_counter() - start < 1.2
+    with px.deadline(5):
+        assert px.request("GET", httpbin.url + "/drip?numbytes=3&duration=0.1") == "***"
+
+    # propagated to thread pools
+    with px.deadline(0.3):
+        results = px.request_many([httpbin.url + "/delay/1", httpbin.url + "/get"])
+    assert isinstance(results[0], px.DeadlineExceeded) and results[1]["url"].endswith("/get")
+
+    # no retry beyond the deadline
+    with px.deadline(0.5):
+        start = time.perf_counter()
+        resp = px.request("GET", httpbin.url + "/status/503", retry=px.RetryPolicy(backoff_factor=1, jitter=False))
+        assert "503" in str(resp) and time.perf_counter() - start < 0.5
+
+    chat = chat_api(system_msg="")
+    chat.url += "?delay=1"
+    with px.deadline(0.2):
+        assert isinstance(chat.chat("hi"), px.DeadlineExceeded)
+
+    start = time.perf_counter()
+    with px.deadline(0.3):
+        ret = px.bash("echo start; sleep 5; echo end")
+    assert ret.returncode == 124 and ret.stdout == "start\n" and "timed out" in ret.stderr
+    assert time.perf_counter() - start < 2
+    assert px.bash("echo ok", timeout=5).stdout == "ok\n"
+    monkeypatch.setenv("BASH_EXIT_ON_ERROR", "false")
+    assert px.bashx("sleep 5", x=False, timeout=0.2).returncode == 124
+
+    # Ctrl+C is forwarded to the own process group of the shell, its children don't keep running
+    import signal
+
+    pid_file = tmp_path / "pid"
+    timer = threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    start = time.perf_counter()
+    with pytest.raises(KeyboardInterrupt):
+        px.bash(f"echo $$ > {pid_file}; sleep 5; sleep 5", timeout=20)
+    assert time.perf_counter() - start < 2
+    time.sleep(0.1)
+    with pytest.raises(ProcessLookupError):
+        os.killpg(int(pid_file.read_text()), 0)
+
+
+def test_token_counter_many(byte_encoding):
+    assert px.token_counter("hello world") == 2
+    # unknown model uses the default encoding
+    assert px.token_counter("hello world", model="grok-test") == 2
+    assert px.pxutil._get_encoder() is byte_encoding
+
+    texts = [f"hello world {i} <|endoftext|>" for i in range(1000)]
+    counts = px.token_counter_many(iter(texts), num_threads=4, batch_size=64)
+    assert counts.typecode == "I" and len(counts) == 1000
+    assert list(counts) == [px.token_counter(t) for t in texts]
+    assert px.token_counter_many(texts, num_threads=1) == counts
+    assert len(px.token_counter_many([])) == 0
+
+
+def test_token_counter_unknown_model(byte_encoding, monkeypatch):
+    import tiktoken
+
+    # nothing loaded yet, the default encoding is loaded while getting the encoder of an unknown model
+    monkeypatch.setattr(px.pxutil, "_token_encoders", {})
+    loaded = []
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: loaded.append(name) or byte_encoding)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(px.token_counter("hello world", model="grok-4")))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert result == [2]
+    assert px.pxutil._get_encoder(model="grok-4") is byte_encoding
+    # the encoding of an unknown model is not cached under the model name only
+    px.pxutil._get_encoder("cl100k_base", model="grok-4")
+    px.pxutil._get_encoder(model="gpt-4o")
+    assert loaded == [px.pxutil.TOKEN_ENCODING, "cl100k_base"]
+    assert px.pxutil._approx_encoding("cl100k_base", model="grok-4") == "cl100k_base"
+    assert px.pxutil._approx_encoding("cl100k_base", model="gpt-4o") == "o200k_base"
+
+
+def test_token_counter_file(byte_encoding, tmp_path):
+    text = "".join(
+        f"hello world {i}!\n  indented  line, ünïcödé 你好 {i * 7}\r\n\nend." for i in range(300)
+    )
+    path = tmp_path / "big.txt"
+    path.write_bytes(text.encode("utf-8"))
+    expected = px.token_counter(text)
+
+    progress = []
+    # small chunks split multi-byte characters and most lines
+    for chunk_size in (7, 64, 1000, 1 << 20):
+        assert px.token_counter_file(str(path), chunk_size=chunk_size) == expected
+    assert px.token_counter_file(io.BytesIO(text.encode("utf-8")), chunk_size=100, progress=lambda *a: progress.append(a)) == expected
+    assert progress[-1][1] == expected and progress[-1][0] == len(text.encode("utf-8"))
+
+    # safe boundaries only
+    assert px.pxutil._split_token_safe("a b  c\n d") == ("a", " b  c\n d")
+    assert px.pxutil._split_token_safe("a\nb c") == ("a\nb", " c")
+    assert px.pxutil._split_token_safe("a\n\nb") == ("", "a\n\nb")
+    assert px.pxutil._split_token_safe("a.\nb") == ("a.\n", "b")
+    assert px.pxutil._split_token_safe("a;\n//b") == ("", "a;\n//b")
+    # no boundary in a long stretch is split anyway
+    assert px.token_counter_file(io.BytesIO(b"x" * 1000), chunk_size=10) > 0
+
+
+def test_token_counter_file_o200k_pattern(monkeypatch):
+    import tiktoken
+
+    # pre-tokenization pattern of o200k_base, whose punctuation pieces take the newlines and / after them
+    pat_str = "|".join(
+        [
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""\p{N}{1,3}""",
+            r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+            r"""\s*[\r\n]+""",
+            r"""\s+(?!\S)""",
+            r"""\s+""",
+        ]
+    )
+    ranks = {bytes([i]): i for i in range(256)}
+    # merges across the newline, so a split there changes the count
+    for merge in (b";\n", b";\n/", b";\n//", b".\n", b".\n/", b":\n", b":\n/", b":\n/*"):
+        ranks[merge] = len(ranks)
+    encoding = tiktoken.Encoding(name="test_o200k_pattern", pat_str=pat_str, mergeable_ranks=ranks, special_tokens={})
+    monkeypatch.setattr(px.pxutil, "_token_encoders", {px.pxutil.TOKEN_ENCODING: encoding})
+
+    text = "".join(f"int a{i} = {i};\n// note {i}\ncd {i}.\n/usr/bin\nx{i}:\n/* c */ end\n" for i in range(200))
+    expected = px.token_counter(text)
+    for chunk_size in (5, 16, 64, 1000):
+        assert px.token_counter_file(io.BytesIO(text.encode("utf-8")), chunk_size=chunk_size) == expected
+
+
+def test_token_report(byte_encoding, tmp_path, monkeypatch):
+    import multiprocessing
+    from pxutil.cli import list_text_files, token_report, _expand_token_paths
+
+    (tmp_path / "src" / "sub").mkdir(parents=True)
+    (tmp_path / "src" / "a.py").write_text("hello world\n" * 10)
+    (tmp_path / "src" / "sub" / "b.py").write_text("hello\n")
+    (tmp_path / "src" / "c.bin").write_bytes(b"\xff\xfe\x00" * 10)
+    (tmp_path / "src" / "ignored.log").write_text("hello\n")
+    (tmp_path / "src" / ".gitignore").write_text("*.log\n")
+    monkeypatch.chdir(tmp_path)
+    px.bash("git -C src init -q && git -C src add -A")
+
+    assert sorted(list_text_files("src")) == [".gitignore", "a.py", "sub/b.py"]
+    files = _expand_token_paths(["src", "src/**/*.py"])
+    assert files == ["src/.gitignore", "src/a.py", "src/sub/b.py"]
+
+    counts = px.token_counter_files(files, max_workers=1)
+    assert counts == [px.token_counter(open(f).read()) for f in files]
+    if multiprocessing.get_start_method() == "fork":
+        # workers inherit the test encoding
+        assert px.token_counter_files(files, max_workers=2) == counts
+    assert isinstance(px.token_counter_files(["missing.txt"])[0], Exception)
+
+    report = token_report(files + ["missing.txt"], counts + [FileNotFoundError("missing.txt")])
+    assert [r["path"] for r in report["files"]] == ["src/a.py", "src/.gitignore", "src/sub/b.py"]
+    assert report["directories"][0] == {"path": "src", "tokens": sum(counts), "bytes": 132, "files": 3}
+    assert report["directories"][1]["path"] == "src/sub"
+    assert report["total"] == {"tokens": sum(counts), "bytes": 132, "files": 3}
+    assert report["errors"][0]["path"] == "missing.txt"
+
+
+def test_token_count_cache(byte_encoding, tmp_path, monkeypatch):
+    cache = px.TokenCountCache(str(tmp_path / "counts.sqlite3"), max_entries=10)
+    text = "hello world\n" * 100
+    assert px.token_counter(text, cache=cache) == px.token_counter(text) == cache.count(text)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    files = []
+    for i in range(5):
+        path = tmp_path / f"f{i}.txt"
+        path.write_text("hello world " * (i + 1))
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        files.append(str(path))
+    expected = px.token_counter_files(files, max_workers=1)
+    assert cache.count_files(files, max_workers=1) == expected
+    assert cache.stats()["misses"] == 6
+
+    # unchanged files are served by the fast path without reading them
+    with monkeypatch.context() as m:
+        m.setattr(px.pxutil, "_file_digest", None)
+        assert px.token_counter_files(files, cache=cache) == expected
+    assert cache.stats()["file_hits"] == 5
+
+    # touched file of the same content is hashed but not counted again
+    os.utime(files[0], (time.time() - 5, time.time() - 5))
+    # changed file is counted again, and its fast path is skipped while it may change in the same mtime tick
+    with open(files[1], "a") as f:
+        f.write("hello")
+    stats = cache.stats()
+    assert cache.count_files(files + [str(tmp_path / "missing")], max_workers=1)[:5] == [
+        expected[0], expected[1] + 1, *expected[2:]
+    ]
+    assert cache.stats()["hits"] == stats["hits"] + 1 and cache.stats()["misses"] == stats["misses"] + 1
+    assert cache.stats()["files"] == 4
+
+    # few changed files are counted in this process without a process pool
+    import concurrent.futures
+
+    with monkeypatch.context() as m:
+        m.setattr(concurrent.futures, "ProcessPoolExecutor", None)
+        assert cache.count_files(files, max_workers=4)[2:] == expected[2:]
+
+    # a miss is counted from the content read to hash it, and a file changed since is not cached
+    path = tmp_path / "changing.txt"
+    path.write_text("hello")
+    os.utime(path, (time.time() - 10, time.time() - 10))
+
+    def digest_then_change(p, keep_bytes=0):
+        result = _file_digest(p, keep_bytes)
+        with open(p, "a") as f:
+            f.write(" world")
+        os.utime(p, (time.time() - 5, time.time() - 5))
+        return result
+
+    _file_digest = px.pxutil._file_digest
+    stats = cache.stats()
+    with monkeypatch.context() as m:
+        m.setattr(px.pxutil, "_file_digest", digest_then_change)
+        assert cache.count_file(str(path)) == px.token_counter("hello")
+    assert cache.stats()["counts"] == stats["counts"] and cache.stats()["files"] == stats["files"]
+
+    # capped to max_entries
+    for i in range(20):
+        cache.count(f"text {i}")
+    assert cache.stats()["counts"] <= 10
+    # last used times of hits are written in batches
+    assert cache.count("text 19") == px.token_counter("text 19")
+    assert list(cache._touched) == [(cache.key("text 19"), px.pxutil.TOKEN_ENCODING)]
+    cache.close()
+    assert not cache._touched
+
+
+def test_token_counter_approx(tmp_path, monkeypatch):
+    # estimated without loading any tiktoken encoder
+    monkeypatch.setattr(px.pxutil, "_get_encoder", None)
+    assert px.token_counter("", approx=True) == 0
+    assert px.pxutil._approx_features("Hello, world 2024!\n\n你好") == {
+        "words": 2, "letters": 10, "digits": 4, "punctuation": 2, "whitespace": 1, "cjk": 2, "other": 2,
+    }  # fmt: skip
+    # within the documented p95 relative error (13%) of real tiktoken counts of fixed samples
+    prose = (
+        "Tokenizers split text into pieces that a language model reads one at a time. Common English words "
+        "are usually a single token, while rare words, names and numbers like 1234567 are split into several. "
+        "This estimate counts words, letters, digits, punctuation and whitespace instead, and weighs them by "
+        "coefficients fitted to real counts, so it needs no vocabulary and runs in microseconds.\n"
+    )
+    code = (
+        "def fibonacci(n: int) -> list[int]:\n"
+        '    """return the first n Fibonacci numbers"""\n'
+        "    numbers = [0, 1]\n"
+        "    while len(numbers) < n:\n"
+        "        numbers.append(numbers[-1] + numbers[-2])\n"
+        "    return numbers[:n]\n"
+        "\n"
+        "\n"
+        'if __name__ == "__main__":\n'
+        "    for i, value in enumerate(fibonacci(20)):\n"
+        '        print(f"{i:>3}: {value}")\n'
+    )
+    real_counts = {  # by tiktoken encode_ordinary()
+        ("o200k_base", prose): 77, ("o200k_base", code): 86,
+        ("cl100k_base", prose): 76, ("cl100k_base", code): 86,
+    }  # fmt: skip
+    for (encoding, sample), real in real_counts.items():
+        assert abs(px.token_counter_approx(sample, encoding) - real) <= 0.13 * real
+    text = prose * 4
+    assert px.token_counter_approx(text, model="gpt-4") != px.token_counter_approx("你好" * 100)
+
+    # streamed file count adds up to the count of the whole text
+    path = tmp_path / "text.txt"
+    path.write_text(text)
+    assert px.token_counter_file(str(path), chunk_size=64, approx=True) == px.token_counter(text, approx=True)
+    assert px.token_counter_files([str(path)], approx=True) == [px.token_counter(text, approx=True)]